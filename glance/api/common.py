@@ -13,11 +13,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+
+import webob.exc
+
 from glance.common import exception
 from glance.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
 
+FILE_WRAPPER_BLOCK_SIZE = 65536
+
 
 def size_checked_iter(response, image_meta, expected_size, image_iter,
                       notifier):
@@ -52,6 +58,105 @@ def size_checked_iter(response, image_meta, expected_size, image_iter,
                                           "image %(image_id)s") % locals())
 
 
+def file_wrapped_iter(response, image_meta, expected_size, image_iter,
+                      notifier):
+    """
+    Returns an app_iter that hands the open file behind image_iter to the
+    WSGI server's ``wsgi.file_wrapper``, so that servers supporting it can
+    send the image straight from disk (with sendfile(), for example)
+    instead of copying it through Python. Returns None if image_iter is
+    not backed by a local file, the server offers no file wrapper, or the
+    file is not the expected size, in which case the image should be
+    streamed through size_checked_iter instead. The image.send
+    notification is sent when the server closes the file wrapper.
+    """
+    environ = response.request.environ
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is None or not hasattr(image_iter, 'fileno'):
+        return None
+
+    try:
+        file_size = os.fstat(image_iter.fileno()).st_size
+    except (OSError, ValueError):
+        return None
+    if file_size != expected_size:
+        return None
+
+    def notify_image_sent():
+        image_send_notification(file_size, expected_size, image_meta,
+                                response.request, notifier)
+
+    return file_wrapper(NotifyingFile(image_iter, notify_image_sent),
+                        FILE_WRAPPER_BLOCK_SIZE)
+
+
+class NotifyingFile(object):
+    """
+    Wraps the file behind an image handed to ``wsgi.file_wrapper``, so
+    that a callback runs when the server closes it after sending it.
+    """
+
+    def __init__(self, image_file, on_close):
+        self.image_file = image_file
+        self.on_close = on_close
+
+    def read(self, size=-1):
+        return self.image_file.read(size)
+
+    def fileno(self):
+        return self.image_file.fileno()
+
+    def close(self):
+        self.image_file.close()
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close()
+
+
+def get_requested_range(request, image_size, checksum=None):
+    """
+    Returns a tuple of the offset and length of the part of an image of
+    image_size bytes asked for with a Range header, or None if the whole
+    image should be sent. Only a single byte range is supported, so a
+    request for several ranges gets the whole image, as does one whose
+    If-Range header does not match the image checksum.
+
+    :raises webob.exc.HTTPRequestRangeNotSatisfiable if the range starts
+            beyond the end of the image
+    """
+    header = request.headers.get('Range')
+    if not header or not image_size or ',' in header:
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range is not None and if_range.strip('"') != checksum:
+        return None
+    byte_range = request.range
+    if byte_range is None:
+        return None
+
+    image_size = int(image_size)
+    bounds = byte_range.range_for_length(image_size)
+    if bounds is None:
+        if byte_range.start < 0:
+            # A suffix longer than the image is the whole image
+            return None
+        content_range = 'bytes */%d' % image_size
+        raise webob.exc.HTTPRequestRangeNotSatisfiable(
+                headers={'Content-Range': content_range})
+    start, stop = bounds
+    return (start, stop - start)
+
+
+def set_range_headers(response, image_range, image_size):
+    """Turns response into a 206 response for part of the image"""
+    offset, length = image_range
+    response.status_int = 206
+    response.headers['Content-Range'] = ('bytes %d-%d/%d' %
+                                         (offset, offset + length - 1,
+                                          int(image_size)))
+    response.headers['Content-Length'] = str(length)
+
+
 def image_send_notification(bytes_written, expected_size, image_meta, request,
                             notifier):
     """Send an image.send message to the notifier."""
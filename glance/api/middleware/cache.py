@@ -28,6 +28,7 @@ import re
 
 import webob
 
+from glance.api import common
 from glance.api.v1 import images
 from glance.common import exception
 from glance.common import utils
@@ -90,11 +91,22 @@ class CacheFilter(wsgi.Middleware):
 
         self._stash_request_info(request, image_id, method)
 
-        if request.method != 'GET' or not self.cache.is_cached(image_id):
+        if request.method != 'GET':
+            return None
+
+        if self.cache.is_cached(image_id):
+            LOG.debug(_("Cache hit for image '%s'"), image_id)
+            image_iterator = self.get_from_cache(image_id)
+        elif 'Range' not in request.headers:
+            # Join a request that is already fetching the image into the
+            # cache, rather than fetching it from the backend again
+            image_iterator = self.cache.open_cache_fill(image_id)
+            if image_iterator is None:
+                return None
+            LOG.debug(_("Following cache fill of image '%s'"), image_id)
+        else:
             return None
 
-        LOG.debug(_("Cache hit for image '%s'"), image_id)
-        image_iterator = self.get_from_cache(image_id)
         method = getattr(self, '_process_%s_request' % version)
 
         try:
@@ -104,7 +116,9 @@ class CacheFilter(wsgi.Middleware):
                     "however the registry did not contain metadata for "
                     "that image!" % image_id)
             LOG.error(msg)
-            self.cache.delete_cached_image(image_id)
+            image_iterator.close()
+            if isinstance(image_iterator, CachedImageFile):
+                self.cache.delete_cached_image(image_id)
 
     @staticmethod
     def _stash_request_info(request, image_id, method):
@@ -137,20 +151,38 @@ class CacheFilter(wsgi.Middleware):
             raise exception.NotFound()
 
         if not image_meta['size']:
+            if not isinstance(image_iterator, CachedImageFile):
+                # The size will not be known until the cache fill is done
+                image_iterator.close()
+                return None
             # override image size metadata with the actual cached
             # file size, see LP Bug #900959
             image_meta['size'] = self.cache.get_image_size(image_id)
 
+        image_range = common.get_requested_range(request, image_meta['size'],
+                                                 image_meta['checksum'])
+        if image_range:
+            image_iterator.set_range(*image_range)
+
         response = webob.Response(request=request)
         raw_response = {
             'image_iterator': image_iterator,
             'image_meta': image_meta,
+            'image_range': image_range,
         }
         return self.serializer.show(response, raw_response)
 
     def _process_v2_request(self, request, image_id, image_iterator):
         response = webob.Response(request=request)
+        image_size = self.cache.get_image_size(image_id)
+        # The checksum is not known here, so If-Range gets the whole image
+        image_range = common.get_requested_range(request, image_size)
+        if image_range:
+            image_iterator.set_range(*image_range)
         response.app_iter = image_iterator
+        response.headers['Accept-Ranges'] = 'bytes'
+        if image_range:
+            common.set_range_headers(response, image_range, image_size)
         return response
 
     def process_response(self, resp):
@@ -161,6 +193,9 @@ class CacheFilter(wsgi.Middleware):
         """
         if not 200 <= self.get_status_code(resp) < 300:
             return resp
+        if self.get_status_code(resp) == 206:
+            # Only part of the image is being sent, so it cannot be cached
+            return resp
 
         try:
             (image_id, method) = self._fetch_request_info(resp.request)
@@ -193,8 +228,15 @@ class CacheFilter(wsgi.Middleware):
         if not image_checksum:
             LOG.error(_("Checksum header is missing."))
 
+        image_size = resp.headers.get('Content-Length',
+                                      resp.headers.get('x-image-meta-size'))
+        try:
+            image_size = int(image_size)
+        except (TypeError, ValueError):
+            image_size = None
+
         resp.app_iter = self.cache.get_caching_iter(image_id, image_checksum,
-                                                    resp.app_iter)
+                                                    resp.app_iter, image_size)
         return resp
 
     def get_status_code(self, response):
@@ -208,7 +250,60 @@ class CacheFilter(wsgi.Middleware):
 
     def get_from_cache(self, image_id):
         """Called if cache hit"""
-        with self.cache.open_for_read(image_id) as cache_file:
-            chunks = utils.chunkiter(cache_file)
-            for chunk in chunks:
+        return CachedImageFile(self.cache, image_id)
+
+
+class CachedImageFile(object):
+    """
+    Iterates over the file of a cached image. The file is opened on first
+    use and kept open for reading until it is exhausted or closed. It is
+    exposed like the open file itself so that it can be handed to
+    ``wsgi.file_wrapper``.
+    """
+
+    def __init__(self, cache, image_id):
+        self.cache = cache
+        self.image_id = image_id
+        self.reader = None
+        self.fp = None
+        self.offset = 0
+        self.remaining = None
+
+    def set_range(self, offset, length):
+        """Limits reading to length bytes from offset of the image"""
+        self.offset = offset
+        self.remaining = length
+
+    def _open(self):
+        if self.fp is None:
+            self.reader = self.cache.open_for_read(self.image_id)
+            self.fp = self.reader.__enter__()
+            if self.offset:
+                self.fp.seek(self.offset)
+        return self.fp
+
+    def __iter__(self):
+        try:
+            for chunk in utils.chunkiter(self):
                 yield chunk
+        finally:
+            self.close()
+
+    def read(self, size=-1):
+        fp = self._open()
+        if self.remaining is None:
+            return fp.read(size)
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._open().fileno()
+
+    def close(self):
+        """Finish reading the cached image file"""
+        if self.reader:
+            reader, self.reader = self.reader, None
+            reader.__exit__(None, None, None)
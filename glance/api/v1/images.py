@@ -50,6 +50,7 @@ from glance.store import (get_from_backend,
                           schedule_delayed_delete_from_backend,
                           get_store_from_location,
                           get_store_from_scheme)
+from glance.store.location import get_location_from_uri
 
 
 CONF = cfg.CONF
@@ -256,10 +257,15 @@ class Controller(controller.BaseController):
         External sources (as specified via the location or copy-from headers)
         are supported only over non-local store types, i.e. S3, Swift, HTTP.
         Note the absence of file:// for security reasons, see LP bug #942118.
+        RBD sources are read with Glance's own credentials, so only admins
+        may use them.
         If the above constraint is violated, we reject with 400 "Bad Request".
         """
         if source:
-            for scheme in ['s3', 'swift', 'http']:
+            schemes = ['s3', 'swift', 'http']
+            if req.context.is_admin:
+                schemes.append('rbd')
+            for scheme in schemes:
                 if source.lower().startswith(scheme):
                     return source
             msg = _("External sourcing not supported for store %s") % source
@@ -278,9 +284,11 @@ class Controller(controller.BaseController):
         return Controller._validate_source(source, req)
 
     @staticmethod
-    def _get_from_store(context, where):
+    def _get_from_store(context, where, offset=0, length=None):
         try:
-            image_data, image_size = get_from_backend(context, where)
+            image_data, image_size = get_from_backend(context, where,
+                                                      offset=offset,
+                                                      length=length)
         except exception.NotFound, e:
             raise HTTPNotFound(explanation="%s" % e)
         image_size = int(image_size) if image_size else None
@@ -289,7 +297,8 @@ class Controller(controller.BaseController):
     def show(self, req, id):
         """
         Returns an iterator that can be used to retrieve an image's
-        data along with the image metadata.
+        data along with the image metadata. A single byte range of the
+        data can be requested with a Range header.
 
         :param req: The WSGI/Webob Request object
         :param id: The opaque image identifier
@@ -300,18 +309,24 @@ class Controller(controller.BaseController):
         self._enforce(req, 'download_image')
         image_meta = self.get_active_image_meta_or_404(req, id)
 
+        image_range = None
         if image_meta.get('size') == 0:
             image_iterator = iter([])
         else:
+            image_range = common.get_requested_range(
+                    req, image_meta.get('size'), image_meta.get('checksum'))
+            offset, length = image_range or (0, None)
             image_iterator, size = self._get_from_store(req.context,
-                                                        image_meta['location'])
-            image_iterator = utils.cooperative_iter(image_iterator)
-            image_meta['size'] = size or image_meta['size']
+                                                        image_meta['location'],
+                                                        offset, length)
+            if image_range is None:
+                image_meta['size'] = size or image_meta['size']
 
         del image_meta['location']
         return {
             'image_iterator': image_iterator,
             'image_meta': image_meta,
+            'image_range': image_range,
         }
 
     def _reserve(self, req, image_meta):
@@ -420,10 +435,24 @@ class Controller(controller.BaseController):
                     "to %(scheme)s store"), locals())
 
         try:
-            location, size, checksum = store.add(
-                image_meta['id'],
-                utils.CooperativeReader(image_data),
-                image_meta['size'])
+            result = None
+            if copy_from and not image_meta.get('checksum'):
+                # Some stores can copy within the backend without the
+                # data passing through here. Such a copy is never read,
+                # so the image is recorded without a checksum. When a
+                # checksum is supplied, the data is streamed through
+                # add() instead so that the checksum is verified.
+                result = store.add_from_location(
+                    image_meta['id'],
+                    get_location_from_uri(copy_from),
+                    image_meta['size'],
+                    context=req.context)
+            if result is None:
+                result = store.add(image_meta['id'],
+                                   utils.CooperativeReader(image_data),
+                                   image_meta['size'],
+                                   context=req.context)
+            location, size, checksum = result
 
             def _kill_mismatched(image_meta, attr, actual):
                 supplied = image_meta.get(attr)
@@ -966,12 +995,27 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
         image_meta = result['image_meta']
 
         image_iter = result['image_iterator']
-        # image_meta['size'] should be an int, but could possibly be a str
-        expected_size = int(image_meta['size'])
-        response.app_iter = common.size_checked_iter(
-                response, image_meta, expected_size, image_iter, self.notifier)
-        # Using app_iter blanks content-length, so we set it here...
-        response.headers['Content-Length'] = str(image_meta['size'])
+        image_range = result.get('image_range')
+        if image_range:
+            response.app_iter = common.size_checked_iter(
+                    response, image_meta, image_range[1],
+                    utils.cooperative_iter(image_iter), self.notifier)
+            common.set_range_headers(response, image_range,
+                                     image_meta['size'])
+        else:
+            # image_meta['size'] should be an int, but could possibly be
+            # a str
+            expected_size = int(image_meta['size'])
+            response.app_iter = common.file_wrapped_iter(
+                    response, image_meta, expected_size, image_iter,
+                    self.notifier)
+            if response.app_iter is None:
+                response.app_iter = common.size_checked_iter(
+                        response, image_meta, expected_size,
+                        utils.cooperative_iter(image_iter), self.notifier)
+            # Using app_iter blanks content-length, so we set it here...
+            response.headers['Content-Length'] = str(image_meta['size'])
+        response.headers['Accept-Ranges'] = 'bytes'
         response.headers['Content-Type'] = 'application/octet-stream'
 
         self._inject_image_meta_headers(response, image_meta)
@@ -103,6 +103,14 @@ class ImageDataController(object):
         image = self._get_image(ctx, image_id)
         location = image['location']
         if location:
+            image_range = common.get_requested_range(req, image['size'],
+                                                     image['checksum'])
+            if image_range:
+                offset, length = image_range
+                image_data, image_size = self.store_api.get_from_backend(
+                        ctx, location, offset=offset, length=length)
+                return {'data': image_data, 'meta': image,
+                        'range': image_range}
             image_data, image_size = self.store_api.get_from_backend(ctx,
                                                                      location)
             #NOTE(bcwaldon): This is done to match the behavior of the v1 API.
@@ -135,17 +143,31 @@ class ResponseSerializer(wsgi.JSONResponseSerializer):
     def download(self, response, result):
         size = result['meta']['size']
         checksum = result['meta']['checksum']
+        image_range = result.get('range')
         response.headers['Content-Type'] = 'application/octet-stream'
-        response.app_iter = common.size_checked_iter(
-                response, result['meta'], size, result['data'], self.notifier)
+        response.headers['Accept-Ranges'] = 'bytes'
+        if image_range:
+            response.app_iter = common.size_checked_iter(
+                    response, result['meta'], image_range[1], result['data'],
+                    self.notifier)
+            common.set_range_headers(response, image_range, size)
+        else:
+            response.app_iter = common.file_wrapped_iter(
+                    response, result['meta'], size, result['data'],
+                    self.notifier)
+            if response.app_iter is None:
+                response.app_iter = common.size_checked_iter(
+                        response, result['meta'], size, result['data'],
+                        self.notifier)
+            #NOTE(markwash): "response.app_iter = ..." also erroneously
+            # resets the content-length
+            response.headers['Content-Length'] = str(size)
         #NOTE(saschpe): "response.app_iter = ..." currently resets Content-MD5
         # (https://github.com/Pylons/webob/issues/86), so it should be set
-        # afterwards for the time being.
-        if checksum:
+        # afterwards for the time being. It is the checksum of the whole
+        # image, so it does not apply to a part of it.
+        if checksum and not image_range:
             response.headers['Content-MD5'] = checksum
-        #NOTE(markwash): "response.app_iter = ..." also erroneously resets the
-        # content-length
-        response.headers['Content-Length'] = str(size)
 
     def upload(self, response, result):
         response.status_int = 201
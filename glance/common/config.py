@@ -54,6 +54,11 @@ common_opts = [
     cfg.IntOpt('image_size_cap', default=1099511627776,
                help=_("Maximum size of image a user can upload in bytes. "
                       "Defaults to 1099511627776 bytes (1 TB).")),
+    cfg.IntOpt('image_chunk_size', default=None,
+               help=_("Size in bytes of the chunks image data is read, "
+                      "written and sent in by the API server and the "
+                      "stores. If unset each store uses its own "
+                      "default.")),
     cfg.BoolOpt('enable_v1_api', default=True,
                 help=_("Deploy the v1 OpenStack Images API. ")),
     cfg.BoolOpt('enable_v2_api', default=True,
@@ -87,6 +92,10 @@ def parse_args(args=None, usage=None, default_config_files=None):
          version=version.cached_version_string(),
          usage=usage,
          default_config_files=default_config_files)
+    if CONF.image_chunk_size is not None and CONF.image_chunk_size <= 0:
+        raise RuntimeError(_("Invalid image_chunk_size %d: it must be a "
+                             "positive number of bytes") %
+                           CONF.image_chunk_size)
 
 
 def parse_cache_args(args=None):
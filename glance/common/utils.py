@@ -24,9 +24,13 @@ import errno
 
 try:
     from eventlet import sleep
+    from eventlet import spawn
+    from eventlet import tpool
 except ImportError:
     from time import sleep
+    tpool = None
 
+import collections
 import functools
 import os
 import platform
@@ -42,27 +46,44 @@ import glance.openstack.common.log as logging
 
 LOG = logging.getLogger(__name__)
 
+CONF = cfg.CONF
+CONF.import_opt('image_chunk_size', 'glance.common.config')
+
 FEATURE_BLACKLIST = ['content-length', 'content-type', 'x-image-meta-size']
 
+DEFAULT_CHUNK_SIZE = 65536
+
+
+def get_chunk_size(default=DEFAULT_CHUNK_SIZE):
+    """
+    Return the size of the chunks image data should be moved in: the
+    image_chunk_size option when it is set, otherwise the given default.
+
+    :param default: chunk size to use if none is configured
+    """
+    return CONF.image_chunk_size or default
+
 
-def chunkreadable(iter, chunk_size=65536):
+def chunkreadable(iter, chunk_size=None):
     """
     Wrap a readable iterator with a reader yielding chunks of
     a preferred size, otherwise leave iterator unchanged.
 
     :param iter: an iter which may also be readable
-    :param chunk_size: maximum size of chunk
+    :param chunk_size: maximum size of chunk, defaults to get_chunk_size()
     """
     return chunkiter(iter, chunk_size) if hasattr(iter, 'read') else iter
 
 
-def chunkiter(fp, chunk_size=65536):
+def chunkiter(fp, chunk_size=None):
     """
     Return an iterator to a file-like obj which yields fixed size chunks
 
     :param fp: a file-like object
-    :param chunk_size: maximum size of chunk
+    :param chunk_size: maximum size of chunk, defaults to get_chunk_size()
     """
+    if chunk_size is None:
+        chunk_size = get_chunk_size()
     while True:
         chunk = fp.read(chunk_size)
         if chunk:
@@ -71,6 +92,32 @@ def chunkiter(fp, chunk_size=65536):
             break
 
 
+def slice_iter(iter, offset=0, length=None):
+    """
+    Return an iterator over the bytes from offset up to offset + length
+    of the data yielded by an iterator of strings. Chunks outside that
+    range are dropped and the ones on its edges are trimmed.
+
+    :param iter: an iterator to wrap
+    :param offset: index of the first byte to return
+    :param length: number of bytes to return, or None for all the rest
+    """
+    end = None if length is None else offset + length
+    position = 0
+    for chunk in iter:
+        chunk_start = position
+        position += len(chunk)
+        if position <= offset:
+            continue
+        start = max(offset - chunk_start, 0)
+        stop = len(chunk) if end is None else min(end - chunk_start,
+                                                  len(chunk))
+        if stop > start:
+            yield chunk[start:stop]
+        if end is not None and position >= end:
+            break
+
+
 def cooperative_iter(iter):
     """
     Return an iterator which schedules after each
@@ -88,6 +135,69 @@ def cooperative_iter(iter):
         raise
 
 
+def limiting_iter(iter, limit):
+    """
+    Return an iterator which raises ImageSizeLimitExceeded as soon as
+    the data yielded by the wrapped iterator grows past limit bytes.
+
+    :param iter: an iterator to wrap
+    :param limit: maximum number of bytes to allow
+    """
+    total = 0
+    for chunk in iter:
+        total += len(chunk)
+        if total > limit:
+            raise exception.ImageSizeLimitExceeded()
+        yield chunk
+
+
+def hashing_iter(iter, hashers):
+    """
+    Return an iterator which feeds each chunk to the given hash objects
+    before passing it on.
+
+    :param iter: an iterator to wrap
+    :param hashers: a list of objects with an update() method, eg.
+                    ThreadedHasher
+    """
+    for chunk in iter:
+        for hasher in hashers:
+            hasher.update(chunk)
+        yield chunk
+
+
+def tee_iter(iter, write):
+    """
+    Return an iterator which passes each chunk to write before
+    passing it on.
+
+    :param iter: an iterator to wrap
+    :param write: a callable taking a chunk, eg. a file's write method
+    """
+    for chunk in iter:
+        write(chunk)
+        yield chunk
+
+
+def pipeline(iter, *stages):
+    """
+    Chain iterator stages onto a source of image data, so that each
+    chunk flows through all of them in the order given without being
+    copied or rechunked in between. A stage is a callable taking an
+    iterator and returning one, such as cooperative_iter or a partial
+    of limiting_iter, hashing_iter or tee_iter with their other
+    arguments given as keywords.
+
+    :param iter: an iterator, or a file-like object to read chunks of
+                 get_chunk_size() bytes from
+    :param stages: the stages to apply
+    """
+    iter = chunkreadable(iter)
+    for stage in stages:
+        iter = stage(iter)
+    return iter
+
+
 def cooperative_read(fd):
     """
     Wrap a file descriptor's read with a partial function which schedules
@@ -102,6 +212,145 @@ def cooperative_read(fd):
     return readfn
 
 
+class ThreadedHasher(object):
+    """
+    Wraps a hashlib hash object so that updates are hashed in a native
+    thread while the green thread feeding it goes on reading or writing
+    the next chunks of data. hashlib releases the GIL while it hashes
+    large buffers, so this neither blocks the eventlet hub nor
+    serializes hashing with the I/O. Updates are collected into batches
+    that are applied in order, with at most one outstanding, and the
+    data passed in must not be modified afterwards.
+    """
+
+    # Updates are handed to a thread in batches of at least this size.
+    # Each hand-off costs a green thread switch and a round-trip through
+    # the tpool, which takes longer than hashing a single 64KB chunk.
+    MIN_THREADED_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.pending = None
+        self.batch = []
+        self.batch_size = 0
+
+    def update(self, data):
+        if tpool is None:
+            self.hasher.update(data)
+            return
+        self.batch.append(data)
+        self.batch_size += len(data)
+        if self.batch_size >= self.MIN_THREADED_SIZE:
+            batch = self._take_batch()
+            self._wait_pending()
+            self.pending = spawn(tpool.execute, self._update_all, batch)
+
+    def _take_batch(self):
+        batch, self.batch, self.batch_size = self.batch, [], 0
+        return batch
+
+    def _update_all(self, batch):
+        for data in batch:
+            self.hasher.update(data)
+
+    def _wait_pending(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.wait()
+
+    def wait(self):
+        """Waits until all of the data passed in so far has been hashed"""
+        self._wait_pending()
+        # Less than a batch is left, so it is hashed right here
+        self._update_all(self._take_batch())
+
+    def digest(self):
+        self.wait()
+        return self.hasher.digest()
+
+    def hexdigest(self):
+        self.wait()
+        return self.hasher.hexdigest()
+
+
+class LRUCache(object):
+    """
+    A dict-like mapping which holds at most maxsize items, evicting the
+    least recently used one to make room for a new one. Reading an item
+    with get() or [] as well as setting it counts as using it.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = {}  # key -> (value, last use)
+        # (last use, key) in order of use; an item is stale once its key
+        # has been used again or removed
+        self.order = collections.deque()
+        self.clock = 0
+
+    def _use(self, key, value):
+        self.clock += 1
+        self.data[key] = (value, self.clock)
+        self.order.append((self.clock, key))
+
+    def _compact(self):
+        if len(self.order) > 2 * len(self.data) + 16:
+            self.order = collections.deque(sorted(
+                (used, key) for key, (value, used) in self.data.iteritems()))
+
+    def __getitem__(self, key):
+        value = self.data[key][0]
+        self._use(key, value)
+        self._compact()
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._use(key, value)
+        while len(self.data) > self.maxsize:
+            used, old_key = self.order.popleft()
+            if self.data.get(old_key, (None, None))[1] == used:
+                del self.data[old_key]
+        self._compact()
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self._compact()
+
+    def pop(self, key, *default):
+        try:
+            value = self.data.pop(key)[0]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        self._compact()
+        return value
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self.data.keys()
+
+    def values(self):
+        return [value for value, used in self.data.itervalues()]
+
+    def items(self):
+        return [(key, value) for key, (value, used) in self.data.iteritems()]
+
+
 class CooperativeReader(object):
     """
     An eventlet thread friendly class for reading in image data.
@@ -156,12 +405,9 @@ class LimitingReader(object):
         self.bytes_read = 0
 
     def __iter__(self):
-        for chunk in self.data:
+        for chunk in limiting_iter(self.data, self.limit):
             self.bytes_read += len(chunk)
-            if self.bytes_read > self.limit:
-                raise exception.ImageSizeLimitExceeded()
-            else:
-                yield chunk
+            yield chunk
 
     def read(self, i):
         result = self.data.read(i)
@@ -19,7 +19,12 @@
 LRU Cache for Image Data
 """
 
+import functools
 import hashlib
+import io
+
+import eventlet
+from eventlet import event
 
 from glance.common import exception
 from glance.common import utils
@@ -34,6 +39,7 @@ image_cache_opts = [
     cfg.IntOpt('image_cache_max_size', default=10 * (1024 ** 3)),  # 10 GB
     cfg.IntOpt('image_cache_stall_time', default=86400),  # 24 hours
     cfg.StrOpt('image_cache_dir'),
+    cfg.BoolOpt('image_cache_enforce_max_size', default=False),
 ]
 
 CONF = cfg.CONF
@@ -47,6 +53,9 @@ class ImageCache(object):
     """Provides an LRU cache for image data."""
 
     def __init__(self):
+        self.fills = {}
+        # Sizes of the images this process is writing into the cache
+        self.reserved = {}
         self.init_driver()
 
     def init_driver(self):
@@ -174,22 +183,67 @@ class ImageCache(object):
 
         total_bytes_pruned = 0
         total_files_pruned = 0
-        entry = self.driver.get_least_recently_accessed()
-        while entry and current_size > max_size:
-            image_id, size = entry
+        entries = self.driver.get_least_recently_accessed_images(overage)
+        for image_id, size in entries:
             LOG.debug(_("Pruning '%(image_id)s' to free %(size)d bytes"),
                       {'image_id': image_id, 'size': size})
-            self.driver.delete_cached_image(image_id)
             total_bytes_pruned = total_bytes_pruned + size
             total_files_pruned = total_files_pruned + 1
-            current_size = current_size - size
-            entry = self.driver.get_least_recently_accessed()
+        self.driver.delete_cached_images([entry[0] for entry in entries])
 
         LOG.debug(_("Pruning finished pruning. "
                     "Pruned %(total_files_pruned)d and "
                     "%(total_bytes_pruned)d.") % locals())
         return total_files_pruned, total_bytes_pruned
 
+    def reserve(self, image_id, image_size):
+        """
+        Makes room in the cache for an image that is about to be cached,
+        if image_cache_enforce_max_size is set, by pruning just enough of
+        the least recently accessed images. Returns False if the image
+        cannot be fitted within image_cache_max_size, in which case it
+        should not be cached, True otherwise. A successful reservation
+        must be released once the image file is written or abandoned.
+
+        :param image_id: Image ID
+        :param image_size: Size of the image in bytes, if known
+        """
+        if not CONF.image_cache_enforce_max_size or not image_size:
+            return True
+
+        max_size = CONF.image_cache_max_size
+        reserved = sum(self.reserved.values())
+        overage = (self.driver.get_cache_size() + reserved + image_size -
+                   max_size)
+        if image_size <= max_size - reserved and overage > 0:
+            entries = self.driver.get_least_recently_accessed_images(overage)
+            freed = sum(size for entry_id, size in entries)
+            # Only prune if that makes enough room
+            if freed >= overage:
+                for entry_id, size in entries:
+                    LOG.debug(_("Pruning '%(image_id)s' to free %(size)d "
+                                "bytes"), {'image_id': entry_id, 'size': size})
+                self.driver.delete_cached_images(
+                        [entry[0] for entry in entries])
+                overage -= freed
+
+        if image_size > max_size - reserved or overage > 0:
+            LOG.warn(_("Not caching image '%(image_id)s' of %(image_size)d "
+                       "bytes, as the image cache cannot make room for it.")
+                     % locals())
+            return False
+
+        self.reserved[image_id] = image_size
+        return True
+
+    def release(self, image_id):
+        """
+        Releases the room reserved for an image by reserve()
+
+        :param image_id: Image ID
+        """
+        self.reserved.pop(image_id, None)
+
     def clean(self, stall_time=None):
         """
         Cleans up any invalid or incomplete cached images. The cache driver
@@ -208,7 +262,8 @@ class ImageCache(object):
         """
         return self.driver.queue_image(image_id)
 
-    def get_caching_iter(self, image_id, image_checksum, image_iter):
+    def get_caching_iter(self, image_id, image_checksum, image_iter,
+                         image_size=None):
         """
         Returns an iterator that caches the contents of an image
         while the image contents are read through the supplied
@@ -218,6 +273,7 @@ class ImageCache(object):
         :param image_checksum: checksum expected to be generated while
                                iterating over image data
         :param image_iter: Iterator that will read image contents
+        :param image_size: Size of the image in bytes, if known
         """
         if not self.driver.is_cacheable(image_id):
             return image_iter
@@ -225,16 +281,44 @@ class ImageCache(object):
         LOG.debug(_("Tee'ing image '%s' into cache"), image_id)
 
         def tee_iter(image_id):
+            # NOTE: room is only reserved once the image is actually read,
+            # as a response which is never sent would never release it
+            if not self.reserve(image_id, image_size):
+                for chunk in image_iter:
+                    yield chunk
+                return
+
+            fill = None
             try:
-                current_checksum = hashlib.md5()
+                current_checksum = utils.ThreadedHasher(hashlib.md5())
 
                 with self.driver.open_for_write(image_id) as cache_file:
-                    for chunk in image_iter:
-                        try:
-                            cache_file.write(chunk)
-                        finally:
-                            current_checksum.update(chunk)
-                            yield chunk
+                    fill = CacheFill(cache_file.name)
+                    self.fills[image_id] = fill
+                    write_errors = []
+
+                    def write(chunk):
+                        # NOTE: the response goes on if the cache file
+                        # cannot be written, so the error is raised later
+                        if not write_errors:
+                            try:
+                                cache_file.write(chunk)
+                                if fill.readers:
+                                    cache_file.flush()
+                            except Exception as e:
+                                write_errors.append(e)
+                                fill.finish(failed=True)
+                        fill.notify()
+
+                    data = utils.pipeline(
+                        image_iter,
+                        functools.partial(utils.hashing_iter,
+                                          hashers=[current_checksum]),
+                        functools.partial(utils.tee_iter, write=write))
+                    for chunk in data:
+                        yield chunk
+                    if write_errors:
+                        raise write_errors[0]
                     cache_file.flush()
 
                     if (image_checksum and
@@ -242,6 +326,7 @@ class ImageCache(object):
                         msg = _("Checksum verification failed. Aborted "
                                 "caching of image '%s'." % image_id)
                         raise exception.GlanceException(msg)
+                fill.finish()
 
             except exception.GlanceException as e:
                 # image_iter has given us bad, (size_checked_iter has found a
@@ -252,44 +337,113 @@ class ImageCache(object):
                 LOG.exception(_("Exception encountered while tee'ing "
                                 "image '%s' into cache: %s. Continuing "
                                 "with response.") % (image_id, e))
+            finally:
+                self.release(image_id)
+                if fill is not None:
+                    del self.fills[image_id]
+                    if not fill.done:
+                        fill.finish(failed=True)
 
             # NOTE(markwash): continue responding even if caching failed
             for chunk in image_iter:
                 yield chunk
 
-        return tee_iter(image_id)
+        def caching_iter(image_id):
+            filler = tee_iter(image_id)
+            try:
+                for chunk in filler:
+                    yield chunk
+            except GeneratorExit:
+                # NOTE: requests following the fill must not fail because
+                # the one which started it has gone away
+                fill = self.fills.get(image_id)
+                if fill is not None and fill.readers:
+                    eventlet.spawn_n(self._finish_fill, fill, filler)
+                else:
+                    filler.close()
+                raise
 
-    def cache_image_iter(self, image_id, image_iter):
+        return caching_iter(image_id)
+
+    def _finish_fill(self, fill, filler):
+        """
+        Goes on writing an image into the cache, for as long as requests
+        are following the fill, once the request which started it has
+        stopped reading.
+
+        :param fill: CacheFill of the image
+        :param filler: the caching iterator writing the image
+        """
+        try:
+            for chunk in filler:
+                if fill.done or not fill.readers:
+                    break
+        except Exception:
+            # The fill has logged the error and failed its readers
+            pass
+        finally:
+            filler.close()
+
+    def open_cache_fill(self, image_id):
+        """
+        Returns a CacheFillReader streaming the image file for an image
+        while another request writes it into the cache, or None if the
+        image is not being cached by this process. Serving concurrent
+        requests for an uncached image this way means it is only read
+        from the backend once.
+
+        :param image_id: Image ID
+        """
+        fill = self.fills.get(image_id)
+        if fill is None:
+            return None
+        try:
+            return CacheFillReader(fill)
+        except IOError:
+            # The cache file has just been moved into place or away
+            return None
+
+    def cache_image_iter(self, image_id, image_iter, image_size=None):
         """
         Cache an image with supplied iterator.
 
         :param image_id: Image ID
         :param image_file: Iterator retrieving image chunks
+        :param image_size: Size of the image in bytes, if known
 
         :retval True if image file was cached, False otherwise
         """
         if not self.driver.is_cacheable(image_id):
             return False
 
-        with self.driver.open_for_write(image_id) as cache_file:
-            for chunk in image_iter:
-                cache_file.write(chunk)
-            cache_file.flush()
+        if not self.reserve(image_id, image_size):
+            return False
+
+        try:
+            with self.driver.open_for_write(image_id) as cache_file:
+                for chunk in image_iter:
+                    cache_file.write(chunk)
+                cache_file.flush()
+        finally:
+            self.release(image_id)
         return True
 
-    def cache_image_file(self, image_id, image_file):
+    def cache_image_file(self, image_id, image_file, image_size=None):
         """
         Cache an image file.
 
         :param image_id: Image ID
         :param image_file: Image file to cache
+        :param image_size: Size of the image in bytes, if known
 
         :retval True if image file was cached, False otherwise
         """
         CHUNKSIZE = 64 * 1024 * 1024
 
+        chunk_size = utils.get_chunk_size(CHUNKSIZE)
         return self.cache_image_iter(image_id,
-                                     utils.chunkiter(image_file, CHUNKSIZE))
+                                     utils.chunkiter(image_file, chunk_size),
+                                     image_size)
 
     def open_for_read(self, image_id):
         """
@@ -319,3 +473,69 @@ class ImageCache(object):
         into the queue.
         """
         return self.driver.get_queued_images()
+
+
+class CacheFill(object):
+    """
+    Tracks the progress of an image file being written into the cache,
+    so that requests for the same image can follow the writer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.readers = 0
+        self.done = False
+        self.failed = False
+        self.progress = event.Event()
+
+    def notify(self):
+        """Wakes the readers waiting for more data to be written"""
+        progress, self.progress = self.progress, event.Event()
+        progress.send()
+
+    def finish(self, failed=False):
+        self.done = True
+        self.failed = failed
+        self.notify()
+
+    def wait(self):
+        """Waits until more data has been written or the fill is over"""
+        self.progress.wait()
+
+
+class CacheFillReader(object):
+    """
+    Iterates over an image file that is still being written into the
+    cache, waiting for the writer whenever it has caught up with it.
+    """
+
+    def __init__(self, fill):
+        self.fill = fill
+        # NOTE: io.open reads the file with plain read() calls, so data
+        # appended after we have hit the end of it is still picked up
+        self.fp = io.open(fill.path, 'rb')
+        fill.readers += 1
+
+    def __iter__(self):
+        try:
+            while True:
+                done = self.fill.done
+                chunk = self.fp.read(utils.get_chunk_size())
+                if chunk:
+                    yield chunk
+                elif not done:
+                    self.fill.wait()
+                elif self.fill.failed:
+                    msg = _("Caching of image file %s failed while it was "
+                            "being read.") % self.fill.path
+                    raise exception.GlanceException(msg)
+                else:
+                    break
+        finally:
+            self.close()
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+            self.fill.readers -= 1
@@ -170,6 +170,26 @@ class Driver(object):
         """
         raise NotImplementedError
 
+    def get_least_recently_accessed_images(self, size):
+        """
+        Return a list of (image_id, size) tuples for the least recently
+        accessed cached files, oldest first, stopping as soon as their
+        sizes add up to at least the supplied size.
+
+        :param size: Number of bytes the returned files should cover
+        """
+        raise NotImplementedError
+
+    def delete_cached_images(self, image_ids):
+        """
+        Removes the cached image files and any attributes about the images
+        with the supplied identifiers.
+
+        :param image_ids: List of image IDs
+        """
+        for image_id in image_ids:
+            self.delete_cached_image(image_id)
+
     def open_for_write(self, image_id):
         """
         Open a file for writing the image file for an image
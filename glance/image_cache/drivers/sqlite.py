@@ -20,12 +20,14 @@ Cache driver that uses SQLite to store information about cached images
 """
 
 from __future__ import absolute_import
+import atexit
 from contextlib import contextmanager
 import os
 import stat
 import time
+import weakref
 
-from eventlet import sleep, timeout
+from eventlet import semaphore, sleep, spawn_after, timeout
 import sqlite3
 
 from glance.common import exception
@@ -37,6 +39,7 @@ LOG = logging.getLogger(__name__)
 
 sqlite_opts = [
     cfg.StrOpt('image_cache_sqlite_db', default='cache.db'),
+    cfg.IntOpt('image_cache_sqlite_hit_flush_interval', default=5),
 ]
 
 CONF = cfg.CONF
@@ -71,6 +74,10 @@ class SqliteConnection(sqlite3.Connection):
         return self._timeout(lambda: sqlite3.Connection.execute(
                                         self, *args, **kwargs))
 
+    def executemany(self, *args, **kwargs):
+        return self._timeout(lambda: sqlite3.Connection.executemany(
+                                        self, *args, **kwargs))
+
     def commit(self):
         return self._timeout(lambda: sqlite3.Connection.commit(self))
 
@@ -96,6 +103,16 @@ class Driver(base.Driver):
         """
         super(Driver, self).configure()
 
+        self.conn = None
+        self.conn_pid = None
+        self.conn_lock = semaphore.Semaphore()
+        # Hits on cached images that are yet to be written to the
+        # database, as a map of image ID to (hits, last accessed time)
+        self.pending_hits = {}
+        self.last_hit_flush = time.time()
+        self.hit_flush_timer = None
+        atexit.register(_flush_hits_at_exit, weakref.ref(self))
+
         # Create the SQLite database that will hold our cache attributes
         self.initialize_db()
 
@@ -114,6 +131,30 @@ class Driver(base.Driver):
                     hits INTEGER DEFAULT 0,
                     checksum TEXT
                 );
+                CREATE INDEX IF NOT EXISTS cached_images_last_accessed
+                    ON cached_images (last_accessed);
+                CREATE TABLE IF NOT EXISTS cache_size (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    size INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO cache_size (id, size)
+                    SELECT 0, COALESCE(SUM(size), 0) FROM cached_images;
+                CREATE TRIGGER IF NOT EXISTS cached_images_insert
+                    AFTER INSERT ON cached_images
+                    BEGIN
+                        UPDATE cache_size SET size = size + NEW.size;
+                    END;
+                CREATE TRIGGER IF NOT EXISTS cached_images_delete
+                    AFTER DELETE ON cached_images
+                    BEGIN
+                        UPDATE cache_size SET size = size - OLD.size;
+                    END;
+                CREATE TRIGGER IF NOT EXISTS cached_images_update
+                    AFTER UPDATE OF size ON cached_images
+                    BEGIN
+                        UPDATE cache_size
+                            SET size = size - OLD.size + NEW.size;
+                    END;
             """)
             conn.close()
         except sqlite3.DatabaseError, e:
@@ -127,13 +168,11 @@ class Driver(base.Driver):
         """
         Returns the total size in bytes of the image cache.
         """
-        sizes = []
-        for path in self.get_cache_files(self.base_dir):
-            if path == self.db_path:
-                continue
-            file_info = os.stat(path)
-            sizes.append(file_info[stat.ST_SIZE])
-        return sum(sizes)
+        # NOTE: the total is kept up to date by triggers on cached_images,
+        # in the same transactions that add and remove cached images
+        with self.get_db() as db:
+            cur = db.execute("""SELECT size FROM cache_size""")
+            return cur.fetchone()[0]
 
     def get_hit_count(self, image_id):
         """
@@ -144,6 +183,7 @@ class Driver(base.Driver):
         if not self.is_cached(image_id):
             return 0
 
+        self.flush_hits()
         hits = 0
         with self.get_db() as db:
             cur = db.execute("""SELECT hits FROM cached_images
@@ -157,6 +197,7 @@ class Driver(base.Driver):
         Returns a list of records about cached images.
         """
         LOG.debug(_("Gathering cached image entries."))
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT
                              image_id, hits, last_accessed, last_modified, size
@@ -230,6 +271,26 @@ class Driver(base.Driver):
                        (image_id, ))
             db.commit()
 
+    def delete_cached_images(self, image_ids):
+        """
+        Removes the cached image files and any attributes about the images
+        with the supplied identifiers. The files are only removed once
+        the images are gone from the database, so that a failed delete
+        does not leave behind rows for files that no longer exist.
+
+        :param image_ids: List of image IDs
+        """
+        deleted = False
+        with self.get_db() as db:
+            db.executemany("""DELETE FROM cached_images
+                           WHERE image_id = ?""",
+                           [(image_id, ) for image_id in image_ids])
+            db.commit()
+            deleted = True
+        if deleted:
+            for image_id in image_ids:
+                delete_cached_file(self.get_image_filepath(image_id))
+
     def delete_all_queued_images(self):
         """
         Removes all queued image files and any attributes about the images
@@ -269,6 +330,7 @@ class Driver(base.Driver):
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT image_id FROM cached_images
                              ORDER BY last_accessed LIMIT 1""")
@@ -282,6 +344,27 @@ class Driver(base.Driver):
         file_info = os.stat(path)
         return image_id, file_info[stat.ST_SIZE]
 
+    def get_least_recently_accessed_images(self, size):
+        """
+        Return a list of (image_id, size) tuples for the least recently
+        accessed cached files, oldest first, stopping as soon as their
+        sizes add up to at least the supplied size.
+
+        :param size: Number of bytes the returned files should cover
+        """
+        self.flush_hits()
+        entries = []
+        total = 0
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id, size FROM cached_images
+                             ORDER BY last_accessed""")
+            for image_id, image_size in cur:
+                if total >= size:
+                    break
+                entries.append((image_id, image_size))
+                total += image_size
+        return entries
+
     @contextmanager
     def open_for_write(self, image_id):
         """
@@ -357,35 +440,103 @@ class Driver(base.Driver):
         with open(path, 'rb') as cache_file:
             yield cache_file
         now = time.time()
-        with self.get_db() as db:
-            db.execute("""UPDATE cached_images
-                       SET hits = hits + 1, last_accessed = ?
-                       WHERE image_id = ?""",
-                       (now, image_id))
-            db.commit()
+        hits, last_accessed = self.pending_hits.get(image_id, (0, now))
+        self.pending_hits[image_id] = (hits + 1, now)
+        if now - self.last_hit_flush >= (
+                CONF.image_cache_sqlite_hit_flush_interval):
+            self.flush_hits()
+        else:
+            self._schedule_hit_flush()
 
-    @contextmanager
-    def get_db(self):
+    def _schedule_hit_flush(self):
         """
-        Returns a context manager that produces a database connection that
-        self-closes and calls rollback if an error occurs while using the
-        database connection
+        Makes sure the pending hits are flushed within the flush interval
+        even if no more images are read
         """
+        if self.hit_flush_timer is None:
+            self.hit_flush_timer = spawn_after(
+                    CONF.image_cache_sqlite_hit_flush_interval,
+                    self._flush_hits_on_timer)
+
+    def _flush_hits_on_timer(self):
+        self.hit_flush_timer = None
+        try:
+            self.flush_hits()
+        except Exception:
+            LOG.exception(_("Failed to write cache hits to the database"))
+        if self.pending_hits:
+            self._schedule_hit_flush()
+
+    def flush_hits(self):
+        """
+        Writes the hits on cached images recorded since the last flush
+        to the database, in a single transaction. Hits are batched this
+        way so that reading a cached image does not cost a write
+        transaction. If the write fails, the hits are kept for the next
+        flush.
+        """
+        self.last_hit_flush = time.time()
+        if not self.pending_hits:
+            return
+        pending_hits, self.pending_hits = self.pending_hits, {}
+        flushed = False
+        try:
+            with self.get_db() as db:
+                db.executemany("""UPDATE cached_images
+                               SET hits = hits + ?, last_accessed = ?
+                               WHERE image_id = ?""",
+                               [(hits, last_accessed, image_id)
+                                for image_id, (hits, last_accessed)
+                                in pending_hits.iteritems()])
+                db.commit()
+                flushed = True
+        finally:
+            if not flushed:
+                # Merge the hits back with any recorded in the meantime
+                for image_id, (hits, last_accessed) in (
+                        pending_hits.iteritems()):
+                    if image_id in self.pending_hits:
+                        more_hits, more_accessed = self.pending_hits[image_id]
+                        hits += more_hits
+                        last_accessed = max(last_accessed, more_accessed)
+                    self.pending_hits[image_id] = (hits, last_accessed)
+
+    def _connect(self):
         conn = sqlite3.connect(self.db_path, check_same_thread=False,
                                factory=SqliteConnection)
         conn.row_factory = sqlite3.Row
         conn.text_factory = str
+        # NOTE: with a write-ahead log, readers are not blocked by a
+        # writer, and commits only need to append to the log
+        conn.execute('PRAGMA journal_mode = WAL')
         conn.execute('PRAGMA synchronous = NORMAL')
         conn.execute('PRAGMA count_changes = OFF')
         conn.execute('PRAGMA temp_store = MEMORY')
-        try:
-            yield conn
-        except sqlite3.DatabaseError, e:
-            msg = _("Error executing SQLite call. Got error: %s") % e
-            LOG.error(msg)
-            conn.rollback()
-        finally:
-            conn.close()
+        return conn
+
+    @contextmanager
+    def get_db(self):
+        """
+        Returns a context manager that produces this process' database
+        connection, and calls rollback if an error occurs while using it.
+        The connection is opened on first use and shared by the green
+        threads of the process, one at a time.
+        """
+        with self.conn_lock:
+            if self.conn is None or self.conn_pid != os.getpid():
+                # A connection must not be used across a fork
+                self.conn = self._connect()
+                self.conn_pid = os.getpid()
+            conn = self.conn
+            try:
+                yield conn
+            except sqlite3.DatabaseError, e:
+                msg = _("Error executing SQLite call. Got error: %s") % e
+                LOG.error(msg)
+                conn.rollback()
+            except Exception:
+                conn.rollback()
+                raise
 
     def queue_image(self, image_id):
         """
@@ -467,6 +618,16 @@ class Driver(base.Driver):
                 yield path
 
 
+def _flush_hits_at_exit(driver_ref):
+    """Writes the hits a driver has yet to flush when the process exits"""
+    driver = driver_ref()
+    if driver is not None and driver.pending_hits:
+        try:
+            driver.flush_hits()
+        except Exception:
+            LOG.exception(_("Failed to write cache hits to the database"))
+
+
 def delete_cached_file(path):
     if os.path.exists(path):
         LOG.debug(_("Deleting image cache file '%s'"), path)
@@ -57,6 +57,7 @@ from __future__ import absolute_import
 from contextlib import contextmanager
 import datetime
 import errno
+import heapq
 import os
 import stat
 import time
@@ -117,15 +118,14 @@ class Driver(base.Driver):
             if os.path.exists(fake_image_filepath):
                 os.unlink(fake_image_filepath)
 
+        self.index = CacheIndex(self.base_dir)
+
     def get_cache_size(self):
         """
         Returns the total size in bytes of the image cache.
         """
-        sizes = []
-        for path in get_all_regular_files(self.base_dir):
-            file_info = os.stat(path)
-            sizes.append(file_info[stat.ST_SIZE])
-        return sum(sizes)
+        self.index.refresh()
+        return self.index.size
 
     def get_hit_count(self, image_id):
         """
@@ -205,9 +205,11 @@ class Driver(base.Driver):
         Removes all cached image files and any attributes about the images
         """
         deleted = 0
-        for path in get_all_regular_files(self.base_dir):
-            delete_cached_file(path)
-            deleted += 1
+        with self.index.changing():
+            for path in get_all_regular_files(self.base_dir):
+                delete_cached_file(path)
+                self.index.remove(os.path.basename(path))
+                deleted += 1
         return deleted
 
     def delete_cached_image(self, image_id):
@@ -217,7 +219,21 @@ class Driver(base.Driver):
         :param image_id: Image ID
         """
         path = self.get_image_filepath(image_id)
-        delete_cached_file(path)
+        with self.index.changing():
+            delete_cached_file(path)
+            self.index.remove(image_id)
+
+    def delete_cached_images(self, image_ids):
+        """
+        Removes the cached image files and any attributes about the images
+        with the supplied identifiers.
+
+        :param image_ids: List of image IDs
+        """
+        with self.index.changing():
+            for image_id in image_ids:
+                delete_cached_file(self.get_image_filepath(image_id))
+                self.index.remove(image_id)
 
     def delete_all_queued_images(self):
         """
@@ -243,18 +259,20 @@ class Driver(base.Driver):
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
-        stats = []
-        for path in get_all_regular_files(self.base_dir):
-            file_info = os.stat(path)
-            stats.append((file_info[stat.ST_ATIME],  # access time
-                          file_info[stat.ST_SIZE],   # size in bytes
-                          path))                     # absolute path
+        self.index.refresh()
+        entries = self.index.get_least_recently_accessed(1, count=1)
+        return entries[0] if entries else None
 
-        if not stats:
-            return None
+    def get_least_recently_accessed_images(self, size):
+        """
+        Return a list of (image_id, size) tuples for the least recently
+        accessed cached files, oldest first, stopping as soon as their
+        sizes add up to at least the supplied size.
 
-        stats.sort()
-        return os.path.basename(stats[0][2]), stats[0][1]
+        :param size: Number of bytes the returned files should cover
+        """
+        self.index.refresh()
+        return self.index.get_least_recently_accessed(size)
 
     @contextmanager
     def open_for_write(self, image_id):
@@ -277,7 +295,11 @@ class Driver(base.Driver):
                         "'%(incomplete_path)s' to '%(final_path)s'"),
                       dict(incomplete_path=incomplete_path,
                            final_path=final_path))
-            os.rename(incomplete_path, final_path)
+            with self.index.changing():
+                os.rename(incomplete_path, final_path)
+                file_info = os.stat(final_path)
+                self.index.add(image_id, file_info.st_atime,
+                               file_info.st_size)
 
             # Make sure that we "pop" the image from the queue...
             if self.is_queued(image_id):
@@ -324,6 +346,7 @@ class Driver(base.Driver):
             yield cache_file
         path = self.get_image_filepath(image_id)
         inc_xattr(path, 'hits', 1)
+        self.index.touch(image_id, time.time())
 
     def queue_image(self, image_id):
         """
@@ -426,6 +449,130 @@ class Driver(base.Driver):
         self.reap_stalled(stall_time)
 
 
+class CacheIndex(object):
+    """
+    In-memory index of the cached image files by last access time, so
+    that the cache size and the least recently accessed images can be
+    found without scanning the cache directory.
+
+    The index is built from a scan of the directory on first use, then
+    kept up to date as this process adds, reads and deletes images. If
+    the directory's mtime shows that another process has added or
+    removed images since, the index is rebuilt on the next refresh().
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.entries = {}  # image ID -> (access time, size)
+        self.heap = []  # (access time, image ID), may hold stale items
+        self.size = 0
+        self.dir_mtime = None
+        # Names in the directory that are not image files, such as the
+        # incomplete and queue subdirectories
+        self.other_names = set()
+
+    def refresh(self):
+        """Rebuilds the index if the cache directory has changed"""
+        dir_mtime = os.stat(self.base_dir).st_mtime
+        if dir_mtime == self.dir_mtime:
+            return
+        self.entries = {}
+        self.size = 0
+        for path in get_all_regular_files(self.base_dir):
+            file_info = os.stat(path)
+            self.entries[os.path.basename(path)] = (file_info.st_atime,
+                                                    file_info.st_size)
+            self.size += file_info.st_size
+        self.other_names = set(os.listdir(self.base_dir)) - set(self.entries)
+        self.heap = [(atime, image_id)
+                     for image_id, (atime, size) in self.entries.iteritems()]
+        heapq.heapify(self.heap)
+        self.dir_mtime = dir_mtime
+
+    @contextmanager
+    def changing(self):
+        """
+        Wraps changes this process makes to the cache directory, so that
+        they are not mistaken for changes made by another process. The
+        new mtime is only taken as ours if the directory then holds just
+        the images the index expects. Otherwise another process changed
+        it at the same time, and the index is rebuilt on next refresh().
+        """
+        in_sync = (self.dir_mtime is not None and
+                   os.stat(self.base_dir).st_mtime == self.dir_mtime)
+        try:
+            yield
+        finally:
+            self.dir_mtime = None
+            if in_sync:
+                # The mtime is read before the listing, so that a change
+                # made after the listing moves the mtime past it
+                dir_mtime = os.stat(self.base_dir).st_mtime
+                names = set(os.listdir(self.base_dir)) - self.other_names
+                if names == set(self.entries):
+                    self.dir_mtime = dir_mtime
+
+    # NOTE: image IDs are keyed by their file names, as found by a scan
+
+    def add(self, image_id, atime, size):
+        image_id = str(image_id)
+        self.remove(image_id)
+        self.entries[image_id] = (atime, size)
+        self.size += size
+        heapq.heappush(self.heap, (atime, image_id))
+
+    def touch(self, image_id, atime):
+        image_id = str(image_id)
+        if image_id not in self.entries:
+            return
+        old_atime, size = self.entries[image_id]
+        if atime != old_atime:
+            self.entries[image_id] = (atime, size)
+            heapq.heappush(self.heap, (atime, image_id))
+            self._compact()
+
+    def remove(self, image_id):
+        # The image's item stays in the heap until it is popped
+        entry = self.entries.pop(str(image_id), None)
+        if entry is not None:
+            self.size -= entry[1]
+            self._compact()
+
+    def _compact(self):
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(atime, image_id)
+                         for image_id, (atime, size)
+                         in self.entries.iteritems()]
+            heapq.heapify(self.heap)
+
+    def get_least_recently_accessed(self, size, count=None):
+        """
+        Return a list of (image_id, size) tuples for the least recently
+        accessed images, oldest first, stopping as soon as their sizes
+        add up to at least the supplied size or count images are found.
+        """
+        found = []
+        found_ids = set()
+        entries = []
+        total = 0
+        while self.heap and total < size and count != len(entries):
+            item = heapq.heappop(self.heap)
+            atime, image_id = item
+            entry = self.entries.get(image_id)
+            if (entry is None or entry[0] != atime or
+                    image_id in found_ids):
+                # The image has been accessed since or removed, or this
+                # is a duplicate item
+                continue
+            found.append(item)
+            found_ids.add(image_id)
+            entries.append((image_id, entry[1]))
+            total += entry[1]
+        for item in found:
+            heapq.heappush(self.heap, item)
+        return entries
+
+
 def get_all_regular_files(basepath):
     for fname in os.listdir(basepath):
         path = os.path.join(basepath, fname)
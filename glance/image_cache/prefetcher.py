@@ -56,7 +56,7 @@ class Prefetcher(base.CacheApp):
         location = image_meta['location']
         image_data, image_size = glance.store.get_from_backend(ctx, location)
         LOG.debug(_("Caching image '%s'"), image_id)
-        self.cache.cache_image_iter(image_id, image_data)
+        self.cache.cache_image_iter(image_id, image_data, image_size)
         return True
 
     def run(self):
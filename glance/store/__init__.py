@@ -141,6 +141,12 @@ def create_stores():
     """
     Registers all store modules and all schemes
     from the given config. Duplicates are not re-registered.
+
+    Each store is instantiated (and therefore configured) exactly once
+    here; that instance is shared by every request handled by this
+    process, so stores must not keep per-request state on themselves.
+    Request-specific information is passed to each store method through
+    its ``context`` argument instead.
     """
     store_count = 0
     store_classes = set()
@@ -166,6 +172,7 @@ def create_stores():
                     scheme_map[scheme] = {
                         'store_class': store_cls,
                         'location_class': loc_cls,
+                        'store': store_instance,
                     }
                 location.register_scheme_map(scheme_map)
                 store_count += 1
@@ -188,12 +195,15 @@ def get_store_from_scheme(context, scheme, loc=None):
     """
     Given a scheme, return the appropriate store object
     for handling that scheme.
+
+    The returned store is the process-wide instance built by
+    create_stores(), so the context is not bound to it; callers
+    must hand the context to each store method they invoke.
     """
     if scheme not in location.SCHEME_TO_CLS_MAP:
         raise exception.UnknownScheme(scheme=scheme)
     scheme_info = location.SCHEME_TO_CLS_MAP[scheme]
-    store = scheme_info['store_class'](context, loc)
-    return store
+    return scheme_info['store']
 
 
 def get_store_from_uri(context, uri, loc=None):
@@ -208,31 +218,43 @@ def get_store_from_uri(context, uri, loc=None):
     return store
 
 
-def get_from_backend(context, uri, **kwargs):
-    """Yields chunks of data from backend specified by uri"""
+def get_store_and_location(context, uri):
+    """
+    Given a URI, return a tuple of the store object that handles it and
+    the parsed `glance.store.location.Location`.
 
+    :param uri: URI to analyze
+    """
     loc = location.get_location_from_uri(uri)
-    store = get_store_from_uri(context, uri, loc)
+    store = get_store_from_scheme(context, loc.store_name, loc)
+    return store, loc
+
 
-    return store.get(loc)
+def get_from_backend(context, uri, offset=0, length=None, **kwargs):
+    """
+    Yields chunks of data from backend specified by uri, optionally just
+    length bytes from offset
+    """
+
+    store, loc = get_store_and_location(context, uri)
+
+    return store.get(loc, context=context, offset=offset, length=length)
 
 
 def get_size_from_backend(context, uri):
     """Retrieves image size from backend specified by uri"""
 
-    loc = location.get_location_from_uri(uri)
-    store = get_store_from_uri(context, uri, loc)
+    store, loc = get_store_and_location(context, uri)
 
-    return store.get_size(loc)
+    return store.get_size(loc, context=context)
 
 
 def delete_from_backend(context, uri, **kwargs):
     """Removes chunks of data from backend specified by uri"""
-    loc = location.get_location_from_uri(uri)
-    store = get_store_from_uri(context, uri, loc)
+    store, loc = get_store_and_location(context, uri)
 
     try:
-        return store.delete(loc)
+        return store.delete(loc, context=context)
     except NotImplementedError:
         raise exception.StoreDeleteNotSupported
 
@@ -285,17 +307,15 @@ def schedule_delayed_delete_from_backend(uri, image_id, **kwargs):
 
 def add_to_backend(context, scheme, image_id, data, size):
     store = get_store_from_scheme(context, scheme)
-    return store.add(image_id, data, size)
+    return store.add(image_id, data, size, context=context)
 
 
 def set_acls(context, location_uri, public=False, read_tenants=[],
              write_tenants=[]):
-    loc = location.get_location_from_uri(location_uri)
-    scheme = get_store_from_location(location_uri)
-    store = get_store_from_scheme(context, scheme, loc)
+    store, loc = get_store_and_location(context, location_uri)
     try:
         store.set_acls(loc, public=public, read_tenants=read_tenants,
-                       write_tenants=write_tenants)
+                       write_tenants=write_tenants, context=context)
     except NotImplementedError:
         LOG.debug(_("Skipping store.set_acls... not implemented."))
 
@@ -19,6 +19,7 @@
 """Base class for all storage backends"""
 
 from glance.common import exception
+from glance.common import utils
 from glance.openstack.common import importutils
 import glance.openstack.common.log as logging
 
@@ -44,6 +45,15 @@ class Store(object):
                     "Disabling add method." % e)
             LOG.warn(msg)
             self.add = self.add_disabled
+            self.add_from_location = self.add_disabled
+
+    @property
+    def stream_chunk_size(self):
+        """
+        Size of the chunks the store moves image data in: CHUNKSIZE,
+        unless overridden by the image_chunk_size option.
+        """
+        return utils.get_chunk_size(self.CHUNKSIZE)
 
     def configure(self):
         """
@@ -79,7 +89,7 @@ class Store(object):
         """
         pass
 
-    def get(self, location):
+    def get(self, location, context=None, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -87,17 +97,23 @@ class Store(object):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param context: The request context, if any
+        :param offset: Index of the first byte of the image to return
+        :param length: Number of bytes to return, or None to read to the
+                       end of the image. When offset or length is given,
+                       image_size is the size of the returned part.
         :raises `glance.exception.NotFound` if image does not exist
         """
         raise NotImplementedError
 
-    def get_size(self, location):
+    def get_size(self, location, context=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns the size
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param context: The request context, if any
         :raises `glance.exception.NotFound` if image does not exist
         """
         raise NotImplementedError
@@ -110,7 +126,7 @@ class Store(object):
         """
         raise exception.StoreAddDisabled
 
-    def add(self, image_id, image_file, image_size):
+    def add(self, image_id, image_file, image_size, context=None):
         """
         Stores an image file with supplied identifier to the backend
         storage system and returns a tuple containing information
@@ -119,6 +135,7 @@ class Store(object):
         :param image_id: The opaque image identifier
         :param image_file: The image data to write, as a file-like object
         :param image_size: The size of the image data to write, in bytes
+        :param context: The request context, if any
 
         :retval tuple of URL in backing store, bytes written, and checksum
         :raises `glance.common.exception.Duplicate` if the image already
@@ -126,19 +143,42 @@ class Store(object):
         """
         raise NotImplementedError
 
-    def delete(self, location):
+    def add_from_location(self, image_id, source, image_size, context=None):
+        """
+        Stores a copy of the image at another location with the supplied
+        identifier, without the image data passing through Glance. Stores
+        that can copy some locations inside the backend, such as by
+        cloning, override this.
+
+        :param image_id: The opaque image identifier
+        :param source: `glance.store.location.Location` object of the
+                       image to copy
+        :param image_size: The size of the image data to copy, in bytes
+        :param context: The request context, if any
+
+        :retval tuple of URL in backing store, bytes written, and checksum,
+                or None if the copy has to be done by streaming the data
+                through `add`. The checksum may be None when the data was
+                not read while copying it.
+        :raises `glance.common.exception.Duplicate` if the image already
+                existed
+        """
+        return None
+
+    def delete(self, location, context=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file to delete
 
         :location `glance.store.location.Location` object, supplied
                   from glance.store.location.get_location_from_uri()
+        :context The request context, if any
         :raises `glance.exception.NotFound` if image does not exist
         """
         raise NotImplementedError
 
     def set_acls(self, location, public=False, read_tenants=[],
-                 write_tenants=[]):
+                 write_tenants=[], context=None):
         """
         Sets the read and write access control list for an image in the
         backend store.
@@ -150,5 +190,6 @@ class Store(object):
                       read access for an image.
         :write_tenants A list of tenant strings which should be granted
                       write access for an image.
+        :context The request context, if any
         """
         raise NotImplementedError
@@ -19,7 +19,11 @@
 A simple filesystem-backed store
 """
 
+import ctypes
+import ctypes.util
 import errno
+import fcntl
+import functools
 import hashlib
 import os
 import urlparse
@@ -34,10 +38,62 @@ import glance.store.location
 
 LOG = logging.getLogger(__name__)
 
-datadir_opt = cfg.StrOpt('filesystem_store_datadir')
+DEFAULT_WRITE_BUFFER_SIZE = 1024  # in KiB
+FSYNC_POLICIES = ('none', 'file', 'full')
+# Ask the filesystem for the blocks without changing the file size, so a
+# short upload does not leave zeros at the end of the image
+FALLOC_FL_KEEP_SIZE = 0x01
+# Directory inside each data directory holding one hard link per distinct
+# image payload, named by its SHA-256 digest, when deduplication is on
+BLOB_DIR = '.blobs'
+
+filesystem_opts = [
+    cfg.StrOpt('filesystem_store_datadir'),
+    cfg.MultiStrOpt('filesystem_store_datadirs', default=[]),
+    cfg.BoolOpt('filesystem_store_preallocate', default=True),
+    cfg.IntOpt('filesystem_store_write_buffer_size',
+               default=DEFAULT_WRITE_BUFFER_SIZE),
+    cfg.StrOpt('filesystem_store_fsync', default='none'),
+    cfg.BoolOpt('filesystem_store_dedup', default=False),
+]
 
 CONF = cfg.CONF
-CONF.register_opt(datadir_opt)
+CONF.register_opts(filesystem_opts)
+
+_libc = None
+
+
+def _get_free_space(path):
+    """Returns the bytes available to Glance on the filesystem of path"""
+    try:
+        stat = os.statvfs(path)
+    except OSError:
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+def _fallocate(fd, size):
+    """
+    Reserves size bytes of disk space for the file open as fd, so the
+    image is laid out contiguously rather than fragmented among other
+    uploads. This is only an optimisation and quietly does nothing where
+    fallocate() is not available.
+    """
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+            _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                        ctypes.c_longlong, ctypes.c_longlong]
+        except (OSError, AttributeError):
+            _libc = False
+    if not _libc:
+        return
+    if _libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        err = ctypes.get_errno()
+        LOG.debug(_("Unable to preallocate %(size)d bytes: %(err)s") %
+                  {'size': size, 'err': os.strerror(err)})
 
 
 class StoreLocation(glance.store.location.StoreLocation):
@@ -72,20 +128,26 @@ class ChunkedFile(object):
 
     """
     We send this back to the Glance API server as
-    something that can iterate over a large file
+    something that can iterate over a large file. It also behaves like
+    the open file itself, so it can be handed to ``wsgi.file_wrapper``.
+    Reading can be limited to length bytes from offset.
     """
 
     CHUNKSIZE = 65536
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, offset=0, length=None):
         self.filepath = filepath
         self.fp = open(self.filepath, 'rb')
+        if offset:
+            self.fp.seek(offset)
+        self.remaining = length
 
     def __iter__(self):
         """Return an iterator over the image file"""
         try:
             while True:
-                chunk = self.fp.read(ChunkedFile.CHUNKSIZE)
+                chunk = self.read(
+                        utils.get_chunk_size(ChunkedFile.CHUNKSIZE))
                 if chunk:
                     yield chunk
                 else:
@@ -93,6 +155,18 @@ class ChunkedFile(object):
         finally:
             self.close()
 
+    def read(self, size=-1):
+        if self.remaining is None:
+            return self.fp.read(size)
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.fp.fileno()
+
     def close(self):
         """Close the internal file pointer"""
         if self.fp:
@@ -112,31 +186,112 @@ class Store(glance.store.base.Store):
         this method. If the store was not able to successfully configure
         itself, it should raise `exception.BadStoreConfiguration`
         """
-        self.datadir = CONF.filesystem_store_datadir
-        if self.datadir is None:
+        self.datadirs = self._get_datadirs()
+        self.datadir = self.datadirs[0][0]
+        self.active_writes = dict((path, 0) for path, weight in self.datadirs)
+
+        self.preallocate = CONF.filesystem_store_preallocate
+        # Keep the buffer a whole number of pages so writes stay aligned
+        buffer_kb = max(4, CONF.filesystem_store_write_buffer_size)
+        self.write_buffer_size = (buffer_kb + 3) // 4 * 4 * 1024
+        self.fsync = CONF.filesystem_store_fsync.lower()
+        if self.fsync not in FSYNC_POLICIES:
+            reason = (_("filesystem_store_fsync must be one of %s") %
+                      ', '.join(FSYNC_POLICIES))
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="filesystem",
+                                                  reason=reason)
+        self.dedup = CONF.filesystem_store_dedup
+
+        for path, weight in self.datadirs:
+            self._create_datadir(path)
+
+    @staticmethod
+    def _get_datadirs():
+        """
+        Returns a list of (directory, weight) tuples for the directories
+        image files are written to, from either filesystem_store_datadir
+        or filesystem_store_datadirs.
+        """
+        datadir = CONF.filesystem_store_datadir
+        datadirs = CONF.filesystem_store_datadirs
+        if datadir and datadirs:
+            reason = _("Specify either filesystem_store_datadir or "
+                       "filesystem_store_datadirs, not both")
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="filesystem",
+                                                  reason=reason)
+        if datadir:
+            return [(datadir, 1)]
+        if not datadirs:
             reason = (_("Could not find %s in configuration options.") %
                       'filesystem_store_datadir')
             LOG.error(reason)
             raise exception.BadStoreConfiguration(store_name="filesystem",
                                                   reason=reason)
 
-        if not os.path.exists(self.datadir):
+        result = []
+        for entry in datadirs:
+            path, sep, weight = entry.strip().rpartition(':')
+            if not sep or not weight.isdigit():
+                path, weight = entry.strip(), '1'
+            if not path or int(weight) < 1:
+                reason = (_("Invalid filesystem_store_datadirs entry: %s")
+                          % entry)
+                LOG.error(reason)
+                raise exception.BadStoreConfiguration(
+                    store_name="filesystem", reason=reason)
+            result.append((path, int(weight)))
+        return result
+
+    @staticmethod
+    def _create_datadir(datadir):
+        if not os.path.exists(datadir):
             msg = _("Directory to write image files does not exist "
-                    "(%s). Creating.") % self.datadir
+                    "(%s). Creating.") % datadir
             LOG.info(msg)
             try:
-                os.makedirs(self.datadir)
+                os.makedirs(datadir)
             except (IOError, OSError):
-                if os.path.exists(self.datadir):
+                if os.path.exists(datadir):
                     # NOTE(markwash): If the path now exists, some other
                     # process must have beat us in the race condition. But it
                     # doesn't hurt, so we can safely ignore the error.
                     return
-                reason = _("Unable to create datadir: %s") % self.datadir
+                reason = _("Unable to create datadir: %s") % datadir
                 LOG.error(reason)
                 raise exception.BadStoreConfiguration(store_name="filesystem",
                                                       reason=reason)
 
+    def _select_datadir(self, image_size):
+        """
+        Picks the data directory to write a new image to. Directories are
+        scored by their weight times their free space, divided among the
+        uploads already being written to them, and the highest score
+        wins. Directories without room for an image of known size are
+        passed over.
+
+        :raises `glance.common.exception.StorageFull` if no directory has
+                room for the image
+        """
+        if len(self.datadirs) == 1:
+            return self.datadir
+
+        best_path, best_score = None, None
+        for path, weight in self.datadirs:
+            free = _get_free_space(path)
+            if image_size and free < image_size:
+                continue
+            score = weight * free / (self.active_writes[path] + 1)
+            if best_score is None or score > best_score:
+                best_path, best_score = path, score
+
+        if best_path is None:
+            LOG.error(_("No data directory has room for an image of "
+                        "%d bytes") % image_size)
+            raise exception.StorageFull()
+        return best_path
+
     @staticmethod
     def _resolve_location(location):
         filepath = location.store_location.path
@@ -147,7 +302,7 @@ class Store(glance.store.base.Store):
         filesize = os.path.getsize(filepath)
         return filepath, filesize
 
-    def get(self, location):
+    def get(self, location, context=None, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -155,14 +310,21 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Index of the first byte of the image to return
+        :param length: Number of bytes to return, or None for the rest
         :raises `glance.exception.NotFound` if image does not exist
         """
         filepath, filesize = self._resolve_location(location)
         msg = _("Found image at %s. Returning in ChunkedFile.") % filepath
         LOG.debug(msg)
+        if offset or length is not None:
+            end = filesize if length is None else min(offset + length,
+                                                      filesize)
+            size = max(end - offset, 0)
+            return (ChunkedFile(filepath, offset, size), size)
         return (ChunkedFile(filepath), filesize)
 
-    def get_size(self, location):
+    def get_size(self, location, context=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file and returns the image size
@@ -177,7 +339,7 @@ class Store(glance.store.base.Store):
         LOG.debug(msg)
         return filesize
 
-    def delete(self, location):
+    def delete(self, location, context=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file to delete
@@ -194,12 +356,108 @@ class Store(glance.store.base.Store):
             try:
                 LOG.debug(_("Deleting image at %(fn)s") % locals())
                 os.unlink(fn)
+                self._release_blob(fn)
             except OSError:
                 raise exception.Forbidden(_("You cannot delete file %s") % fn)
         else:
             raise exception.NotFound(_("Image file %s does not exist") % fn)
 
-    def add(self, image_id, image_file, image_size):
+    @staticmethod
+    def _blob_ref(filepath):
+        """
+        Returns the path of the symlink recording which blob the image
+        file at filepath shares its data with.
+        """
+        datadir, name = os.path.split(filepath)
+        return os.path.join(datadir, BLOB_DIR, '%s.ref' % name)
+
+    def _publish_blob(self, datadir, tmp_filepath, filepath, digest):
+        """
+        Moves a completely written image file into place, deduplicating
+        it against the images already in datadir.
+
+        If a blob with the same SHA-256 digest exists, the image becomes
+        another hard link to it and the newly written data is discarded;
+        otherwise the image file is registered as the blob for digest.
+        The filesystem's link count serves as the reference count.
+        """
+        blobdir = os.path.join(datadir, BLOB_DIR)
+        utils.safe_mkdirs(blobdir)
+        blob = os.path.join(blobdir, digest)
+        # NOTE: The reference is recorded before the image is moved into
+        # place, replacing any left behind by an image file that is gone
+        ref = self._blob_ref(filepath)
+        try:
+            os.unlink(ref)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        os.symlink(digest, ref)
+        try:
+            os.link(blob, filepath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            os.rename(tmp_filepath, filepath)
+            try:
+                os.link(filepath, blob)
+            except OSError as e:
+                # Another upload of the same data registered it first
+                if e.errno != errno.EEXIST:
+                    raise
+        else:
+            LOG.debug(_("Image %(filepath)s shares its data with blob "
+                        "%(digest)s") % locals())
+            os.unlink(tmp_filepath)
+
+    def _release_blob(self, filepath):
+        """
+        Drops the blob reference of a deleted image file, removing the
+        blob itself once no image links to it any more.
+        """
+        ref = self._blob_ref(filepath)
+        if not os.path.islink(ref):
+            return
+        blob = os.path.join(os.path.dirname(ref), os.readlink(ref))
+        os.unlink(ref)
+        try:
+            if os.stat(blob).st_nlink == 1:
+                LOG.debug(_("Removing unreferenced blob %s") % blob)
+                os.unlink(blob)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _lock_partial(fd, tmp_filepath):
+        """
+        Takes an exclusive lock on the partial image file open as fd, and
+        empties it. The lock goes away with the process holding it, so a
+        partial file left behind by a writer that died is simply reused.
+
+        :retval False if another writer is still writing the file
+        """
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        # NOTE: The writer that held the lock may have renamed the file
+        # into place between our open() and flock(), in which case it is
+        # a complete image now and must be left alone
+        try:
+            current = os.stat(tmp_filepath)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        opened = os.fstat(fd)
+        if (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+            return False
+        os.ftruncate(fd, 0)
+        return True
+
+    def add(self, image_id, image_file, image_size, context=None):
         """
         Stores an image file with supplied identifier to the backend
         storage system and returns a tuple containing information
@@ -215,37 +473,89 @@ class Store(glance.store.base.Store):
 
         :note By default, the backend writes the image data to a file
               `/<DATADIR>/<ID>`, where <DATADIR> is the value of
-              the filesystem_store_datadir configuration option and <ID>
-              is the supplied image ID.
+              the filesystem_store_datadir configuration option, or the
+              one of the filesystem_store_datadirs picked for the image,
+              and <ID> is the supplied image ID. The data is written to a
+              hidden temporary file next to it first, which is only
+              renamed to that name once the whole image has been written.
+              With filesystem_store_dedup enabled, an image whose data is
+              already stored in the same data directory is made a hard
+              link to the existing file instead.
         """
 
-        filepath = os.path.join(self.datadir, str(image_id))
+        for path, weight in self.datadirs:
+            filepath = os.path.join(path, str(image_id))
+            if os.path.exists(filepath):
+                raise exception.Duplicate(_("Image file %s already exists!")
+                                          % filepath)
 
-        if os.path.exists(filepath):
-            raise exception.Duplicate(_("Image file %s already exists!")
-                                      % filepath)
+        datadir = self._select_datadir(image_size)
+        filepath = os.path.join(datadir, str(image_id))
+        tmp_filepath = os.path.join(datadir, '.%s.partial' % image_id)
 
-        checksum = hashlib.md5()
+        checksum = utils.ThreadedHasher(hashlib.md5())
+        digest = None
+        if self.dedup:
+            digest = utils.ThreadedHasher(hashlib.sha256())
         bytes_written = 0
+        self.active_writes[datadir] += 1
         try:
-            with open(filepath, 'wb') as f:
-                for buf in utils.chunkreadable(image_file,
-                                               ChunkedFile.CHUNKSIZE):
-                    bytes_written += len(buf)
-                    checksum.update(buf)
-                    f.write(buf)
-        except IOError as e:
-            if e.errno in [errno.EFBIG, errno.ENOSPC]:
+            fd = os.open(tmp_filepath, os.O_WRONLY | os.O_CREAT, 0644)
+            try:
+                locked = self._lock_partial(fd, tmp_filepath)
+            except Exception:
+                os.close(fd)
+                raise
+            if not locked:
+                os.close(fd)
+                raise exception.Duplicate(_("Image file %s is already "
+                                            "being written!") % filepath)
+
+            try:
+                hashers = [checksum, digest] if digest else [checksum]
+                with os.fdopen(fd, 'wb', self.write_buffer_size) as f:
+                    if self.preallocate and image_size:
+                        _fallocate(fd, image_size)
+                    data = utils.pipeline(
+                        image_file,
+                        functools.partial(utils.hashing_iter,
+                                          hashers=hashers),
+                        functools.partial(utils.tee_iter, write=f.write))
+                    for buf in data:
+                        bytes_written += len(buf)
+                    f.flush()
+                    if self.fsync != 'none':
+                        os.fsync(f.fileno())
+                if digest:
+                    self._publish_blob(datadir, tmp_filepath, filepath,
+                                       digest.hexdigest())
+                else:
+                    os.rename(tmp_filepath, filepath)
+            except Exception:
                 try:
-                    os.unlink(filepath)
+                    if os.path.exists(tmp_filepath):
+                        os.unlink(tmp_filepath)
                 except Exception:
                     msg = _('Unable to remove partial image data for image %s')
                     LOG.error(msg % image_id)
+                raise
+
+            if self.fsync == 'full':
+                # Make the rename itself durable
+                dir_fd = os.open(datadir, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+        except (IOError, OSError) as e:
+            if e.errno in [errno.EFBIG, errno.ENOSPC]:
                 raise exception.StorageFull()
             elif e.errno == errno.EACCES:
                 raise exception.StorageWriteDenied()
             else:
                 raise
+        finally:
+            self.active_writes[datadir] -= 1
 
         checksum_hex = checksum.hexdigest()
 
@@ -15,10 +15,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import httplib
+import socket
+import time
 import urlparse
 
+import eventlet
+
 from glance.common import exception
+from glance.common import utils
+from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
 import glance.store.base
 import glance.store.location
@@ -27,6 +34,29 @@ LOG = logging.getLogger(__name__)
 
 
 MAX_REDIRECTS = 5
+DEFAULT_MAX_IDLE_CONNECTIONS = 4
+DEFAULT_REDIRECT_CACHE_TTL = 60  # in seconds
+REDIRECT_CACHE_SIZE = 128
+DEFAULT_RANGE_FETCH_CONCURRENCY = 1
+DEFAULT_RANGE_FETCH_CHUNK_SIZE = 8  # in MiB
+ONE_MB = 1024 * 1024
+# Most bytes read from a response body we do not use, such as a redirect,
+# to be able to reuse its connection
+MAX_DRAIN_SIZE = 65536
+
+http_opts = [
+    cfg.IntOpt('http_store_max_idle_connections',
+               default=DEFAULT_MAX_IDLE_CONNECTIONS),
+    cfg.IntOpt('http_store_redirect_cache_ttl',
+               default=DEFAULT_REDIRECT_CACHE_TTL),
+    cfg.IntOpt('http_store_range_fetch_concurrency',
+               default=DEFAULT_RANGE_FETCH_CONCURRENCY),
+    cfg.IntOpt('http_store_range_fetch_chunk_size',
+               default=DEFAULT_RANGE_FETCH_CHUNK_SIZE),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(http_opts)
 
 
 class StoreLocation(glance.store.location.StoreLocation):
@@ -93,26 +123,70 @@ class StoreLocation(glance.store.location.StoreLocation):
         self.path = path
 
 
-def http_response_iterator(conn, response, size):
+def http_response_iterator(conn, response, size, release=None):
     """
     Return an iterator for a file-like object.
 
     :param conn: HTTP(S) Connection
     :param response: httplib.HTTPResponse object
     :param size: Chunk size to iterate with
+    :param release: Called instead of closing the connection once the
+                    response has been read completely
     """
     chunk = response.read(size)
     while chunk:
         yield chunk
         chunk = response.read(size)
-    conn.close()
+    if release:
+        release()
+    else:
+        conn.close()
+
+
+class ConnectionPool(object):
+
+    """
+    Keeps idle keep-alive connections, up to max_idle per host, so that
+    consecutive requests to the same server do not each pay for setting
+    up a new TCP and TLS session.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self.idle = collections.defaultdict(collections.deque)
+
+    def get(self, key):
+        """Returns an idle connection for key, or None if there is none"""
+        conns = self.idle.get(key)
+        if conns:
+            return conns.pop()
+        return None
+
+    def put(self, key, conn):
+        """Makes conn available for the next request for key"""
+        conns = self.idle[key]
+        if len(conns) < self.max_idle:
+            conns.append(conn)
+        else:
+            conn.close()
 
 
 class Store(glance.store.base.Store):
 
     """An implementation of the HTTP(S) Backend Adapter"""
 
-    def get(self, location):
+    def configure(self):
+        """
+        Configure the Store to use the stored configuration options
+        """
+        self.pool = ConnectionPool(CONF.http_store_max_idle_connections)
+        self.redirect_ttl = CONF.http_store_redirect_cache_ttl
+        self.redirects = utils.LRUCache(REDIRECT_CACHE_SIZE)
+        self.range_concurrency = CONF.http_store_range_fetch_concurrency
+        self.range_chunk_size = (CONF.http_store_range_fetch_chunk_size *
+                                 ONE_MB)
+
+    def get(self, location, context=None, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -120,10 +194,37 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Index of the first byte of the image to return
+        :param length: Number of bytes to return, or None for the rest
         """
-        conn, resp, content_length = self._query(location, 'GET')
+        headers = {}
+        ranged = offset or length is not None
+        if ranged:
+            last = '' if length is None else str(offset + length - 1)
+            headers['Range'] = 'bytes=%d-%s' % (offset, last)
+        conn, resp, content_length, loc = self._query(location, 'GET',
+                                                      headers)
 
-        iterator = http_response_iterator(conn, resp, self.CHUNKSIZE)
+        def release():
+            self._release(loc, conn, resp)
+
+        accept_ranges = resp.getheader('accept-ranges') or ''
+        validator = self._get_range_validator(resp)
+        if (not ranged and self.range_concurrency > 1 and
+                content_length > self.range_chunk_size and
+                accept_ranges.lower() == 'bytes' and validator):
+            iterator = self._ranged_iterator(loc, conn, resp, content_length,
+                                             validator)
+        else:
+            iterator = http_response_iterator(conn, resp,
+                                              self.stream_chunk_size,
+                                              release)
+        if ranged and resp.status != 206:
+            # The server ignored the range and sends the whole image
+            iterator = utils.slice_iter(iterator, offset, length)
+            end = (content_length if length is None
+                   else min(offset + length, content_length))
+            content_length = max(end - offset, 0)
 
         class ResponseIndexable(glance.store.Indexable):
             def another(self):
@@ -137,7 +238,7 @@ class Store(glance.store.base.Store):
     def get_schemes(self):
         return ('http', 'https')
 
-    def get_size(self, location):
+    def get_size(self, location, context=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns the size
@@ -146,39 +247,217 @@ class Store(glance.store.base.Store):
                         from glance.store.location.get_location_from_uri()
         """
         try:
-            return self._query(location, 'HEAD')[2]
+            conn, resp, content_length, loc = self._query(location, 'HEAD')
+            self._drain(loc, conn, resp)
+            return content_length
         except Exception:
             return 0
 
-    def _query(self, location, verb, depth=0):
+    @staticmethod
+    def _get_range_validator(resp):
+        """
+        Returns the validator to send as If-Range with the ranges of the
+        image in resp, so that the server refuses them if the image
+        changes under us, or None if there is none that can be used.
+        Weak ETags may not be used in If-Range.
+        """
+        etag = resp.getheader('etag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return resp.getheader('last-modified')
+
+    def _ranged_iterator(self, loc, conn, resp, size, validator):
+        """
+        Returns an iterator over the image at loc which reads the first
+        range_chunk_size bytes from the response already received, and
+        meanwhile fetches the rest of the image as byte ranges of that
+        size over up to range_concurrency connections. The ranges are
+        yielded in order, and only as many of them as are being fetched
+        at once are held in memory.
+        """
+        chunk_size = self.range_chunk_size
+        ranges = collections.deque((start, min(start + chunk_size, size))
+                                   for start in xrange(chunk_size, size,
+                                                       chunk_size))
+        pending = collections.deque()
+
+        def fetch_more():
+            while ranges and len(pending) < self.range_concurrency - 1:
+                start, end = ranges.popleft()
+                pending.append(eventlet.spawn(self._get_range, loc,
+                                              start, end, validator))
+
+        try:
+            fetch_more()
+            remaining = chunk_size
+            while remaining:
+                chunk = resp.read(min(self.stream_chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+            # The rest of this response is fetched as ranges instead
+            conn.close()
+
+            while pending:
+                data = pending.popleft().wait()
+                fetch_more()
+                for offset in xrange(0, len(data), self.stream_chunk_size):
+                    yield data[offset:offset + self.stream_chunk_size]
+        finally:
+            conn.close()
+            for thread in pending:
+                thread.kill()
+
+    def _get_range(self, loc, start, end, validator=None):
+        """
+        Returns the bytes from start up to end of the image at loc.
+
+        :raises `glance.common.exception.BadStoreUri` if the server does
+                not return exactly that range, for example because the
+                image changed since validator was obtained
+        """
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+        if validator:
+            headers['If-Range'] = validator
+        conn, resp = self._request(loc, 'GET', headers)
+        if resp.status != 206:
+            conn.close()
+            reason = (_("HTTP URL returned a %s status code for a byte "
+                        "range.") % resp.status)
+            raise exception.BadStoreUri(loc.path, reason)
+        data = resp.read()
+        if len(data) != end - start:
+            conn.close()
+            reason = (_("HTTP URL returned %(got)d bytes for a range of "
+                        "%(expected)d.") %
+                      {'got': len(data), 'expected': end - start})
+            raise exception.BadStoreUri(loc.path, reason)
+        self._release(loc, conn, resp)
+        return data
+
+    def _query(self, location, verb, headers=None):
+        """
+        Sends a request for the image at location, following redirects,
+        and returns a tuple of the connection, the response, the size of
+        the image and the `glance.store.location.StoreLocation` that was
+        eventually used.
+
+        Where a URL was recently found to redirect, the request goes to
+        the final target of the redirects right away.
+        """
+        uri = location.store_location.get_uri()
+        target = self._get_redirect(uri)
+        if target is not None:
+            try:
+                return self._follow(self._redirect(location, target), verb,
+                                    headers)
+            except (exception.BadStoreUri, exception.MaxRedirectsExceeded,
+                    httplib.HTTPException, socket.error):
+                LOG.debug(_("Redirect target %(target)s of %(uri)s failed, "
+                            "resolving it again") % locals())
+                self.redirects.pop(uri, None)
+
+        result = self._follow(location, verb, headers)
+        target = result[3].get_uri()
+        if target != uri:
+            self._remember_redirect(uri, target)
+        return result
+
+    def _follow(self, location, verb, headers=None, depth=0):
         if depth > MAX_REDIRECTS:
             raise exception.MaxRedirectsExceeded(redirects=MAX_REDIRECTS)
         loc = location.store_location
-        conn_class = self._get_conn_class(loc)
-        conn = conn_class(loc.netloc)
-        conn.request(verb, loc.path, "", {})
-        resp = conn.getresponse()
+        conn, resp = self._request(loc, verb, headers)
 
         # Check for bad status codes
         if resp.status >= 400:
+            self._drain(loc, conn, resp)
             reason = _("HTTP URL returned a %s status code.") % resp.status
             raise exception.BadStoreUri(loc.path, reason)
 
         location_header = resp.getheader("location")
         if location_header:
             if resp.status not in (301, 302):
+                conn.close()
                 reason = _("The HTTP URL attempted to redirect with an "
                            "invalid status code.")
                 raise exception.BadStoreUri(loc.path, reason)
-            location_class = glance.store.location.Location
-            new_loc = location_class(location.store_name,
-                                     location.store_location.__class__,
-                                     uri=location_header,
-                                     image_id=location.image_id,
-                                     store_specs=location.store_specs)
-            return self._query(new_loc, verb, depth + 1)
+            self._drain(loc, conn, resp)
+            new_loc = self._redirect(location, location_header)
+            return self._follow(new_loc, verb, headers, depth + 1)
         content_length = int(resp.getheader('content-length', 0))
-        return (conn, resp, content_length)
+        return (conn, resp, content_length, loc)
+
+    @staticmethod
+    def _redirect(location, uri):
+        """Returns a copy of location pointing to uri instead"""
+        location_class = glance.store.location.Location
+        return location_class(location.store_name,
+                              location.store_location.__class__,
+                              uri=uri,
+                              image_id=location.image_id,
+                              store_specs=location.store_specs)
+
+    def _get_redirect(self, uri):
+        """Returns the cached redirect target of uri, if still valid"""
+        entry = self.redirects.get(uri)
+        if entry is None:
+            return None
+        target, expires = entry
+        if expires < time.time():
+            del self.redirects[uri]
+            return None
+        return target
+
+    def _remember_redirect(self, uri, target):
+        if self.redirect_ttl <= 0:
+            return
+        self.redirects[uri] = (target, time.time() + self.redirect_ttl)
+
+    @staticmethod
+    def _pool_key(loc):
+        return (loc.scheme, loc.netloc)
+
+    def _request(self, loc, verb, headers=None):
+        """
+        Sends a request for loc, on an idle connection to the same host
+        if there is one, and returns the connection and the response.
+        """
+        headers = headers or {}
+        conn = self.pool.get(self._pool_key(loc))
+        if conn is not None:
+            try:
+                conn.request(verb, loc.path, "", headers)
+                return (conn, conn.getresponse())
+            except (httplib.HTTPException, socket.error):
+                # The server closed the connection while it was idle
+                conn.close()
+        conn_class = self._get_conn_class(loc)
+        conn = conn_class(loc.netloc)
+        conn.request(verb, loc.path, "", headers)
+        return (conn, conn.getresponse())
+
+    def _release(self, loc, conn, resp):
+        """
+        Returns conn to the pool for reuse, once resp has been read to
+        the end, unless the server is going to close it.
+        """
+        if getattr(resp, 'will_close', False):
+            conn.close()
+        else:
+            self.pool.put(self._pool_key(loc), conn)
+
+    def _drain(self, loc, conn, resp):
+        """
+        Discards the body of a response we do not use, so its connection
+        can be reused, provided the body is small.
+        """
+        resp.read(MAX_DRAIN_SIZE)
+        if resp.read(1):
+            conn.close()
+        else:
+            self._release(loc, conn, resp)
 
     def _get_conn_class(self, loc):
         """
@@ -20,11 +20,19 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import atexit
+import collections
+import contextlib
 import hashlib
 import math
+import os
 import urllib
 
+import eventlet
+from eventlet import tpool
+
 from glance.common import exception
+from glance.common import utils
 from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
 import glance.store
@@ -42,6 +50,7 @@ DEFAULT_CONFFILE = ''  # librados will locate the default conf file
 DEFAULT_USER = None    # let librados decide based on the Ceph conf file
 DEFAULT_CHUNKSIZE = 4  # in MiB
 DEFAULT_SNAPNAME = 'snap'
+DEFAULT_QUEUE_DEPTH = 1
 
 LOG = logging.getLogger(__name__)
 
@@ -50,11 +59,153 @@ rbd_opts = [
     cfg.StrOpt('rbd_store_pool', default=DEFAULT_POOL),
     cfg.StrOpt('rbd_store_user', default=DEFAULT_USER),
     cfg.StrOpt('rbd_store_ceph_conf', default=DEFAULT_CONFFILE),
+    cfg.IntOpt('rbd_store_queue_depth', default=DEFAULT_QUEUE_DEPTH),
+    cfg.BoolOpt('rbd_store_clone_on_copy', default=True),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(rbd_opts)
 
+_CLUSTERS = {}
+
+
+def get_cluster(conf_file, user):
+    """
+    Returns the process wide `ClusterConnection` for the given Ceph
+    configuration file and user, creating it if needed.
+    """
+    key = (conf_file, user)
+    if key not in _CLUSTERS:
+        _CLUSTERS[key] = ClusterConnection(conf_file, user)
+    return _CLUSTERS[key]
+
+
+@atexit.register
+def shutdown_clusters():
+    """Closes every cluster connection opened by this process"""
+    for cluster in _CLUSTERS.values():
+        cluster.shutdown()
+
+
+class ClusterHandles(object):
+    """
+    A cluster connection and the I/O contexts opened on it, along with
+    the number of operations using them, so that they are only closed
+    once the last of those operations is done.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.ioctxs = {}
+        self.users = 0
+        self.retired = False
+
+    def close(self):
+        for ioctx in self.ioctxs.values():
+            try:
+                ioctx.close()
+            except Exception:
+                pass
+        self.ioctxs = {}
+        try:
+            self.conn.shutdown()
+        except Exception:
+            pass
+
+
+class ClusterConnection(object):
+    """
+    A long-lived connection to a RADOS cluster, shared by every request
+    in a process, that also keeps an I/O context open for each pool it
+    is asked about. Connecting is done lazily so that the connection is
+    made in the worker process that uses it, and is redone after a
+    fork or after the cluster connection fails. A failed connection is
+    only closed once the operations still using it are done, since other
+    green threads may be in the middle of reading through it.
+    """
+
+    def __init__(self, conf_file, user):
+        self.conf_file = conf_file
+        self.user = user
+        self.pid = None
+        self.handles = None
+
+    def _acquire(self):
+        """Returns the current handles, connecting first if needed"""
+        if self.pid != os.getpid():
+            # Handles inherited from a parent process are not usable,
+            # and shutting them down here would affect the parent
+            self.handles = None
+        elif (self.handles is not None and
+                self.handles.conn.state != 'connected'):
+            self._retire(self.handles)
+
+        if self.handles is None:
+            LOG.debug(_("Connecting to RADOS cluster as %(user)s using "
+                        "%(conf_file)s") % {'user': self.user,
+                                            'conf_file': self.conf_file})
+            conn = rados.Rados(conffile=self.conf_file, rados_id=self.user)
+            conn.connect()
+            self.handles = ClusterHandles(conn)
+            self.pid = os.getpid()
+        self.handles.users += 1
+        return self.handles
+
+    def _release(self, handles):
+        handles.users -= 1
+        if handles.retired and handles.users == 0:
+            handles.close()
+
+    def _retire(self, handles):
+        """
+        Stops handing out the handles, and closes them as soon as no
+        operation is using them any more.
+        """
+        handles.retired = True
+        if self.handles is handles:
+            self.handles = None
+        if handles.users == 0:
+            handles.close()
+
+    @contextlib.contextmanager
+    def _use(self):
+        handles = self._acquire()
+        try:
+            yield handles
+        except rados.Error:
+            LOG.exception(_("Error talking to the RADOS cluster, "
+                            "reconnecting"))
+            self._retire(handles)
+            raise
+        finally:
+            self._release(handles)
+
+    def get_fsid(self):
+        with self._use() as handles:
+            if hasattr(handles.conn, 'get_fsid'):
+                return handles.conn.get_fsid()
+            return None
+
+    @contextlib.contextmanager
+    def open_ioctx(self, pool):
+        """
+        Provides the cached I/O context for a pool. If a RADOS error
+        escapes, the next caller gets a fresh connection.
+        """
+        with self._use() as handles:
+            ioctx = handles.ioctxs.get(pool)
+            if ioctx is None:
+                ioctx = handles.conn.open_ioctx(pool)
+                handles.ioctxs[pool] = ioctx
+            yield ioctx
+
+    def shutdown(self):
+        """Closes the cached I/O contexts and the cluster connection"""
+        if self.handles is None or self.pid != os.getpid():
+            return
+        self.handles.close()
+        self.handles = None
+
 
 class StoreLocation(glance.store.location.StoreLocation):
     """
@@ -120,35 +271,85 @@ class StoreLocation(glance.store.location.StoreLocation):
 
 class ImageIterator(object):
     """
-    Reads data from an RBD image, one chunk at a time.
+    Reads data from an RBD image, one chunk at a time, optionally just
+    length bytes from offset.
     """
 
-    def __init__(self, name, store):
+    def __init__(self, name, store, offset=0, length=None):
         self.name = name
         self.pool = store.pool
-        self.user = store.user
-        self.conf_file = store.conf_file
+        self.cluster = store.cluster
         self.chunk_size = store.chunk_size
+        self.queue_depth = store.queue_depth
+        self.offset = offset
+        self.length = length
 
     def __iter__(self):
         try:
-            with rados.Rados(conffile=self.conf_file,
-                             rados_id=self.user) as conn:
-                with conn.open_ioctx(self.pool) as ioctx:
-                    with rbd.Image(ioctx, self.name) as image:
-                        img_info = image.stat()
-                        size = img_info['size']
-                        bytes_left = size
-                        while bytes_left > 0:
-                            length = min(self.chunk_size, bytes_left)
-                            data = image.read(size - bytes_left, length)
-                            bytes_left -= len(data)
-                            yield data
+            with self.cluster.open_ioctx(self.pool) as ioctx:
+                with rbd.Image(ioctx, self.name) as image:
+                    img_info = image.stat()
+                    size = img_info['size']
+                    if self.length is not None:
+                        size = min(size, self.offset + self.length)
+                    if self.queue_depth > 1:
+                        chunks = self._read_ahead(image, size)
+                        try:
+                            for data in chunks:
+                                yield data
+                        finally:
+                            # Wait for the reads in flight before the
+                            # image is closed, even if the reader stopped
+                            chunks.close()
                         raise StopIteration()
+                    position = self.offset
+                    while position < size:
+                        length = min(self.chunk_size, size - position)
+                        data = image.read(position, length)
+                        position += len(data)
+                        yield data
+                    raise StopIteration()
         except rbd.ImageNotFound:
             raise exception.NotFound(
                 _('RBD image %s does not exist') % self.name)
 
+    def _read_ahead(self, image, size):
+        """
+        Yields the chunks of the image from offset up to size in order
+        while keeping up to ``rbd_store_queue_depth`` reads outstanding,
+        so the cluster is already working on the next chunks while the
+        current one is being sent to the client.
+        """
+        pending = collections.deque()
+        try:
+            for offset in xrange(self.offset, size, self.chunk_size):
+                if len(pending) >= self.queue_depth:
+                    yield pending.popleft().wait()
+                length = min(self.chunk_size, size - offset)
+                pending.append(eventlet.spawn(tpool.execute, image.read,
+                                              offset, length))
+            while pending:
+                yield pending.popleft().wait()
+        finally:
+            # The image is closed once we return, so let any reads that
+            # are still running finish first
+            wait_all(pending, raise_errors=False)
+
+
+def wait_all(pending, raise_errors=True):
+    """
+    Waits for every green thread in pending, re-raising the first error
+    any of them hit unless raise_errors is False.
+    """
+    error = None
+    while pending:
+        try:
+            pending.popleft().wait()
+        except Exception, e:
+            error = error or e
+    if error and raise_errors:
+        raise error
+
 
 class Store(glance.store.base.Store):
     """An implementation of the RBD backend adapter."""
@@ -173,13 +374,16 @@ class Store(glance.store.base.Store):
             self.pool = str(CONF.rbd_store_pool)
             self.user = str(CONF.rbd_store_user)
             self.conf_file = str(CONF.rbd_store_ceph_conf)
+            self.queue_depth = max(1, CONF.rbd_store_queue_depth)
+            self.clone_on_copy = CONF.rbd_store_clone_on_copy
+            self.cluster = get_cluster(self.conf_file, self.user)
         except cfg.ConfigFileValueError, e:
             reason = _("Error in store configuration: %s") % e
             LOG.error(reason)
             raise exception.BadStoreConfiguration(store_name='rbd',
                                                   reason=reason)
 
-    def get(self, location):
+    def get(self, location, context=None, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a generator for reading
@@ -187,10 +391,12 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Index of the first byte of the image to return
+        :param length: Number of bytes to return, or None for the rest
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
-        return (ImageIterator(str(loc.image), self), None)
+        return (ImageIterator(str(loc.image), self, offset, length), None)
 
     def _create_image(self, fsid, ioctx, name, size, order):
         """
@@ -214,7 +420,7 @@ class Store(glance.store.base.Store):
             librbd.create(ioctx, name, size, order, old_format=True)
             return StoreLocation({'image': name})
 
-    def add(self, image_id, image_file, image_size):
+    def add(self, image_id, image_file, image_size, context=None):
         """
         Stores an image file with supplied identifier to the backend
         storage system and returns a tuple containing information
@@ -228,23 +434,23 @@ class Store(glance.store.base.Store):
         :raises `glance.common.exception.Duplicate` if the image already
                 existed
         """
-        checksum = hashlib.md5()
+        checksum = utils.ThreadedHasher(hashlib.md5())
         image_name = str(image_id)
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
-            fsid = None
-            if hasattr(conn, 'get_fsid'):
-                fsid = conn.get_fsid()
-            with conn.open_ioctx(self.pool) as ioctx:
-                order = int(math.log(self.chunk_size, 2))
-                LOG.debug('creating image %s with order %d',
-                          image_name, order)
-                try:
-                    location = self._create_image(fsid, ioctx, image_name,
-                                                  image_size, order)
-                except rbd.ImageExists:
-                    raise exception.Duplicate(
-                        _('RBD image %s already exists') % image_id)
-                with rbd.Image(ioctx, image_name) as image:
+        fsid = self.cluster.get_fsid()
+        with self.cluster.open_ioctx(self.pool) as ioctx:
+            order = int(math.log(self.chunk_size, 2))
+            LOG.debug('creating image %s with order %d', image_name, order)
+            try:
+                location = self._create_image(fsid, ioctx, image_name,
+                                              image_size, order)
+            except rbd.ImageExists:
+                raise exception.Duplicate(
+                    _('RBD image %s already exists') % image_id)
+            with rbd.Image(ioctx, image_name) as image:
+                if self.queue_depth > 1:
+                    self._write_pipelined(image, image_file, image_size,
+                                          checksum)
+                else:
                     bytes_left = image_size
                     while bytes_left > 0:
                         length = min(self.chunk_size, bytes_left)
@@ -252,13 +458,95 @@ class Store(glance.store.base.Store):
                         image.write(data, image_size - bytes_left)
                         bytes_left -= length
                         checksum.update(data)
-                    if location.snapshot:
-                        image.create_snap(location.snapshot)
-                        image.protect_snap(location.snapshot)
+                if location.snapshot:
+                    image.create_snap(location.snapshot)
+                    image.protect_snap(location.snapshot)
 
         return (location.get_uri(), image_size, checksum.hexdigest())
 
-    def delete(self, location):
+    def add_from_location(self, image_id, source, image_size, context=None):
+        """
+        Copies an image from a protected snapshot in the same cluster by
+        cloning it, which only creates metadata, instead of streaming the
+        image data through Glance. The snapshot of the source then cannot
+        be removed while the clone exists.
+
+        :param image_id: The opaque image identifier
+        :param source: `glance.store.location.Location` object of the
+                       image to copy
+        :param image_size: The size of the image data to copy, in bytes
+
+        :retval tuple of URL in backing store, bytes written, and checksum
+                (always None, since the data is not read), or None if the
+                source cannot be cloned
+        :raises `glance.common.exception.Duplicate` if the image already
+                existed
+        """
+        src = source.store_location
+        if (not self.clone_on_copy or
+                not isinstance(src, StoreLocation) or
+                not src.snapshot or
+                not hasattr(rbd, 'RBD_FEATURE_LAYERING')):
+            return None
+        fsid = self.cluster.get_fsid()
+        if not fsid or src.fsid != fsid:
+            return None
+
+        image_name = str(image_id)
+        LOG.debug(_("Cloning RBD image %(image)s@%(snapshot)s in pool "
+                    "%(pool)s to %(image_name)s") %
+                  {'image': src.image, 'snapshot': src.snapshot,
+                   'pool': src.pool, 'image_name': image_name})
+        with self.cluster.open_ioctx(src.pool) as src_ioctx:
+            with self.cluster.open_ioctx(self.pool) as ioctx:
+                try:
+                    rbd.RBD().clone(src_ioctx, src.image, src.snapshot,
+                                    ioctx, image_name,
+                                    features=rbd.RBD_FEATURE_LAYERING)
+                except rbd.ImageExists:
+                    raise exception.Duplicate(
+                        _('RBD image %s already exists') % image_id)
+                except rbd.ImageNotFound:
+                    raise exception.NotFound(
+                        _('RBD image %s does not exist') % src.image)
+                with rbd.Image(ioctx, image_name) as image:
+                    size = image.size()
+                    image.create_snap(DEFAULT_SNAPNAME)
+                    image.protect_snap(DEFAULT_SNAPNAME)
+
+        location = StoreLocation({
+            'fsid': fsid,
+            'pool': self.pool,
+            'image': image_name,
+            'snapshot': DEFAULT_SNAPNAME,
+        })
+        return (location.get_uri(), size, None)
+
+    def _write_pipelined(self, image, image_file, image_size, checksum):
+        """
+        Writes the image data with up to ``rbd_store_queue_depth`` writes
+        outstanding, so that receiving the next chunk from the client
+        and checksumming it overlap with writing earlier chunks to the
+        cluster.
+        """
+        pending = collections.deque()
+        try:
+            offset = 0
+            while offset < image_size:
+                length = min(self.chunk_size, image_size - offset)
+                data = image_file.read(length)
+                if len(pending) >= self.queue_depth:
+                    pending.popleft().wait()
+                pending.append(eventlet.spawn(tpool.execute, image.write,
+                                              data, offset))
+                checksum.update(data)
+                offset += length
+        except Exception:
+            wait_all(pending, raise_errors=False)
+            raise
+        wait_all(pending)
+
+    def delete(self, location, context=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file to delete
@@ -270,25 +558,24 @@ class Store(glance.store.base.Store):
         """
         loc = location.store_location
 
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
-            with conn.open_ioctx(self.pool) as ioctx:
-                if loc.snapshot:
-                    with rbd.Image(ioctx, loc.image) as image:
-                        try:
-                            image.unprotect_snap(loc.snapshot)
-                        except rbd.ImageBusy:
-                            log_msg = _("snapshot %s@%s could not be "
-                                        "unprotected because it is in use")
-                            LOG.debug(log_msg % (loc.image, loc.snapshot))
-                            raise exception.InUseByStore()
-                        image.remove_snap(loc.snapshot)
-                try:
-                    rbd.RBD().remove(ioctx, str(loc.image))
-                except rbd.ImageNotFound:
-                    raise exception.NotFound(
-                        _('RBD image %s does not exist') % loc.image)
-                except rbd.ImageBusy:
-                    log_msg = _("image %s could not be removed"
-                                "because it is in use")
-                    LOG.debug(log_msg % loc.image)
-                    raise exception.InUseByStore()
+        with self.cluster.open_ioctx(self.pool) as ioctx:
+            if loc.snapshot:
+                with rbd.Image(ioctx, loc.image) as image:
+                    try:
+                        image.unprotect_snap(loc.snapshot)
+                    except rbd.ImageBusy:
+                        log_msg = _("snapshot %s@%s could not be "
+                                    "unprotected because it is in use")
+                        LOG.debug(log_msg % (loc.image, loc.snapshot))
+                        raise exception.InUseByStore()
+                    image.remove_snap(loc.snapshot)
+            try:
+                rbd.RBD().remove(ioctx, str(loc.image))
+            except rbd.ImageNotFound:
+                raise exception.NotFound(
+                    _('RBD image %s does not exist') % loc.image)
+            except rbd.ImageBusy:
+                log_msg = _("image %s could not be removed"
+                            "because it is in use")
+                LOG.debug(log_msg % loc.image)
+                raise exception.InUseByStore()
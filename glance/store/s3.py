@@ -20,9 +20,12 @@
 import hashlib
 import httplib
 import re
+import StringIO
 import tempfile
 import urlparse
 
+import eventlet
+
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import cfg
@@ -33,6 +36,17 @@ import glance.store.location
 
 LOG = logging.getLogger(__name__)
 
+DEFAULT_LARGE_OBJECT_SIZE = 100          # 100M
+DEFAULT_LARGE_OBJECT_CHUNK_SIZE = 10     # 10M
+DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE = 5  # 5M
+DEFAULT_UPLOAD_CONCURRENCY = 4
+ONE_MB = 1024 * 1024
+# The most parts S3 accepts in a multipart upload
+MAX_MULTIPART_PARTS = 10000
+# The number of bucket handles (and the connections behind them) kept
+# around for reuse by later requests
+BUCKET_CACHE_SIZE = 32
+
 s3_opts = [
     cfg.StrOpt('s3_store_host'),
     cfg.StrOpt('s3_store_access_key', secret=True),
@@ -41,6 +55,12 @@ s3_opts = [
     cfg.StrOpt('s3_store_object_buffer_dir'),
     cfg.BoolOpt('s3_store_create_bucket_on_put', default=False),
     cfg.StrOpt('s3_store_bucket_url_format', default='subdomain'),
+    cfg.IntOpt('s3_store_large_object_size',
+               default=DEFAULT_LARGE_OBJECT_SIZE),
+    cfg.IntOpt('s3_store_large_object_chunk_size',
+               default=DEFAULT_LARGE_OBJECT_CHUNK_SIZE),
+    cfg.IntOpt('s3_store_large_object_upload_concurrency',
+               default=DEFAULT_UPLOAD_CONCURRENCY),
 ]
 
 CONF = cfg.CONF
@@ -173,7 +193,8 @@ class ChunkedFile(object):
         """Return an iterator over the image file"""
         try:
             while True:
-                chunk = self.fp.read(ChunkedFile.CHUNKSIZE)
+                chunk = self.fp.read(
+                        utils.get_chunk_size(ChunkedFile.CHUNKSIZE))
                 if chunk:
                     yield chunk
                 else:
@@ -206,6 +227,9 @@ class Store(glance.store.base.Store):
     def get_schemes(self):
         return ('s3', 's3+http', 's3+https')
 
+    def configure(self):
+        self.bucket_cache = utils.LRUCache(BUCKET_CACHE_SIZE)
+
     def configure_add(self):
         """
         Configure the Store to use the stored configuration options
@@ -235,6 +259,19 @@ class Store(glance.store.base.Store):
 
         self.s3_store_object_buffer_dir = CONF.s3_store_object_buffer_dir
 
+        self.large_object_size = CONF.s3_store_large_object_size * ONE_MB
+        chunk_size = CONF.s3_store_large_object_chunk_size
+        if chunk_size < DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE:
+            reason = (_("s3_store_large_object_chunk_size must be at least "
+                        "%d MB, the smallest part S3 accepts in a multipart "
+                        "upload") % DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE)
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="s3",
+                                                  reason=reason)
+        self.large_object_chunk_size = chunk_size * ONE_MB
+        self.upload_concurrency = max(
+            1, CONF.s3_store_large_object_upload_concurrency)
+
     def _option_get(self, param):
         result = getattr(CONF, param)
         if not result:
@@ -245,7 +282,7 @@ class Store(glance.store.base.Store):
                                                   reason=reason)
         return result
 
-    def get(self, location):
+    def get(self, location, context=None, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -253,20 +290,33 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Index of the first byte of the image to return
+        :param length: Number of bytes to return, or None for the rest
         :raises `glance.exception.NotFound` if image does not exist
         """
         key = self._retrieve_key(location)
 
-        key.BufferSize = self.CHUNKSIZE
+        key.BufferSize = self.stream_chunk_size
+        size = key.size
+        if offset or length is not None:
+            end = size if length is None else min(offset + length, size)
+            size = max(end - offset, 0)
+            if size:
+                key.open_read(headers={'Range': 'bytes=%d-%d' %
+                                                (offset, end - 1)})
+            else:
+                key.close()
+                return (iter([]), 0)
 
         class ChunkedIndexable(glance.store.Indexable):
             def another(self):
-                return (self.wrapped.fp.read(ChunkedFile.CHUNKSIZE)
+                return (self.wrapped.fp.read(
+                            utils.get_chunk_size(ChunkedFile.CHUNKSIZE))
                         if self.wrapped.fp else None)
 
-        return (ChunkedIndexable(ChunkedFile(key), key.size), key.size)
+        return (ChunkedIndexable(ChunkedFile(key), size), size)
 
-    def get_size(self, location):
+    def get_size(self, location, context=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns the image_size (or 0
@@ -283,15 +333,9 @@ class Store(glance.store.base.Store):
 
     def _retrieve_key(self, location):
         loc = location.store_location
-        from boto.s3.connection import S3Connection
-
-        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
-                               host=loc.s3serviceurl,
-                               is_secure=(loc.scheme == 's3+https'),
-                               calling_format=get_calling_format())
-        bucket_obj = get_bucket(s3_conn, loc.bucket)
-
-        key = get_key(bucket_obj, loc.key)
+        key = self._with_bucket(loc,
+                                lambda bucket_obj: get_key(bucket_obj,
+                                                           loc.key))
 
         msg = _("Retrieved image object from S3 using (s3_host=%(s3_host)s, "
                 "access_key=%(accesskey)s, bucket=%(bucket)s, "
@@ -303,7 +347,7 @@ class Store(glance.store.base.Store):
 
         return key
 
-    def add(self, image_id, image_file, image_size):
+    def add(self, image_id, image_file, image_size, context=None):
         """
         Stores an image file with supplied identifier to the backend
         storage system and returns a tuple containing information
@@ -326,8 +370,6 @@ class Store(glance.store.base.Store):
             <BUCKET> = ``s3_store_bucket``
             <ID> = The id of the image being added
         """
-        from boto.s3.connection import S3Connection
-
         loc = StoreLocation({'scheme': self.scheme,
                              'bucket': self.bucket,
                              'key': image_id,
@@ -335,14 +377,6 @@ class Store(glance.store.base.Store):
                              'accesskey': self.access_key,
                              'secretkey': self.secret_key})
 
-        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
-                               host=loc.s3serviceurl,
-                               is_secure=(loc.scheme == 's3+https'),
-                               calling_format=get_calling_format())
-
-        create_bucket_if_missing(self.bucket, s3_conn)
-
-        bucket_obj = get_bucket(s3_conn, self.bucket)
         obj_name = str(image_id)
 
         def _sanitize(uri):
@@ -350,8 +384,10 @@ class Store(glance.store.base.Store):
                           '//s3_store_secret_key:s3_store_access_key@',
                           uri)
 
-        key = bucket_obj.get_key(obj_name)
-        if key and key.exists():
+        bucket_obj, key = self._with_bucket(
+            loc, lambda bucket_obj: (bucket_obj, bucket_obj.get_key(obj_name)),
+            create=True)
+        if key:
             raise exception.Duplicate(_("S3 already has an image at "
                                       "location %s") %
                                       _sanitize(loc.get_uri()))
@@ -364,6 +400,18 @@ class Store(glance.store.base.Store):
                                          'obj_name': obj_name})
         LOG.debug(msg)
 
+        if image_size == 0 or image_size >= self.large_object_size:
+            # Stream the image to S3 in parts as it arrives instead of
+            # spooling the whole thing to disk first
+            size, checksum_hex = self._add_multipart(bucket_obj, obj_name,
+                                                     image_file, image_size,
+                                                     _sanitize(loc.get_uri()))
+
+            LOG.debug(_("Wrote %(size)d bytes to S3 key named %(obj_name)s "
+                        "with checksum %(checksum_hex)s") % locals())
+
+            return (loc.get_uri(), size, checksum_hex)
+
         key = bucket_obj.new_key(obj_name)
 
         # We need to wrap image_file, which is a reference to the
@@ -384,8 +432,8 @@ class Store(glance.store.base.Store):
 
         tmpdir = self.s3_store_object_buffer_dir
         temp_file = tempfile.NamedTemporaryFile(dir=tmpdir)
-        checksum = hashlib.md5()
-        for chunk in utils.chunkreadable(image_file, self.CHUNKSIZE):
+        checksum = utils.ThreadedHasher(hashlib.md5())
+        for chunk in utils.chunkreadable(image_file, self.stream_chunk_size):
             checksum.update(chunk)
             temp_file.write(chunk)
         temp_file.flush()
@@ -404,7 +452,94 @@ class Store(glance.store.base.Store):
 
         return (loc.get_uri(), size, checksum_hex)
 
-    def delete(self, location):
+    def _add_multipart(self, bucket_obj, obj_name, image_file, image_size,
+                       uri):
+        """
+        Uploads the image data as a multipart upload, sending each part
+        of ``s3_store_large_object_chunk_size`` as soon as it has been
+        read while the next one is being received. At most
+        ``s3_store_large_object_upload_concurrency`` parts are in flight
+        (and held in memory) at once. The parts of an image of known size
+        are made large enough to fit it in MAX_MULTIPART_PARTS parts. The
+        multipart upload is aborted if anything goes wrong.
+
+        :retval tuple of bytes written and checksum
+        """
+        msg = _("Starting multipart upload to S3 for %s") % uri
+        LOG.debug(msg)
+
+        part_size = max(self.large_object_chunk_size,
+                        (image_size + MAX_MULTIPART_PARTS - 1) //
+                        MAX_MULTIPART_PARTS)
+
+        mpu = bucket_obj.initiate_multipart_upload(obj_name)
+        pool = eventlet.GreenPool(self.upload_concurrency)
+        errors = []
+        checksum = utils.ThreadedHasher(hashlib.md5())
+        size = 0
+        part_num = 0
+
+        def _upload_part(part, part_num):
+            try:
+                mpu.upload_part_from_file(part, part_num)
+            except Exception, e:
+                errors.append(e)
+            finally:
+                part.close()
+
+        try:
+            while not errors:
+                part = self._read_part(image_file, part_size)
+                if not part.len and part_num:
+                    part.close()
+                    break
+                if part_num == MAX_MULTIPART_PARTS:
+                    part.close()
+                    raise exception.StorageFull(
+                            _("S3 cannot store an image in more than %(max)d "
+                              "parts of %(size)d bytes") %
+                            {'max': MAX_MULTIPART_PARTS, 'size': part_size})
+                checksum.update(part.getvalue())
+                size += part.len
+                part_num += 1
+                # Blocks while every upload slot is busy, which keeps the
+                # number of parts buffered in memory bounded
+                pool.spawn_n(_upload_part, part, part_num)
+                if part.len < part_size:
+                    break
+            pool.waitall()
+            if errors:
+                raise errors[0]
+            mpu.complete_upload()
+        except Exception:
+            LOG.error(_("Failed to upload %s to S3, aborting the multipart "
+                        "upload") % uri)
+            pool.waitall()
+            mpu.cancel_upload()
+            raise
+
+        msg = (_("Uploaded %(part_num)d parts to S3 for %(uri)s") %
+               locals())
+        LOG.debug(msg)
+
+        return (size, checksum.hexdigest())
+
+    def _read_part(self, image_file, part_size):
+        """
+        Reads up to part_size bytes of image data into an in-memory part
+        """
+        part = StringIO.StringIO()
+        remaining = part_size
+        while remaining > 0:
+            chunk = image_file.read(min(remaining, self.stream_chunk_size))
+            if not chunk:
+                break
+            part.write(chunk)
+            remaining -= len(chunk)
+        part.seek(0)
+        return part
+
+    def delete(self, location, context=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file to delete
@@ -415,15 +550,9 @@ class Store(glance.store.base.Store):
         :raises NotFound if image does not exist
         """
         loc = location.store_location
-        from boto.s3.connection import S3Connection
-        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
-                               host=loc.s3serviceurl,
-                               is_secure=(loc.scheme == 's3+https'),
-                               calling_format=get_calling_format())
-        bucket_obj = get_bucket(s3_conn, loc.bucket)
-
-        # Close the key when we're through.
-        key = get_key(bucket_obj, loc.key)
+        key = self._with_bucket(loc,
+                                lambda bucket_obj: get_key(bucket_obj,
+                                                           loc.key))
 
         msg = _("Deleting image object from S3 using (s3_host=%(s3_host)s, "
                 "access_key=%(accesskey)s, bucket=%(bucket)s, "
@@ -435,6 +564,81 @@ class Store(glance.store.base.Store):
 
         return key.delete()
 
+    def _get_bucket(self, loc, create=False):
+        """
+        Returns a ``boto.s3.bucket.Bucket`` for the bucket of the supplied
+        location along with whether it came from the cache. Connections
+        and bucket handles are kept per host, credentials, bucket and
+        calling format, so only the first request for a bucket pays for
+        the bucket lookup.
+
+        :param loc: The ``StoreLocation`` to get the bucket for
+        :param create: Create the bucket if it is missing and the
+                       ``s3_store_create_bucket_on_put`` option is set
+        """
+        calling_format = get_calling_format()
+        # NOTE: the secret key must be part of the key, or a location
+        # with a wrong secret would get a connection authenticated by
+        # someone else
+        secret_hash = hashlib.sha256(loc.secretkey or '').hexdigest()
+        cache_key = (loc.scheme, loc.s3serviceurl, loc.accesskey,
+                     secret_hash, loc.bucket,
+                     calling_format.__class__.__name__)
+        bucket_obj = self.bucket_cache.get(cache_key)
+        if bucket_obj is not None:
+            return bucket_obj, True
+
+        from boto.s3.connection import S3Connection
+        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
+                               host=loc.s3serviceurl,
+                               is_secure=(loc.scheme == 's3+https'),
+                               calling_format=calling_format)
+        if create:
+            create_bucket_if_missing(loc.bucket, s3_conn)
+        bucket_obj = get_bucket(s3_conn, loc.bucket)
+
+        self.bucket_cache[cache_key] = bucket_obj
+        return bucket_obj, False
+
+    def _evict_bucket(self, bucket_obj):
+        for cache_key, cached in self.bucket_cache.items():
+            if cached is bucket_obj:
+                del self.bucket_cache[cache_key]
+
+    def _with_bucket(self, loc, func, create=False):
+        """
+        Calls func with the bucket of the supplied location and returns
+        its result. A cached bucket handle that turns out to be stale,
+        because the bucket is gone or the credentials are no longer
+        accepted, is dropped and the call is retried once with a fresh
+        connection.
+        """
+        from boto.exception import S3ResponseError
+        bucket_obj, cached = self._get_bucket(loc, create=create)
+        try:
+            return func(bucket_obj)
+        except S3ResponseError, e:
+            self._evict_bucket(bucket_obj)
+            if not cached or not is_stale_bucket_error(e):
+                raise
+            LOG.debug(_("Cached S3 bucket %(bucket)s is stale (%(e)s), "
+                        "reconnecting") % {'bucket': loc.bucket, 'e': e})
+        except (IOError, httplib.HTTPException):
+            self._evict_bucket(bucket_obj)
+            raise
+        bucket_obj, cached = self._get_bucket(loc, create=create)
+        return func(bucket_obj)
+
+
+def is_stale_bucket_error(e):
+    """
+    Returns whether an ``S3ResponseError`` means that a bucket handle
+    should no longer be used
+    """
+    return (e.status in (httplib.UNAUTHORIZED, httplib.FORBIDDEN) or
+            (e.status == httplib.NOT_FOUND and
+             getattr(e, 'error_code', None) == 'NoSuchBucket'))
+
 
 def get_bucket(conn, bucket_id):
     """
@@ -510,7 +714,7 @@ def get_key(bucket, obj):
     """
 
     key = bucket.get_key(obj)
-    if not key or not key.exists():
+    if not key:
         msg = _("Could not find key %(obj)s in bucket %(bucket)s") % locals()
         LOG.debug(msg)
         raise exception.NotFound(msg)
@@ -19,14 +19,22 @@
 
 from __future__ import absolute_import
 
+import collections
+import functools
 import hashlib
 import httplib
+import itertools
+import json
 import math
+import tempfile
 import urllib
 import urlparse
 
+import eventlet
+
 from glance.common import auth
 from glance.common import exception
+from glance.common import utils
 from glance.openstack.common import cfg
 import glance.openstack.common.log as logging
 import glance.store
@@ -43,6 +51,17 @@ LOG = logging.getLogger(__name__)
 DEFAULT_CONTAINER = 'glance'
 DEFAULT_LARGE_OBJECT_SIZE = 5 * 1024  # 5GB
 DEFAULT_LARGE_OBJECT_CHUNK_SIZE = 200  # 200M
+DEFAULT_MAX_IDLE_CONNECTIONS = 10
+DEFAULT_UPLOAD_CONCURRENCY = 1
+DEFAULT_DOWNLOAD_CONCURRENCY = 1
+DEFAULT_DELETE_CONCURRENCY = 10
+DEFAULT_BULK_DELETE_LIMIT = 10000
+# Times a segment that could not be deleted is retried before giving up,
+# on top of the retries swiftclient makes for connection and server errors
+DELETE_RETRIES = 2
+# Segments buffered for a concurrent upload or download are kept in memory
+# up to this size and spilled to a temporary file beyond it
+SEGMENT_SPOOL_SIZE = 64 * 1024 * 1024  # 64M
 ONE_MB = 1000 * 1024
 
 swift_opts = [
@@ -63,6 +82,15 @@ swift_opts = [
     cfg.BoolOpt('swift_store_create_container_on_put', default=False),
     cfg.BoolOpt('swift_store_multi_tenant', default=False),
     cfg.ListOpt('swift_store_admin_tenants', default=[]),
+    cfg.IntOpt('swift_store_max_idle_connections',
+               default=DEFAULT_MAX_IDLE_CONNECTIONS),
+    cfg.IntOpt('swift_store_large_object_upload_concurrency',
+               default=DEFAULT_UPLOAD_CONCURRENCY),
+    cfg.IntOpt('swift_store_large_object_download_concurrency',
+               default=DEFAULT_DOWNLOAD_CONCURRENCY),
+    cfg.IntOpt('swift_store_delete_concurrency',
+               default=DEFAULT_DELETE_CONCURRENCY),
+    cfg.BoolOpt('swift_store_use_bulk_delete', default=True),
 ]
 
 CONF = cfg.CONF
@@ -222,22 +250,44 @@ class BaseStore(glance.store.base.Store):
         self.large_object_size = _obj_size * ONE_MB
         _chunk_size = self._option_get('swift_store_large_object_chunk_size')
         self.large_object_chunk_size = _chunk_size * ONE_MB
+        self.upload_concurrency = max(
+                1, CONF.swift_store_large_object_upload_concurrency)
+        self.download_concurrency = max(
+                1, CONF.swift_store_large_object_download_concurrency)
+        self.delete_concurrency = max(1, CONF.swift_store_delete_concurrency)
+        self.use_bulk_delete = CONF.swift_store_use_bulk_delete
+        self.bulk_delete_limits = {}
         self.admin_tenants = CONF.swift_store_admin_tenants
         self.region = CONF.swift_store_region
         self.service_type = CONF.swift_store_service_type
         self.endpoint_type = CONF.swift_store_endpoint_type
         self.snet = CONF.swift_enable_snet
 
-    def get(self, location, connection=None):
+    def get(self, location, connection=None, context=None, offset=0,
+            length=None):
+        """
+        Returns a tuple of an iterator over the object at location and
+        its size, or over just length bytes from offset of it. A range is
+        requested from Swift with a Range header, and of a large object
+        only the segments that overlap the range are downloaded.
+        """
         location = location.store_location
-        if not connection:
-            connection = self.get_connection(location)
+        ranged = offset or length is not None
+        pooled = not connection
+        if pooled:
+            connection = self._acquire_connection(location, context)
 
+        manifest = None
         try:
-            resp_headers, resp_body = connection.get_object(
-                    container=location.container, obj=location.obj,
-                    resp_chunk_size=self.CHUNKSIZE)
+            if ranged or (pooled and self.download_concurrency > 1):
+                manifest = self._get_manifest_segments(location, connection)
+            if manifest is None:
+                resp_headers, resp_body = self._get_object(
+                        connection, location.container, location.obj,
+                        offset, length)
         except swiftclient.ClientException, e:
+            if pooled:
+                self._release_connection(location, connection)
             if e.http_status == httplib.NOT_FOUND:
                 uri = location.get_uri()
                 msg = _("Swift could not find image at URI.")
@@ -252,19 +302,163 @@ class BaseStore(glance.store.base.Store):
                 except StopIteration:
                     return ''
 
-        length = int(resp_headers.get('content-length', 0))
-        return (ResponseIndexable(resp_body, length), length)
+        if manifest is not None:
+            if pooled:
+                self._release_connection(location, connection)
+            container, segments = manifest
+            size = sum(int(segment['bytes']) for segment in segments)
+            if ranged:
+                parts = self._select_segments(segments, offset, length)
+                end = size if length is None else min(offset + length, size)
+                size = max(end - offset, 0)
+            else:
+                parts = [(segment, 0, None) for segment in segments]
+            resp_body = self._iter_segments(location, container, parts,
+                                            context)
+        else:
+            if pooled:
+                release = functools.partial(self._release_connection,
+                                            location, connection)
+                resp_body = ReleasingIterator(resp_body, release)
+            size = int(resp_headers.get('content-length', 0))
+
+        return (ResponseIndexable(resp_body, size), size)
+
+    def _get_object(self, connection, container, obj, offset=0,
+                    length=None):
+        """
+        Returns the headers of an object and an iterator over it, or over
+        just length bytes from offset of it.
+        """
+        if not offset and length is None:
+            return connection.get_object(
+                    container=container, obj=obj,
+                    resp_chunk_size=self.stream_chunk_size)
+        # NOTE: Going through the connection's retry logic authenticates
+        # it first if needed and re-authenticates it on a 401, exactly as
+        # for the requests swiftclient makes itself
+        return connection._retry(None, _get_object_range, container, obj,
+                                 offset, length,
+                                 resp_chunk_size=self.stream_chunk_size)
+
+    @staticmethod
+    def _select_segments(segments, offset, length):
+        """
+        Returns the segments of a large object that hold any of the length
+        bytes from offset of it, as a list of tuples of each segment and
+        the offset and length of the part of the range within it. The
+        length is None where the range extends past the segment.
+        """
+        end = None if length is None else offset + length
+        selected = []
+        start = 0
+        for segment in segments:
+            segment_end = start + int(segment['bytes'])
+            if segment_end > offset and (end is None or start < end):
+                part_offset = max(offset - start, 0)
+                if end is None or end >= segment_end:
+                    part_length = None
+                else:
+                    part_length = end - start - part_offset
+                selected.append((segment, part_offset, part_length))
+            start = segment_end
+        return selected
+
+    @staticmethod
+    def _parse_manifest(manifest):
+        """
+        Returns a tuple of the container and the name prefix of the
+        segments of a large object, given its X-Object-Manifest header
+        """
+        # NOTE: The header value is URL-encoded
+        return tuple(urllib.unquote(manifest).split('/', 1))
+
+    def _get_manifest_segments(self, location, connection):
+        """
+        Returns a tuple of the container and the ordered listing of the
+        segments of a large object, or None if the object is not a large
+        object manifest.
+        """
+        headers = connection.head_object(location.container, location.obj)
+        manifest = headers.get('x-object-manifest')
+        if not manifest:
+            return None
+        container, prefix = self._parse_manifest(manifest)
+        segments = connection.get_container(container, prefix=prefix,
+                                            full_listing=True)[1]
+        # NOTE: The manifest itself may share the segment prefix, in
+        # which case it shows up in the listing too
+        segments = [segment for segment in segments
+                    if not (container == location.container and
+                            segment['name'] == location.obj)]
+        return container, segments
+
+    def _iter_segments(self, location, container, parts, context):
+        """
+        Yields the data of a large object, fetching up to
+        ``swift_store_large_object_download_concurrency`` of its segments
+        at the same time. Segments are emitted in order, so at most that
+        many segments are buffered while the reader catches up.
+
+        :param parts: a list of tuples of a segment and the offset and
+                      length of the data to read from it, as returned by
+                      _select_segments()
+        """
+        pool = eventlet.GreenPool(self.download_concurrency)
+        pending = collections.deque()
+        parts = iter(parts)
+
+        def fetch_next():
+            for segment, offset, length in itertools.islice(parts, 1):
+                pending.append(pool.spawn(self._get_segment, location,
+                                          container, segment['name'],
+                                          context, offset, length))
 
-    def get_size(self, location, connection=None):
+        try:
+            for i in xrange(self.download_concurrency):
+                fetch_next()
+            while pending:
+                data = pending.popleft().wait()
+                try:
+                    fetch_next()
+                    for chunk in utils.chunkiter(data, self.stream_chunk_size):
+                        yield chunk
+                finally:
+                    data.close()
+        finally:
+            for thread in pending:
+                thread.kill()
+
+    def _get_segment(self, location, container, name, context, offset=0,
+                     length=None):
+        connection = self._acquire_connection(location, context)
+        resp_headers, resp_body = self._get_object(connection, container,
+                                                   name, offset, length)
+        data = tempfile.SpooledTemporaryFile(max_size=SEGMENT_SPOOL_SIZE)
+        try:
+            for chunk in resp_body:
+                data.write(chunk)
+        except BaseException:
+            data.close()
+            raise
+        self._release_connection(location, connection)
+        data.seek(0)
+        return data
+
+    def get_size(self, location, connection=None, context=None):
         location = location.store_location
-        if not connection:
-            connection = self.get_connection(location)
+        pooled = not connection
+        if pooled:
+            connection = self._acquire_connection(location, context)
         try:
             resp_headers = connection.head_object(
                     container=location.container, obj=location.obj)
             return int(resp_headers.get('content-length', 0))
         except Exception:
             return 0
+        finally:
+            if pooled:
+                self._release_connection(location, connection)
 
     def _option_get(self, param):
         result = getattr(CONF, param)
@@ -276,10 +470,12 @@ class BaseStore(glance.store.base.Store):
                                                   reason=reason)
         return result
 
-    def add(self, image_id, image_file, image_size, connection=None):
-        location = self.create_location(image_id)
-        if not connection:
-            connection = self.get_connection(location)
+    def add(self, image_id, image_file, image_size, connection=None,
+            context=None):
+        location = self.create_location(image_id, context=context)
+        pooled = not connection
+        if pooled:
+            connection = self._acquire_connection(location, context)
 
         self._create_container_if_missing(location.container, connection)
 
@@ -294,7 +490,6 @@ class BaseStore(glance.store.base.Store):
                                                  content_length=image_size)
             else:
                 # Write the image into Swift in chunks.
-                chunk_id = 1
                 if image_size > 0:
                     total_chunks = str(int(
                         math.ceil(float(image_size) /
@@ -307,42 +502,15 @@ class BaseStore(glance.store.base.Store):
                                 "segmented object to Swift."))
                     total_chunks = '?'
 
-                checksum = hashlib.md5()
-                combined_chunks_size = 0
-                while True:
-                    chunk_size = self.large_object_chunk_size
-                    if image_size == 0:
-                        content_length = None
-                    else:
-                        left = image_size - combined_chunks_size
-                        if left == 0:
-                            break
-                        if chunk_size > left:
-                            chunk_size = left
-                        content_length = chunk_size
-
-                    chunk_name = "%s-%05d" % (location.obj, chunk_id)
-                    reader = ChunkReader(image_file, checksum, chunk_size)
-                    chunk_etag = connection.put_object(
-                        location.container, chunk_name, reader,
-                        content_length=content_length)
-                    bytes_read = reader.bytes_read
-                    msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
-                            "%(total_chunks)s) of length %(bytes_read)d "
-                            "to Swift returning MD5 of content: "
-                            "%(chunk_etag)s")
-                    LOG.debug(msg % locals())
-
-                    if bytes_read == 0:
-                        # Delete the last chunk, because it's of zero size.
-                        # This will happen if size == 0.
-                        LOG.debug(_("Deleting final zero-length chunk"))
-                        connection.delete_object(location.container,
-                                                 chunk_name)
-                        break
-
-                    chunk_id += 1
-                    combined_chunks_size += bytes_read
+                checksum = utils.ThreadedHasher(hashlib.md5())
+                if pooled and self.upload_concurrency > 1:
+                    combined_chunks_size = self._add_segments_concurrently(
+                            location, image_file, image_size, checksum,
+                            total_chunks, context)
+                else:
+                    combined_chunks_size = self._add_segments(
+                            location, image_file, image_size, checksum,
+                            total_chunks, connection)
 
                 # In the case we have been given an unknown image size,
                 # set the size to the total size of the combined chunks.
@@ -370,6 +538,8 @@ class BaseStore(glance.store.base.Store):
             # the location attribute from GET /images/<ID> and
             # GET /images/details
 
+            if pooled:
+                self._release_connection(location, connection)
             return (location.get_uri(), image_size, obj_etag)
         except swiftclient.ClientException, e:
             if e.http_status == httplib.CONFLICT:
@@ -380,10 +550,123 @@ class BaseStore(glance.store.base.Store):
             LOG.error(msg)
             raise glance.store.BackendException(msg)
 
-    def delete(self, location, connection=None):
+    def _add_segments(self, location, image_file, image_size, checksum,
+                      total_chunks, connection):
+        """
+        Writes the image into Swift one segment after another, streaming
+        each segment straight from the image file.
+
+        :retval the number of bytes written
+        """
+        chunk_id = 1
+        combined_chunks_size = 0
+        while True:
+            chunk_size = self.large_object_chunk_size
+            if image_size == 0:
+                content_length = None
+            else:
+                left = image_size - combined_chunks_size
+                if left == 0:
+                    break
+                if chunk_size > left:
+                    chunk_size = left
+                content_length = chunk_size
+
+            chunk_name = "%s-%05d" % (location.obj, chunk_id)
+            reader = ChunkReader(image_file, checksum, chunk_size)
+            chunk_etag = connection.put_object(
+                location.container, chunk_name, reader,
+                content_length=content_length)
+            bytes_read = reader.bytes_read
+            msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
+                    "%(total_chunks)s) of length %(bytes_read)d "
+                    "to Swift returning MD5 of content: "
+                    "%(chunk_etag)s")
+            LOG.debug(msg % locals())
+
+            if bytes_read == 0:
+                # Delete the last chunk, because it's of zero size.
+                # This will happen if size == 0.
+                LOG.debug(_("Deleting final zero-length chunk"))
+                connection.delete_object(location.container,
+                                         chunk_name)
+                break
+
+            chunk_id += 1
+            combined_chunks_size += bytes_read
+        return combined_chunks_size
+
+    def _add_segments_concurrently(self, location, image_file, image_size,
+                                   checksum, total_chunks, context):
+        """
+        Writes the image into Swift with up to
+        ``swift_store_large_object_upload_concurrency`` segments being
+        uploaded at the same time. Each segment is read from the image
+        file in order (so the checksum still covers the whole image) into
+        a spooled buffer and then handed to a green thread that PUTs it
+        using its own connection.
+
+        :retval the number of bytes written
+        """
+        pool = eventlet.GreenPool(self.upload_concurrency)
+        errors = []
+        chunk_id = 1
+        combined_chunks_size = 0
+        while not errors:
+            chunk_size = self.large_object_chunk_size
+            if image_size != 0:
+                left = image_size - combined_chunks_size
+                if left == 0:
+                    break
+                if chunk_size > left:
+                    chunk_size = left
+
+            segment = tempfile.SpooledTemporaryFile(
+                    max_size=SEGMENT_SPOOL_SIZE)
+            reader = ChunkReader(image_file, checksum, chunk_size)
+            for data in utils.chunkiter(reader, self.stream_chunk_size):
+                segment.write(data)
+            bytes_read = reader.bytes_read
+            if bytes_read == 0:
+                segment.close()
+                break
+            segment.seek(0)
+
+            chunk_name = "%s-%05d" % (location.obj, chunk_id)
+            pool.spawn_n(self._put_segment, location, chunk_name,
+                         chunk_id, total_chunks, segment, bytes_read,
+                         errors, context)
+            chunk_id += 1
+            combined_chunks_size += bytes_read
+
+        pool.waitall()
+        if errors:
+            raise errors[0]
+        return combined_chunks_size
+
+    def _put_segment(self, location, chunk_name, chunk_id, total_chunks,
+                     segment, bytes_read, errors, context):
+        try:
+            connection = self._acquire_connection(location, context)
+            chunk_etag = connection.put_object(
+                location.container, chunk_name, segment,
+                content_length=bytes_read)
+            self._release_connection(location, connection)
+            msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
+                    "%(total_chunks)s) of length %(bytes_read)d "
+                    "to Swift returning MD5 of content: "
+                    "%(chunk_etag)s")
+            LOG.debug(msg % locals())
+        except Exception, e:
+            errors.append(e)
+        finally:
+            segment.close()
+
+    def delete(self, location, connection=None, context=None):
         location = location.store_location
-        if not connection:
-            connection = self.get_connection(location)
+        pooled = not connection
+        if pooled:
+            connection = self._acquire_connection(location, context)
 
         try:
             # We request the manifest for the object. If one exists,
@@ -400,20 +683,19 @@ class BaseStore(glance.store.base.Store):
                     raise
             if manifest:
                 # Delete all the chunks before the object manifest itself
-                obj_container, obj_prefix = manifest.split('/', 1)
+                obj_container, obj_prefix = self._parse_manifest(manifest)
                 segments = connection.get_container(
-                        obj_container, prefix=obj_prefix)[1]
-                for segment in segments:
-                    # TODO(jaypipes): This would be an easy area to parallelize
-                    # since we're simply sending off parallelizable requests
-                    # to Swift to delete stuff. It's not like we're going to
-                    # be hogging up network or file I/O here...
-                    connection.delete_object(
-                            obj_container, segment['name'])
+                        obj_container, prefix=obj_prefix,
+                        full_listing=True)[1]
+                self._delete_segments(location, obj_container,
+                                      [s['name'] for s in segments],
+                                      connection, context)
 
             else:
                 connection.delete_object(location.container, location.obj)
 
+            if pooled:
+                self._release_connection(location, connection)
         except swiftclient.ClientException, e:
             if e.http_status == httplib.NOT_FOUND:
                 uri = location.get_uri()
@@ -422,6 +704,136 @@ class BaseStore(glance.store.base.Store):
             else:
                 raise
 
+    def _delete_segments(self, location, container, names, connection,
+                         context):
+        """
+        Deletes the segments of a large object. When the Swift cluster
+        advertises the bulk delete middleware the segments are removed
+        with as few requests as possible, and any segment that could not
+        be removed that way is deleted individually, up to
+        ``swift_store_delete_concurrency`` at a time. Individual deletes
+        are retried up to DELETE_RETRIES times.
+        """
+        if len(names) > 1 and self.use_bulk_delete:
+            names = self._bulk_delete(connection, container, names)
+
+        if self.delete_concurrency > 1 and len(names) > 1:
+            pool = eventlet.GreenPool(self.delete_concurrency)
+            errors = []
+            for name in names:
+                pool.spawn_n(self._delete_segment, location, container,
+                             name, errors, context)
+            pool.waitall()
+            if errors:
+                raise errors[0]
+        else:
+            for name in names:
+                self._delete_object(connection, container, name)
+
+    def _delete_segment(self, location, container, name, errors, context):
+        try:
+            connection = self._acquire_connection(location, context)
+            self._delete_object(connection, container, name)
+            self._release_connection(location, connection)
+        except Exception, e:
+            errors.append(e)
+
+    def _delete_object(self, connection, container, name):
+        """
+        Deletes an object, trying again up to DELETE_RETRIES times if
+        that fails. An object which is already gone counts as deleted.
+        """
+        attempt = 0
+        while True:
+            try:
+                connection.delete_object(container, name)
+                return
+            except Exception, e:
+                if (isinstance(e, swiftclient.ClientException) and
+                        e.http_status == httplib.NOT_FOUND):
+                    return
+                attempt += 1
+                if attempt > DELETE_RETRIES:
+                    raise
+                LOG.warn(_("Failed to delete %(container)s/%(name)s from "
+                           "Swift, retrying: %(e)s") % locals())
+
+    def _get_bulk_delete_limit(self, connection):
+        """
+        Returns the maximum number of objects the cluster behind the
+        connection accepts in a single bulk delete, or None if it does
+        not support bulk deletes. The answer is cached per cluster.
+        """
+        if not connection.url:
+            return None
+        parsed = urlparse.urlparse(connection.url)
+        if parsed.netloc not in self.bulk_delete_limits:
+            limit = None
+            info_url = '%s://%s/info' % (parsed.scheme, parsed.netloc)
+            try:
+                info_parsed, conn = swiftclient.client.http_connection(
+                        info_url)
+                conn.request('GET', info_parsed.path, '', {})
+                resp = conn.getresponse()
+                body = resp.read()
+                if resp.status == httplib.OK:
+                    bulk_delete = json.loads(body).get('bulk_delete')
+                    if bulk_delete is not None:
+                        limit = bulk_delete.get('max_deletes_per_request',
+                                                DEFAULT_BULK_DELETE_LIMIT)
+            except Exception, e:
+                LOG.debug(_("Unable to determine whether Swift at "
+                            "%(url)s supports bulk deletes: %(e)s") %
+                          {'url': info_url, 'e': e})
+            self.bulk_delete_limits[parsed.netloc] = limit
+        return self.bulk_delete_limits[parsed.netloc]
+
+    def _bulk_delete(self, connection, container, names):
+        """
+        Deletes objects using the Swift bulk delete middleware.
+
+        :retval a list of the names that still need to be deleted
+        """
+        limit = self._get_bulk_delete_limit(connection)
+        if not limit:
+            return names
+
+        remaining = []
+        for start in xrange(0, len(names), limit):
+            batch = names[start:start + limit]
+            paths = dict((urllib.quote('/%s/%s' % (container, name)), name)
+                         for name in batch)
+            try:
+                parsed, conn = swiftclient.client.http_connection(
+                        connection.url)
+                headers = {'X-Auth-Token': connection.token,
+                           'Content-Type': 'text/plain',
+                           'Accept': 'application/json'}
+                conn.request('DELETE', parsed.path + '?bulk-delete',
+                             '\n'.join(paths.keys()), headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                if resp.status != httplib.OK:
+                    remaining.extend(batch)
+                    continue
+                result = json.loads(body)
+            except Exception, e:
+                LOG.debug(_("Bulk delete failed, falling back to deleting "
+                            "segments individually: %s") % e)
+                remaining.extend(batch)
+                continue
+            # NOTE: The middleware may answer 200 and report the actual
+            # outcome of the request in the body
+            status = result.get('Response Status', '200 OK')
+            if not status.startswith('2'):
+                LOG.debug(_("Bulk delete failed with %s, falling back to "
+                            "deleting segments individually") % status)
+                remaining.extend(batch)
+                continue
+            for path, status in result.get('Errors', []):
+                remaining.append(paths.get(path, urllib.unquote(path)))
+        return remaining
+
     def _create_container_if_missing(self, container, connection):
         """
         Creates a missing container in Swift if the
@@ -451,10 +863,21 @@ class BaseStore(glance.store.base.Store):
             else:
                 raise
 
-    def get_connection(self):
+    def _acquire_connection(self, location, context=None):
+        """
+        Returns a connection to use for a single store operation. Once the
+        operation has completed successfully the connection is handed back
+        through _release_connection() so that it may be reused.
+        """
+        return self.get_connection(location, context=context)
+
+    def _release_connection(self, location, connection):
+        pass
+
+    def get_connection(self, location, context=None):
         raise NotImplemented()
 
-    def create_location(self):
+    def create_location(self, image_id, context=None):
         raise NotImplemented()
 
 
@@ -464,6 +887,8 @@ class SingleTenantStore(BaseStore):
     def configure(self):
         super(SingleTenantStore, self).configure()
         self.auth_version = self._option_get('swift_store_auth_version')
+        self.connection_pool = ConnectionPool(
+                CONF.swift_store_max_idle_connections)
 
     def configure_add(self):
         self.auth_address = self._option_get('swift_store_auth_address')
@@ -475,7 +900,7 @@ class SingleTenantStore(BaseStore):
         self.user = self._option_get('swift_store_user')
         self.key = self._option_get('swift_store_key')
 
-    def create_location(self, image_id):
+    def create_location(self, image_id, context=None):
         specs = {'scheme': self.scheme,
                  'container': self.container,
                  'obj': str(image_id),
@@ -484,7 +909,21 @@ class SingleTenantStore(BaseStore):
                  'key': self.key}
         return StoreLocation(specs)
 
-    def get_connection(self, location):
+    def _get_pool_key(self, location):
+        return (location.swift_url, location.user, location.key, self.region)
+
+    def _acquire_connection(self, location, context=None):
+        key = self._get_pool_key(location)
+        connection = self.connection_pool.get(key)
+        if connection is None:
+            connection = self.get_connection(location, context=context)
+        return connection
+
+    def _release_connection(self, location, connection):
+        key = self._get_pool_key(location)
+        self.connection_pool.put(key, connection)
+
+    def get_connection(self, location, context=None):
         if not location.user:
             reason = (_("Location is missing user:password information."))
             LOG.debug(reason)
@@ -521,36 +960,87 @@ class SingleTenantStore(BaseStore):
 class MultiTenantStore(BaseStore):
     EXAMPLE_URL = "swift://<SWIFT_URL>/<CONTAINER>/<FILE>"
 
+    def configure(self):
+        super(MultiTenantStore, self).configure()
+        # NOTE: Locations created before multi-tenant storage was enabled
+        # still carry their own credentials, so they are handed off to a
+        # single-tenant store rather than being accessed with the
+        # requesting user's token.
+        self.single_tenant_store = None
+
     def configure_add(self):
         self.container = CONF.swift_store_container
-        if self.context is None:
+        self.storage_url = None
+        self.scheme = None
+        if self.context is not None:
+            self.storage_url, self.scheme = self._get_storage_url(
+                    self.context)
+
+    def _get_storage_url(self, context):
+        if context is None:
             reason = _("Multi-tenant Swift storage requires a context.")
             raise exception.BadStoreConfiguration(store_name="swift",
                                                   reason=reason)
-        if self.context.service_catalog is None:
+        if context.service_catalog is None:
             reason = _("Multi-tenant Swift storage requires "
                        "a service catalog.")
             raise exception.BadStoreConfiguration(store_name="swift",
                                                   reason=reason)
-        self.storage_url = auth.get_endpoint(
-                self.context.service_catalog, service_type=self.service_type,
+        storage_url = auth.get_endpoint(
+                context.service_catalog, service_type=self.service_type,
                 endpoint_region=self.region, endpoint_type=self.endpoint_type)
-        if self.storage_url.startswith('http://'):
-            self.scheme = 'swift+http'
+        if storage_url.startswith('http://'):
+            scheme = 'swift+http'
         else:
-            self.scheme = 'swift+https'
-
-    def delete(self, location, connection=None):
+            scheme = 'swift+https'
+        return storage_url, scheme
+
+    def _get_single_tenant_store(self, location):
+        if location.store_location.user is None:
+            return None
+        if self.single_tenant_store is None:
+            self.single_tenant_store = SingleTenantStore()
+        return self.single_tenant_store
+
+    def get(self, location, connection=None, context=None, offset=0,
+            length=None):
+        store = self._get_single_tenant_store(location)
+        if store is not None:
+            return store.get(location, connection, offset=offset,
+                             length=length)
+        return super(MultiTenantStore, self).get(location, connection,
+                                                 context=context,
+                                                 offset=offset, length=length)
+
+    def get_size(self, location, connection=None, context=None):
+        store = self._get_single_tenant_store(location)
+        if store is not None:
+            return store.get_size(location, connection)
+        return super(MultiTenantStore, self).get_size(location, connection,
+                                                      context=context)
+
+    def delete(self, location, connection=None, context=None):
+        store = self._get_single_tenant_store(location)
+        if store is not None:
+            return store.delete(location, connection)
         if not connection:
-            connection = self.get_connection(location.store_location)
-        super(MultiTenantStore, self).delete(location, connection)
+            connection = self.get_connection(location.store_location,
+                                             context=context)
+        super(MultiTenantStore, self).delete(location, connection,
+                                             context=context)
         connection.delete_container(location.store_location.container)
 
     def set_acls(self, location, public=False, read_tenants=None,
-                 write_tenants=None, connection=None):
+                 write_tenants=None, connection=None, context=None):
+        store = self._get_single_tenant_store(location)
+        if store is not None:
+            return store.set_acls(location, public=public,
+                                  read_tenants=read_tenants,
+                                  write_tenants=write_tenants,
+                                  context=context)
         location = location.store_location
         if not connection:
-            connection = self.get_connection(location)
+            connection = self.get_connection(location, context=context)
 
         if read_tenants is None:
             read_tenants = []
@@ -581,22 +1071,147 @@ class MultiTenantStore(BaseStore):
             else:
                 raise
 
-    def create_location(self, image_id):
-        specs = {'scheme': self.scheme,
+    def create_location(self, image_id, context=None):
+        if context is not None:
+            storage_url, scheme = self._get_storage_url(context)
+        elif self.storage_url is not None:
+            storage_url, scheme = self.storage_url, self.scheme
+        else:
+            raise exception.StoreAddDisabled()
+        specs = {'scheme': scheme,
                  'container': self.container + '_' + str(image_id),
                  'obj': str(image_id),
-                 'auth_or_store_url': self.storage_url}
+                 'auth_or_store_url': storage_url}
         return StoreLocation(specs)
 
-    def get_connection(self, location):
+    def get_connection(self, location, context=None):
+        context = context or self.context
+        if context is None:
+            reason = _("Multi-tenant Swift storage requires a context.")
+            raise exception.BadStoreConfiguration(store_name="swift",
+                                                  reason=reason)
         return swiftclient.Connection(
-                None, self.context.user, None,
+                None, context.user, None,
                 preauthurl=location.swift_url,
-                preauthtoken=self.context.auth_tok,
-                tenant_name=self.context.tenant,
+                preauthtoken=context.auth_tok,
+                tenant_name=context.tenant,
                 auth_version='2', snet=self.snet)
 
 
+def _get_object_range(url, token, container, name, offset, length,
+                      http_conn=None, resp_chunk_size=None):
+    """
+    Gets length bytes from offset of an object, or all of it from offset
+    if length is None, with a single ranged GET. The arguments and the
+    return value are those of swiftclient.client.get_object(), except
+    that the content-length header is the size of the range.
+
+    :raises ClientException: HTTP GET request failed
+    """
+    if length == 0:
+        return {'content-length': '0'}, iter([])
+    if http_conn:
+        parsed, conn = http_conn
+    else:
+        parsed, conn = swiftclient.client.http_connection(url)
+    path = '%s/%s/%s' % (parsed.path, urllib.quote(container),
+                         urllib.quote(name))
+    end = '' if length is None else str(offset + length - 1)
+    headers = {'X-Auth-Token': token,
+               'Range': 'bytes=%d-%s' % (offset, end)}
+    conn.request('GET', path, '', headers)
+    resp = conn.getresponse()
+    if resp.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+        # The offset is at or past the end of the object
+        resp.read()
+        return {'content-length': '0'}, iter([])
+    if resp.status < 200 or resp.status >= 300:
+        body = resp.read()
+        raise swiftclient.ClientException('Object GET failed',
+                                          http_scheme=parsed.scheme,
+                                          http_path=path,
+                                          http_status=resp.status,
+                                          http_reason=resp.reason,
+                                          http_response_content=body)
+    resp_headers = dict((header.lower(), value)
+                        for header, value in resp.getheaders())
+
+    def _object_body():
+        buf = resp.read(resp_chunk_size)
+        while buf:
+            yield buf
+            buf = resp.read(resp_chunk_size)
+
+    object_body = _object_body()
+    if resp.status != httplib.PARTIAL_CONTENT:
+        # The Range header was ignored and the whole object is coming
+        size = int(resp_headers.get('content-length', 0))
+        range_end = size if length is None else min(offset + length, size)
+        resp_headers['content-length'] = str(max(range_end - offset, 0))
+        object_body = utils.slice_iter(object_body, offset, length)
+    return resp_headers, object_body
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle Swift connections for reuse, grouped by the credentials
+    they were created with. A swiftclient Connection caches its auth
+    token and storage URL after the first request and re-authenticates
+    by itself when Swift answers 401, so a reused connection normally
+    goes straight to Swift without contacting the auth service.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self.idle = {}
+
+    def get(self, key):
+        """Returns an idle connection for the key, or None"""
+        connections = self.idle.get(key)
+        if connections:
+            return connections.pop()
+        return None
+
+    def put(self, key, connection):
+        """Makes a connection available for reuse"""
+        connections = self.idle.setdefault(key, [])
+        if len(connections) < self.max_idle:
+            connections.append(connection)
+
+
+class ReleasingIterator(object):
+    """
+    Iterates over an object body, calling `release` once the body has
+    been read to the end so that its connection can be reused. A body
+    that is only partially read leaves the connection unusable, so in
+    that case the connection is simply dropped.
+    """
+
+    def __init__(self, wrapped, release):
+        self.wrapped = wrapped
+        self.release = release
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self.wrapped.next()
+        except StopIteration:
+            if self.release:
+                self.release()
+                self.release = None
+            raise
+
+    @property
+    def len(self):
+        return self.wrapped.len
+
+    def getvalue(self):
+        """Return entire string value... used in testing"""
+        return self.wrapped.getvalue()
+
+
 class ChunkReader(object):
     def __init__(self, fd, checksum, total):
         self.fd = fd
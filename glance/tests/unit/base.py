@@ -60,6 +60,10 @@ class IsolatedUnitTest(StoreClearingUnitTest):
                     default_store='filesystem',
                     filesystem_store_datadir=os.path.join(self.test_dir),
                     policy_file=policy_file)
+        # Stores are configured once when they are created, so rebuild
+        # them now that the test configuration is in place
+        location.SCHEME_TO_CLS_MAP = {}
+        store.create_stores()
         stubs.stub_out_registry_and_store_server(self.stubs, self.test_dir)
         self.addCleanup(self.stubs.UnsetAll)
 
@@ -13,6 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+import StringIO
+
 import stubout
 import testtools
 import webob
@@ -81,8 +84,10 @@ class TestCacheMiddlewareRequestStashCacheInfo(testtools.TestCase):
 class ChecksumTestCacheFilter(glance.api.middleware.cache.CacheFilter):
     def __init__(self):
         class DummyCache(object):
-            def get_caching_iter(self, image_id, image_checksum, app_iter):
+            def get_caching_iter(self, image_id, image_checksum, app_iter,
+                                 image_size=None):
                 self.image_checksum = image_checksum
+                self.image_size = image_size
 
         self.cache = DummyCache()
 
@@ -114,6 +119,24 @@ class TestCacheMiddlewareChecksumVerification(testtools.TestCase):
 
         self.assertEqual(None, cache_filter.cache.image_checksum)
 
+    def test_image_size_header(self):
+        cache_filter = ChecksumTestCacheFilter()
+        headers = {"x-image-meta-size": "1024"}
+        resp = webob.Response(headers=headers)
+        cache_filter._process_GET_response(resp, None)
+
+        self.assertEqual(1024, cache_filter.cache.image_size)
+
+    def test_partial_response_not_cached(self):
+        cache_filter = ChecksumTestCacheFilter()
+        request = webob.Request.blank('/v1/images/test1')
+        cache_filter._stash_request_info(request, 'test1', 'GET')
+        headers = {"x-image-meta-checksum": "1234567890"}
+        resp = webob.Response(request=request, status=206, headers=headers)
+        cache_filter.process_response(resp)
+
+        self.assertFalse(hasattr(cache_filter.cache, 'image_checksum'))
+
 
 class ProcessRequestTestCacheFilter(glance.api.middleware.cache.CacheFilter):
     def __init__(self):
@@ -124,7 +147,8 @@ class ProcessRequestTestCacheFilter(glance.api.middleware.cache.CacheFilter):
             def is_cached(self, image_id):
                 return True
 
-            def get_caching_iter(self, image_id, image_checksum, app_iter):
+            def get_caching_iter(self, image_id, image_checksum, app_iter,
+                                 image_size=None):
                 pass
 
             def delete_cached_image(self, image_id):
@@ -133,6 +157,43 @@ class ProcessRequestTestCacheFilter(glance.api.middleware.cache.CacheFilter):
         self.cache = DummyCache()
 
 
+class TestCachedImageFile(testtools.TestCase):
+    def setUp(self):
+        super(TestCachedImageFile, self).setUp()
+        self.reads = []
+
+        class DummyCache(object):
+            @contextlib.contextmanager
+            def open_for_read(cache, image_id):
+                yield StringIO.StringIO('data for %s' % image_id)
+                self.reads.append(image_id)
+
+        self.cache = DummyCache()
+
+    def test_iterate(self):
+        image_file = glance.api.middleware.cache.CachedImageFile(self.cache,
+                                                                 'test1')
+        self.assertEqual(self.reads, [])
+        self.assertEqual(''.join(image_file), 'data for test1')
+        self.assertEqual(self.reads, ['test1'])
+
+    def test_iterate_range(self):
+        image_file = glance.api.middleware.cache.CachedImageFile(self.cache,
+                                                                 'test1')
+        image_file.set_range(5, 3)
+        self.assertEqual(''.join(image_file), 'for')
+        self.assertEqual(self.reads, ['test1'])
+
+    def test_read_and_close(self):
+        image_file = glance.api.middleware.cache.CachedImageFile(self.cache,
+                                                                 'test1')
+        self.assertEqual(image_file.read(4), 'data')
+        self.assertEqual(self.reads, [])
+        image_file.close()
+        image_file.close()
+        self.assertEqual(self.reads, ['test1'])
+
+
 class TestCacheMiddlewareProcessRequest(testtools.TestCase):
     def setUp(self):
         super(TestCacheMiddlewareProcessRequest, self).setUp()
@@ -176,3 +237,38 @@ class TestCacheMiddlewareProcessRequest(testtools.TestCase):
                        fake_process_v1_request)
         cache_filter.process_request(request)
         self.assertTrue(image_id in cache_filter.cache.deleted_images)
+
+    def test_process_request_follows_cache_fill(self):
+        """
+        Test that a request for an image which is being cached is served
+        from the cache fill, unless it only asks for part of the image.
+        """
+        class DummyFill(object):
+            def __iter__(self):
+                return iter(['data'])
+
+        fill = DummyFill()
+
+        class DummyCache(object):
+            def is_cached(self, image_id):
+                return False
+
+            def open_cache_fill(self, image_id):
+                return fill if image_id == 'test1' else None
+
+            def get_image_size(self, image_id):
+                return None
+
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter.cache = DummyCache()
+
+        request = webob.Request.blank('/v2/images/test1/file')
+        response = cache_filter.process_request(request)
+        self.assertTrue(response.app_iter is fill)
+
+        request = webob.Request.blank('/v2/images/test2/file')
+        self.assertEqual(None, cache_filter.process_request(request))
+
+        request = webob.Request.blank('/v2/images/test1/file',
+                                      headers={'Range': 'bytes=0-1'})
+        self.assertEqual(None, cache_filter.process_request(request))
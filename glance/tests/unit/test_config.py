@@ -26,6 +26,25 @@ from glance.common import config
 from glance.tests import utils as test_utils
 
 
+class TestParseArgs(test_utils.BaseTestCase):
+
+    def _parse_config(self, contents):
+        temp_dir = self.useFixture(fixtures.TempDir()).path
+        temp_file = os.path.join(temp_dir, 'testcfg.conf')
+        with open(temp_file, 'wb') as f:
+            f.write('[DEFAULT]\n' + contents)
+        config.parse_args(['--config-file', temp_file])
+
+    def test_image_chunk_size(self):
+        self._parse_config('image_chunk_size = 131072\n')
+        self.assertEqual(131072, config.CONF.image_chunk_size)
+
+    def test_image_chunk_size_not_positive(self):
+        for chunk_size in ('0', '-1'):
+            self.assertRaises(RuntimeError, self._parse_config,
+                              'image_chunk_size = %s\n' % chunk_size)
+
+
 class TestPasteApp(test_utils.BaseTestCase):
 
     def setUp(self):
@@ -18,11 +18,14 @@
 """Tests the filesystem backend store"""
 
 import errno
+import fcntl
 import hashlib
+import os
 import StringIO
 
 from glance.common import exception
 from glance.openstack.common import uuidutils
+import glance.store.filesystem
 from glance.store.filesystem import Store, ChunkedFile
 from glance.store.location import get_location_from_uri
 from glance.tests.unit import base
@@ -70,6 +73,21 @@ class TestStore(base.IsolatedUnitTest):
         self.assertEqual(expected_data, data)
         self.assertEqual(expected_num_chunks, num_chunks)
 
+    def test_get_range(self):
+        """Test reading part of an image"""
+        image_id = uuidutils.generate_uuid()
+        image_file = StringIO.StringIO("chunk00000remainder")
+        location, size, checksum = self.store.add(image_id, image_file, 19)
+
+        loc = get_location_from_uri(location)
+        (image_file, image_size) = self.store.get(loc, offset=5, length=8)
+        self.assertEqual(8, image_size)
+        self.assertEqual('00000rem', ''.join(image_file))
+
+        (image_file, image_size) = self.store.get(loc, offset=10)
+        self.assertEqual(9, image_size)
+        self.assertEqual('remainder', ''.join(image_file))
+
     def test_get_non_existing(self):
         """
         Test that trying to retrieve a file that doesn't exist
@@ -132,6 +150,59 @@ class TestStore(base.IsolatedUnitTest):
                           self.store.add,
                           image_id, image_file, 0)
 
+    def test_add_replaces_stale_partial_file(self):
+        """
+        Tests that a partial file left behind by a writer that died does
+        not prevent the image from being added
+        """
+        image_id = uuidutils.generate_uuid()
+        tmp_filepath = os.path.join(self.test_dir, '.%s.partial' % image_id)
+        with open(tmp_filepath, 'wb') as f:
+            f.write("stale data that is longer than the image")
+
+        file_contents = "*" * 1024
+        location, size, checksum = self.store.add(
+                image_id, StringIO.StringIO(file_contents), len(file_contents))
+
+        self.assertEqual(len(file_contents), size)
+        self.assertFalse(os.path.exists(tmp_filepath))
+        filepath = os.path.join(self.test_dir, image_id)
+        self.assertEqual(file_contents, open(filepath).read())
+
+    def test_add_partial_file_being_written(self):
+        """
+        Tests that an image whose partial file is locked by another writer
+        is reported as a duplicate and the partial file left alone
+        """
+        image_id = uuidutils.generate_uuid()
+        tmp_filepath = os.path.join(self.test_dir, '.%s.partial' % image_id)
+        with open(tmp_filepath, 'wb') as f:
+            f.write("in progress")
+            f.flush()
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            self.assertRaises(exception.Duplicate, self.store.add,
+                              image_id, StringIO.StringIO("new data"), 8)
+            self.assertEqual("in progress", open(tmp_filepath).read())
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir,
+                                                     image_id)))
+
+    def test_add_lock_failure_closes_partial_file(self):
+        """
+        Tests that the partial file is closed when it cannot be locked
+        """
+        opened = []
+
+        def fake_flock(fd, operation):
+            opened.append(fd)
+            raise IOError(errno.ENOLCK, 'No locks available')
+
+        self.stubs.Set(glance.store.filesystem.fcntl, 'flock', fake_flock)
+        self.assertRaises(IOError, self.store.add,
+                          uuidutils.generate_uuid(),
+                          StringIO.StringIO("data"), 4)
+        self.assertEqual(1, len(opened))
+        self.assertRaises(OSError, os.fstat, opened[0])
+
     def _do_test_add_failure(self, errno, exception):
         ChunkedFile.CHUNKSIZE = 1024
         image_id = uuidutils.generate_uuid()
@@ -149,6 +220,136 @@ class TestStore(base.IsolatedUnitTest):
         self.assertRaises(exception,
                           self.store.add,
                           image_id, image_file, 0)
+        self.assertEqual(os.listdir(self.test_dir), ['policy.json'])
+
+    def test_add_publishes_complete_file(self):
+        """
+        Tests that image data is written under a temporary name and only
+        appears under the image's own name once it is complete
+        """
+        image_id = uuidutils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        image_file = StringIO.StringIO(file_contents)
+        filepath = os.path.join(self.test_dir, image_id)
+        tmp_filepath = os.path.join(self.test_dir, '.%s.partial' % image_id)
+        real_read = image_file.read
+
+        def fake_read(size):
+            self.assertFalse(os.path.exists(filepath))
+            self.assertTrue(os.path.exists(tmp_filepath))
+            return real_read(size)
+
+        self.stubs.Set(image_file, 'read', fake_read)
+        location, size, checksum = self.store.add(image_id, image_file,
+                                                  len(file_contents))
+
+        self.assertEqual("file://%s" % filepath, location)
+        self.assertFalse(os.path.exists(tmp_filepath))
+        self.assertEqual(file_contents, open(filepath).read())
+
+    def test_add_fsync_full(self):
+        """
+        Tests that both the image file and the data directory are synced
+        when the fsync policy is 'full'
+        """
+        self.config(filesystem_store_fsync='full')
+        self.store = Store()
+        synced = []
+        self.stubs.Set(os, 'fsync', synced.append)
+
+        image_id = uuidutils.generate_uuid()
+        image_file = StringIO.StringIO("chunk00000remainder")
+        self.store.add(image_id, image_file, 19)
+
+        self.assertEqual(len(synced), 2)
+
+    def test_add_bad_fsync_policy(self):
+        """
+        Tests that an unknown fsync policy disables adding images
+        """
+        self.config(filesystem_store_fsync='sometimes')
+        self.store = Store()
+        self.assertEqual(self.store.add, self.store.add_disabled)
+
+    def _configure_datadirs(self, free_space, weights=None):
+        weights = weights or {}
+        datadirs = []
+        for name in sorted(free_space):
+            datadirs.append('%s:%d' % (os.path.join(self.test_dir, name),
+                                       weights.get(name, 1)))
+        self.config(filesystem_store_datadir=None,
+                    filesystem_store_datadirs=datadirs)
+
+        def fake_get_free_space(path):
+            return free_space[os.path.basename(path)]
+
+        self.stubs.Set(glance.store.filesystem, '_get_free_space',
+                       fake_get_free_space)
+        self.store = Store()
+
+    def _add_image(self, image_size=19):
+        image_id = uuidutils.generate_uuid()
+        image_file = StringIO.StringIO("chunk00000remainder")
+        location, size, checksum = self.store.add(image_id, image_file,
+                                                  image_size)
+        return image_id, location
+
+    def test_add_datadirs_by_weighted_free_space(self):
+        """
+        Tests that images go to the data directory with the most weighted
+        free space and can be read back from there
+        """
+        self._configure_datadirs({'a': 1000, 'b': 600}, {'b': 2})
+
+        image_id, location = self._add_image()
+
+        self.assertEqual(location, "file://%s/b/%s" % (self.test_dir,
+                                                       image_id))
+        (image_file, image_size) = self.store.get(
+            get_location_from_uri(location))
+        self.assertEqual("chunk00000remainder", ''.join(image_file))
+
+    def test_add_datadirs_spreads_write_load(self):
+        """
+        Tests that uploads in progress count against a data directory
+        """
+        self._configure_datadirs({'a': 1000, 'b': 600})
+        self.store.active_writes[os.path.join(self.test_dir, 'a')] = 1
+
+        image_id, location = self._add_image()
+
+        self.assertTrue(location.startswith("file://%s/b/" % self.test_dir))
+
+    def test_add_datadirs_skips_full_directories(self):
+        """
+        Tests that a data directory without room for the image is not used,
+        and that the store is full when no directory has room
+        """
+        self._configure_datadirs({'a': 10, 'b': 20})
+        image_id, location = self._add_image(15)
+        self.assertTrue(location.startswith("file://%s/b/" % self.test_dir))
+
+        self.assertRaises(exception.StorageFull, self._add_image, 25)
+
+    def test_add_datadirs_already_existing(self):
+        """
+        Tests that an image already in any data directory is a duplicate
+        """
+        self._configure_datadirs({'a': 1000, 'b': 600})
+        image_id = uuidutils.generate_uuid()
+        open(os.path.join(self.test_dir, 'b', image_id), 'w').close()
+
+        image_file = StringIO.StringIO("chunk00000remainder")
+        self.assertRaises(exception.Duplicate, self.store.add, image_id,
+                          image_file, 19)
+
+    def test_datadir_and_datadirs_conflict(self):
+        """
+        Tests that setting both datadir options disables adding images
+        """
+        self.config(filesystem_store_datadirs=[self.test_dir])
+        self.store = Store()
+        self.assertEqual(self.store.add, self.store.add_disabled)
 
     def test_add_storage_full(self):
         """
@@ -200,6 +401,67 @@ class TestStore(base.IsolatedUnitTest):
 
         self.assertRaises(exception.NotFound, self.store.get, loc)
 
+    def test_add_dedup_links_identical_images(self):
+        """Test identical images share one file with dedup enabled"""
+        self.config(filesystem_store_dedup=True)
+        self.store = Store()
+        first_id, first_loc = self._add_image()
+        second_id, second_loc = self._add_image()
+
+        first = os.stat(os.path.join(self.test_dir, first_id))
+        second = os.stat(os.path.join(self.test_dir, second_id))
+        self.assertEqual(first.st_ino, second.st_ino)
+        # Both images plus the blob entry
+        self.assertEqual(3, first.st_nlink)
+
+        image_file = StringIO.StringIO("some other content")
+        third_id = uuidutils.generate_uuid()
+        self.store.add(third_id, image_file, 18)
+        third = os.stat(os.path.join(self.test_dir, third_id))
+        self.assertNotEqual(first.st_ino, third.st_ino)
+        self.assertFalse([f for f in os.listdir(self.test_dir)
+                          if f.endswith('.partial')])
+
+    def test_add_dedup_replaces_stale_ref(self):
+        """
+        Test that a blob reference left behind for an image file that is
+        gone does not prevent the image from being added
+        """
+        self.config(filesystem_store_dedup=True)
+        self.store = Store()
+        image_id = uuidutils.generate_uuid()
+        blobdir = os.path.join(self.test_dir, '.blobs')
+        os.makedirs(blobdir)
+        ref = os.path.join(blobdir, '%s.ref' % image_id)
+        os.symlink('stale', ref)
+
+        image_file = StringIO.StringIO("stale ref content")
+        self.store.add(image_id, image_file, 17)
+
+        digest = hashlib.sha256("stale ref content").hexdigest()
+        self.assertEqual(digest, os.readlink(ref))
+        self.assertEqual("stale ref content",
+                         open(os.path.join(self.test_dir, image_id)).read())
+
+    def test_delete_dedup_keeps_shared_data(self):
+        """Test the shared data is only removed with the last image"""
+        self.config(filesystem_store_dedup=True)
+        self.store = Store()
+        first_id, first_loc = self._add_image()
+        second_id, second_loc = self._add_image()
+        blobdir = os.path.join(self.test_dir, '.blobs')
+
+        self.store.delete(get_location_from_uri(first_loc))
+        (image_file, image_size) = self.store.get(
+            get_location_from_uri(second_loc))
+        self.assertEqual("chunk00000remainder", "".join(image_file))
+        digest = hashlib.sha256("chunk00000remainder").hexdigest()
+        self.assertEqual(sorted([digest, '%s.ref' % second_id]),
+                         sorted(os.listdir(blobdir)))
+
+        self.store.delete(get_location_from_uri(second_loc))
+        self.assertEqual([], os.listdir(blobdir))
+
     def test_delete_non_existing(self):
         """
         Test that trying to delete a file that doesn't exist
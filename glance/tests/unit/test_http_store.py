@@ -33,6 +33,11 @@ from glance.tests import utils, stubs as test_stubs
 # however when it's empty a default 200 OK response is returned from
 # FakeHTTPConnection below.
 FAKE_RESPONSE_STACK = []
+# Every connection opened by FakeHTTPConnection, in order
+FAKE_CONNECTIONS = []
+# Headers of every request sent, in order
+FAKE_REQUEST_HEADERS = []
+FAKE_DATA = 'I am a teapot, short and stout\n'
 
 
 def stub_out_http_backend(stubs):
@@ -49,15 +54,23 @@ def stub_out_http_backend(stubs):
     class FakeHTTPConnection(object):
 
         def __init__(self, *args, **kwargs):
-            pass
+            FAKE_CONNECTIONS.append(self)
+            self.requests = []
+            self.headers = {}
 
         def getresponse(self):
             if len(FAKE_RESPONSE_STACK):
                 return FAKE_RESPONSE_STACK.pop()
+            if 'Range' in self.headers:
+                start, end = self.headers['Range'][6:].split('-')
+                data = FAKE_DATA[int(start):int(end) + 1]
+                return utils.FakeHTTPResponse(status=206, data=data)
             return utils.FakeHTTPResponse()
 
-        def request(self, *_args, **_kwargs):
-            pass
+        def request(self, verb, path, body=None, headers=None):
+            self.requests.append((verb, path))
+            self.headers = headers or {}
+            FAKE_REQUEST_HEADERS.append(self.headers)
 
         def close(self):
             pass
@@ -87,6 +100,8 @@ class TestHttpStore(base.StoreClearingUnitTest):
     def setUp(self):
         global FAKE_RESPONSE_STACK
         FAKE_RESPONSE_STACK = []
+        del FAKE_CONNECTIONS[:]
+        del FAKE_REQUEST_HEADERS[:]
         self.config(default_store='http',
                     known_stores=['glance.store.http.Store'])
         super(TestHttpStore, self).setUp()
@@ -129,6 +144,137 @@ class TestHttpStore(base.StoreClearingUnitTest):
         chunks = [c for c in image_file]
         self.assertEqual(chunks, expected_returns)
 
+    def test_http_reuses_connections(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        self.assertEqual(31, self.store.get_size(loc))
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual('I am a teapot, short and stout\n',
+                         ''.join(image_file))
+        self.assertEqual(31, self.store.get_size(loc))
+
+        self.assertEqual(1, len(FAKE_CONNECTIONS))
+        self.assertEqual([('HEAD', '/path/to/file.tar.gz'),
+                          ('GET', '/path/to/file.tar.gz'),
+                          ('HEAD', '/path/to/file.tar.gz')],
+                         FAKE_CONNECTIONS[0].requests)
+
+    def test_http_get_size_caches_redirect(self):
+        redirect_headers = {"location": "http://example.com/teapot.img"}
+        redirect_resp = utils.FakeHTTPResponse(status=302,
+                                               headers=redirect_headers)
+        FAKE_RESPONSE_STACK.append(redirect_resp)
+
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        self.assertEqual(31, self.store.get_size(loc))
+        self.assertEqual(31, self.store.get_size(loc))
+
+        requests = [r for c in FAKE_CONNECTIONS for r in c.requests]
+        self.assertEqual([('HEAD', '/path/to/file.tar.gz'),
+                          ('HEAD', '/teapot.img'),
+                          ('HEAD', '/teapot.img')], requests)
+
+    def test_http_get_stale_redirect_resolved_again(self):
+        redirect_headers = {"location": "http://example.com/teapot.img"}
+        redirect_resp = utils.FakeHTTPResponse(status=302,
+                                               headers=redirect_headers)
+        FAKE_RESPONSE_STACK.append(redirect_resp)
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        self.assertEqual(31, self.store.get_size(loc))
+
+        # The old target is gone and the URL now serves the image itself
+        not_found_resp = utils.FakeHTTPResponse(status=404,
+                                                data="404 Not Found")
+        FAKE_RESPONSE_STACK.append(not_found_resp)
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(31, image_size)
+        requests = [r for c in FAKE_CONNECTIONS for r in c.requests]
+        self.assertTrue(('GET', '/teapot.img') in requests)
+        self.assertTrue(('GET', '/path/to/file.tar.gz') in requests)
+        self.assertEqual(None, self.store._get_redirect(uri))
+
+    def _push_ranged_response(self, validators=None):
+        headers = {'content-length': 31, 'accept-ranges': 'bytes'}
+        headers.update(validators or {'etag': '"teapot"'})
+        FAKE_RESPONSE_STACK.append(utils.FakeHTTPResponse(headers=headers))
+        self.config(http_store_range_fetch_concurrency=3)
+        self.store = Store()
+        self.store.range_chunk_size = 8
+
+    def test_http_get_ranges(self):
+        self._push_ranged_response()
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(31, image_size)
+        self.assertEqual(FAKE_DATA, ''.join(image_file))
+
+        ranges = [h.get('Range') for h in FAKE_REQUEST_HEADERS]
+        self.assertEqual([None, 'bytes=8-15', 'bytes=16-23', 'bytes=24-30'],
+                         ranges)
+        self.assertEqual('"teapot"', FAKE_REQUEST_HEADERS[1]['If-Range'])
+
+    def test_http_get_ranges_weak_etag(self):
+        # A weak ETag cannot be used in If-Range, unlike the date
+        last_modified = 'Tue, 15 Nov 1994 12:45:26 GMT'
+        self._push_ranged_response({'etag': 'W/"teapot"',
+                                    'last-modified': last_modified})
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(FAKE_DATA, ''.join(image_file))
+        self.assertEqual(4, len(FAKE_REQUEST_HEADERS))
+        self.assertEqual(last_modified, FAKE_REQUEST_HEADERS[1]['If-Range'])
+
+    def test_http_get_ranges_without_validator(self):
+        # Ranges could mix different versions of the image without a
+        # validator, so the image is read in a single request
+        self._push_ranged_response({'etag': 'W/"teapot"'})
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(FAKE_DATA, ''.join(image_file))
+        self.assertEqual(1, len(FAKE_REQUEST_HEADERS))
+
+    def test_http_get_ranges_unsupported(self):
+        self.config(http_store_range_fetch_concurrency=3)
+        self.store = Store()
+        self.store.range_chunk_size = 8
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc)
+        self.assertEqual(FAKE_DATA, ''.join(image_file))
+        self.assertEqual(1, len(FAKE_CONNECTIONS))
+
+    def test_http_get_ranges_changed(self):
+        self._push_ranged_response()
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc)
+        # The image changed, so the server ignores the range
+        for i in xrange(2):
+            FAKE_RESPONSE_STACK.append(utils.FakeHTTPResponse())
+        self.assertRaises(exception.BadStoreUri, ''.join, image_file)
+
+    def test_http_get_range(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc, offset=2, length=5)
+        self.assertEqual(5, image_size)
+        self.assertEqual('am a ', ''.join(image_file))
+        self.assertEqual('bytes=2-6', FAKE_REQUEST_HEADERS[0]['Range'])
+
+    def test_http_get_range_ignored(self):
+        # The server sends the whole image instead of the range
+        FAKE_RESPONSE_STACK.append(utils.FakeHTTPResponse())
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc, offset=2)
+        self.assertEqual(29, image_size)
+        self.assertEqual(FAKE_DATA[2:], ''.join(image_file))
+
     def test_http_get_max_redirects(self):
         # Add more than MAX_REDIRECTS redirects to the response stack
         redirect_headers = {"location": "http://example.com/teapot.img"}
@@ -21,7 +21,10 @@ import os
 import random
 import shutil
 import StringIO
+import time
+import weakref
 
+import eventlet
 import fixtures
 import stubout
 
@@ -186,6 +189,68 @@ class ImageCacheTestCase(object):
             self.assertTrue(self.cache.is_cached(x),
                             "Image %s was not cached!" % x)
 
+    @skip_if_disabled
+    def test_least_recently_accessed_images(self):
+        """
+        Test that the eviction set is taken oldest first and stops once
+        it covers the requested size
+        """
+        for x in xrange(0, 4):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+        for x in xrange(0, 4):
+            with self.cache.open_for_read(x) as cache_file:
+                cache_file.read()
+            time.sleep(0.01)
+
+        driver = self.cache.driver
+        self.assertEqual([], driver.get_least_recently_accessed_images(0))
+        self.assertEqual(['0'], [str(image_id) for image_id, size in
+                                 driver.get_least_recently_accessed_images(1)])
+        entries = driver.get_least_recently_accessed_images(1025)
+        self.assertEqual([('0', 1024), ('1', 1024)],
+                         [(str(i), size) for i, size in entries])
+        self.assertEqual(4, len(driver.get_least_recently_accessed_images(
+                                    100 * 1024)))
+
+        driver.delete_cached_images(['0', '1'])
+        self.assertEqual(2 * 1024, self.cache.get_cache_size())
+        self.assertFalse(self.cache.is_cached('1'))
+        self.assertTrue(self.cache.is_cached('2'))
+
+    @skip_if_disabled
+    def test_enforce_max_size(self):
+        """
+        Test that caching an image of known size makes room for it by
+        pruning the least recently accessed images
+        """
+        self.config(image_cache_enforce_max_size=True)
+        for x in xrange(0, 5):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE,
+                                                        1024))
+            with self.cache.open_for_read(x) as cache_file:
+                cache_file.read()
+            time.sleep(0.01)
+        self.assertEqual(5 * 1024, self.cache.get_cache_size())
+
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file('xxx', FIXTURE_FILE,
+                                                    1024))
+        self.assertEqual(5 * 1024, self.cache.get_cache_size())
+        self.assertFalse(self.cache.is_cached(0))
+        self.assertTrue(self.cache.is_cached(1))
+        self.assertTrue(self.cache.is_cached('xxx'))
+        self.assertEqual({}, self.cache.reserved)
+
+        # An image bigger than the whole cache is refused
+        data = ['a' * 1024] * 6
+        caching_iter = self.cache.get_caching_iter('big', None, iter(data),
+                                                   6 * 1024)
+        self.assertEqual(data, list(caching_iter))
+        self.assertFalse(self.cache.is_cached('big'))
+        self.assertEqual(5 * 1024, self.cache.get_cache_size())
+
     @skip_if_disabled
     def test_prune_to_zero(self):
         """Test that an image_cache_max_size of 0 doesn't kill the pruner
@@ -344,6 +409,40 @@ class ImageCacheTestCase(object):
         # make sure bad image was not cached
         self.assertFalse(self.cache.is_cached(image_id))
 
+    def test_caching_iterator_handles_cache_write_failure(self):
+        """
+        Test that the whole image is still returned when the cache file
+        cannot be written, and that the image is not cached
+        """
+        real_open_for_write = self.cache.driver.open_for_write
+
+        @contextmanager
+        def failing_open_for_write(image_id):
+            with real_open_for_write(image_id) as cache_file:
+                class FailingFile(object):
+                    name = cache_file.name
+
+                    def write(self, chunk):
+                        if chunk == 'c':
+                            raise IOError('No space left on device')
+                        cache_file.write(chunk)
+
+                    def flush(self):
+                        cache_file.flush()
+
+                yield FailingFile()
+
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(self.cache.driver, 'open_for_write',
+                       failing_open_for_write)
+        image_id = '1'
+        data = ['a', 'b', 'c', 'd', 'e', 'f']
+        caching_iter = self.cache.get_caching_iter(image_id, None,
+                                                   iter(data))
+        self.assertEqual(data, list(caching_iter))
+        self.assertFalse(self.cache.is_cached(image_id))
+
     def test_caching_iterator_falloffend(self):
         """
         Test to see if the caching iterator interacts properly with the driver
@@ -372,6 +471,61 @@ class ImageCacheTestCase(object):
         self.assertFalse(os.path.exists(incomplete_file_path))
         self.assertTrue(os.path.exists(invalid_file_path))
 
+    def test_caching_iterator_followers(self):
+        """
+        Ensure requests for an image being cached read it from the cache
+        file as it is written
+        """
+        image_id = '1'
+        data = ['a' * 10, 'b' * 10, 'c' * 10]
+        caching_iter = self.cache.get_caching_iter(image_id, None,
+                                                   iter(data))
+        self.assertEqual(None, self.cache.open_cache_fill(image_id))
+
+        self.assertEqual(data[0], caching_iter.next())
+        follower = self.cache.open_cache_fill(image_id)
+        self.assertTrue(follower is not None)
+        result = eventlet.spawn(lambda: ''.join(follower))
+        eventlet.sleep(0)
+        self.assertEqual(data[1], caching_iter.next())
+        eventlet.sleep(0)
+        self.assertEqual(data[2:], list(caching_iter))
+
+        self.assertEqual(''.join(data), result.wait())
+        self.assertTrue(self.cache.is_cached(image_id))
+        self.assertEqual(None, self.cache.open_cache_fill(image_id))
+
+    def test_caching_iterator_followers_outlive_first_request(self):
+        """
+        Ensure requests following an image being cached are served in
+        full when the request which started caching it goes away
+        """
+        image_id = '1'
+        data = ['a' * 10, 'b' * 10, 'c' * 10]
+        caching_iter = self.cache.get_caching_iter(image_id, None,
+                                                   iter(data))
+        self.assertEqual(data[0], caching_iter.next())
+        follower = self.cache.open_cache_fill(image_id)
+        result = eventlet.spawn(lambda: ''.join(follower))
+        eventlet.sleep(0)
+        caching_iter.close()
+
+        self.assertEqual(''.join(data), result.wait())
+        self.assertTrue(self.cache.is_cached(image_id))
+        self.assertEqual(None, self.cache.open_cache_fill(image_id))
+
+    def test_caching_iterator_followers_fail_with_fill(self):
+        image_id = '1'
+        data = ['a' * 10, 'b' * 10]
+        caching_iter = self.cache.get_caching_iter(image_id, 'foobar',
+                                                   iter(data))
+        self.assertEqual(data[0], caching_iter.next())
+        follower = self.cache.open_cache_fill(image_id)
+        result = eventlet.spawn(lambda: ''.join(follower))
+        self.assertRaises(exception.GlanceException, list, caching_iter)
+        self.assertRaises(exception.GlanceException, result.wait)
+        self.assertFalse(self.cache.is_cached(image_id))
+
     def test_gate_caching_iter_good_checksum(self):
         image = "12345678990abcdefghijklmnop"
         image_id = 123
@@ -443,6 +597,116 @@ class TestImageCacheXattr(test_utils.BaseTestCase,
             self.disabled_message = ("filesystem does not support xattr")
             return
 
+    @skip_if_disabled
+    def test_index_kept_up_to_date(self):
+        """
+        Test that the xattr driver only scans the cache directory when
+        another process has changed it
+        """
+        from glance.image_cache.drivers import xattr as xattr_driver
+
+        self.assertEqual(0, self.cache.get_cache_size())
+        scans = []
+        real_get_all_regular_files = xattr_driver.get_all_regular_files
+
+        def fake_get_all_regular_files(basepath):
+            scans.append(basepath)
+            return real_get_all_regular_files(basepath)
+
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(xattr_driver, 'get_all_regular_files',
+                       fake_get_all_regular_files)
+
+        for x in xrange(0, 3):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+        with self.cache.open_for_read(0) as cache_file:
+            cache_file.read()
+        self.cache.delete_cached_image(1)
+
+        self.assertEqual(2 * 1024, self.cache.get_cache_size())
+        self.assertEqual(('2', 1024),
+                         self.cache.driver.get_least_recently_accessed())
+        self.assertEqual([], scans)
+
+        # Another process adds an image
+        time.sleep(0.01)
+        with open(os.path.join(self.cache_dir, 'other'), 'wb') as f:
+            f.write('x' * 10)
+        self.assertEqual(2 * 1024 + 10, self.cache.get_cache_size())
+        self.assertEqual([self.cache_dir], scans)
+
+    @skip_if_disabled
+    def test_prune_lists_directory_once(self):
+        """
+        Test that pruning several images only checks the cache directory
+        for other processes' changes once
+        """
+        for x in xrange(0, 5):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+        self.assertEqual(5 * 1024, self.cache.get_cache_size())
+
+        listings = []
+        real_listdir = os.listdir
+
+        def fake_listdir(path):
+            listings.append(path)
+            return real_listdir(path)
+
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(os, 'listdir', fake_listdir)
+        self.config(image_cache_max_size=1024)
+        self.assertEqual((4, 4 * 1024), self.cache.prune())
+        self.assertEqual(1024, self.cache.get_cache_size())
+        self.assertEqual([self.cache_dir], listings)
+
+    @skip_if_disabled
+    def test_index_sees_concurrent_changes(self):
+        """
+        Test that an image another process adds or removes while this
+        process is changing the cache directory is not missed
+        """
+        self.assertEqual(0, self.cache.get_cache_size())
+        for x in xrange(0, 2):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+        self.assertEqual(2 * 1024, self.cache.get_cache_size())
+
+        index = self.cache.driver.index
+        real_changing = index.changing
+
+        @contextmanager
+        def changing_with_other_process(change):
+            with real_changing():
+                yield
+                # Another process changes the directory before this
+                # one has looked at the directory's mtime again
+                change()
+
+        def add_other():
+            with open(os.path.join(self.cache_dir, 'other'), 'wb') as f:
+                f.write('x' * 10)
+
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(index, 'changing',
+                       lambda: changing_with_other_process(add_other))
+        self.cache.delete_cached_image(0)
+        self.assertEqual(1024 + 10, self.cache.get_cache_size())
+
+        def remove_other():
+            os.unlink(os.path.join(self.cache_dir, 'other'))
+
+        self.stubs.Set(index, 'changing',
+                       lambda: changing_with_other_process(remove_other))
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file(2, FIXTURE_FILE))
+        self.assertEqual(2 * 1024, self.cache.get_cache_size())
+        self.assertFalse(self.cache.is_cached(0))
+
 
 class TestImageCacheSqlite(test_utils.BaseTestCase,
                            ImageCacheTestCase):
@@ -476,6 +740,153 @@ class TestImageCacheSqlite(test_utils.BaseTestCase,
                     image_cache_max_size=1024 * 5)
         self.cache = image_cache.ImageCache()
 
+    @skip_if_disabled
+    def test_connection_reused(self):
+        driver = self.cache.driver
+        with driver.get_db() as db:
+            conn = db
+            mode = db.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual('wal', mode.lower())
+        with driver.get_db() as db:
+            self.assertTrue(db is conn)
+
+    def _lock_db(self):
+        import sqlite3
+        conn = sqlite3.connect(self.cache.driver.db_path, timeout=0,
+                               isolation_level=None)
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    @skip_if_disabled
+    def test_delete_cached_images_waits_for_lock(self):
+        """
+        Test that deleting cached images retries while another connection
+        holds the database write lock
+        """
+        self.assertTrue(self.cache.cache_image_file(
+                'xxx', StringIO.StringIO(FIXTURE_DATA)))
+        lock = self._lock_db()
+        eventlet.spawn_after(0.1, lock.rollback)
+
+        self.cache.driver.delete_cached_images(['xxx'])
+
+        self.assertEqual(0, self.cache.get_cache_size())
+        self.assertFalse(self.cache.is_cached('xxx'))
+        self.assertFalse(os.path.exists(
+                self.cache.driver.get_image_filepath('xxx')))
+
+    @skip_if_disabled
+    def test_delete_cached_images_failure_keeps_files(self):
+        """
+        Test that cached image files are kept when their rows cannot be
+        deleted
+        """
+        self.assertTrue(self.cache.cache_image_file(
+                'xxx', StringIO.StringIO(FIXTURE_DATA)))
+        lock = self._lock_db()
+        self.addCleanup(lock.rollback)
+        with self.cache.driver.get_db() as db:
+            db.timeout_seconds = 0.1
+
+        self.assertRaises(eventlet.Timeout,
+                          self.cache.driver.delete_cached_images, ['xxx'])
+
+        lock.rollback()
+        self.assertTrue(self.cache.is_cached('xxx'))
+        self.assertTrue(os.path.exists(
+                self.cache.driver.get_image_filepath('xxx')))
+
+    @skip_if_disabled
+    def test_hits_flushed_in_batches(self):
+        """
+        Test that cache hits are written to the database in batches, and
+        before anything that reports them
+        """
+        self.config(image_cache_sqlite_hit_flush_interval=3600)
+        self.assertTrue(self.cache.cache_image_file(
+                'xxx', StringIO.StringIO(FIXTURE_DATA)))
+        for x in xrange(3):
+            with self.cache.open_for_read('xxx') as cache_file:
+                cache_file.read()
+
+        with self.cache.driver.get_db() as db:
+            cur = db.execute("""SELECT hits FROM cached_images
+                             WHERE image_id = 'xxx'""")
+            self.assertEqual(0, cur.fetchone()[0])
+        self.assertEqual(3, self.cache.get_hit_count('xxx'))
+        self.assertEqual({}, self.cache.driver.pending_hits)
+
+        self.config(image_cache_sqlite_hit_flush_interval=0)
+        with self.cache.open_for_read('xxx') as cache_file:
+            cache_file.read()
+        self.assertEqual({}, self.cache.driver.pending_hits)
+        self.assertEqual(4, self.cache.get_hit_count('xxx'))
+
+    @skip_if_disabled
+    def test_hits_flushed_on_timer(self):
+        """
+        Test that cache hits are written to the database within the flush
+        interval when no more images are read, and when the process exits
+        """
+        from glance.image_cache.drivers import sqlite as sqlite_driver
+
+        timers = []
+
+        def fake_spawn_after(seconds, func):
+            timers.append((seconds, func))
+            return object()
+
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(sqlite_driver, 'spawn_after', fake_spawn_after)
+        self.config(image_cache_sqlite_hit_flush_interval=3600)
+        self.assertTrue(self.cache.cache_image_file(
+                'xxx', StringIO.StringIO(FIXTURE_DATA)))
+        driver = self.cache.driver
+        for x in xrange(2):
+            with self.cache.open_for_read('xxx') as cache_file:
+                cache_file.read()
+        self.assertEqual(1, len(timers))
+        self.assertEqual(3600, timers[0][0])
+
+        timers.pop()[1]()
+        self.assertEqual({}, driver.pending_hits)
+        self.assertEqual(2, self.cache.get_hit_count('xxx'))
+
+        with self.cache.open_for_read('xxx') as cache_file:
+            cache_file.read()
+        self.assertEqual(1, len(timers))
+        sqlite_driver._flush_hits_at_exit(weakref.ref(driver))
+        self.assertEqual({}, driver.pending_hits)
+        self.assertEqual(3, self.cache.get_hit_count('xxx'))
+
+    @skip_if_disabled
+    def test_hits_kept_when_flush_fails(self):
+        """
+        Test that cache hits that could not be written to the database
+        are written by the next flush
+        """
+        self.config(image_cache_sqlite_hit_flush_interval=3600)
+        self.assertTrue(self.cache.cache_image_file(
+                'xxx', StringIO.StringIO(FIXTURE_DATA)))
+        for x in xrange(2):
+            with self.cache.open_for_read('xxx') as cache_file:
+                cache_file.read()
+
+        driver = self.cache.driver
+        with driver.get_db() as db:
+            db.timeout_seconds = 0.1
+        lock = self._lock_db()
+        self.assertRaises(eventlet.Timeout, driver.flush_hits)
+        lock.rollback()
+        self.assertEqual(2, driver.pending_hits['xxx'][0])
+
+        with self.cache.open_for_read('xxx') as cache_file:
+            cache_file.read()
+        driver.flush_hits()
+        self.assertEqual({}, driver.pending_hits)
+        self.assertEqual(3, self.cache.get_hit_count('xxx'))
+
 
 class TestImageCacheNoDep(test_utils.BaseTestCase):
 
@@ -0,0 +1,467 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack, LLC
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Tests the RBD backend store"""
+
+import hashlib
+import StringIO
+import threading
+import time
+
+import fixtures
+import stubout
+
+from glance.common import exception
+from glance.store.location import Location
+import glance.store.rbd
+from glance.tests import utils as test_utils
+
+
+FSID = 'fake-fsid'
+
+
+def rbd_location(uri):
+    return Location('rbd', glance.store.rbd.StoreLocation, uri=uri)
+
+
+# rados and rbd are not needed to run the unit tests, so the parts of
+# them the store uses are faked here, keeping the images in memory
+class FakeRados(object):
+
+    class Error(Exception):
+        pass
+
+    class Rados(object):
+        def __init__(self, conffile=None, rados_id=None):
+            self.state = 'configuring'
+            self.ioctxs = []
+
+        def connect(self):
+            self.state = 'connected'
+
+        def get_fsid(self):
+            return FSID
+
+        def open_ioctx(self, pool):
+            ioctx = FakeIoctx(pool)
+            self.ioctxs.append(ioctx)
+            return ioctx
+
+        def shutdown(self):
+            self.state = 'shutdown'
+
+
+class FakeIoctx(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRBD(object):
+
+    RBD_FEATURE_LAYERING = 1
+
+    class Error(Exception):
+        pass
+
+    class ImageExists(Error):
+        pass
+
+    class ImageNotFound(Error):
+        pass
+
+    class ImageBusy(Error):
+        pass
+
+    # The images in each pool, as a map of (pool, name) to a dict of the
+    # image data and snapshots
+    images = {}
+
+    class RBD(object):
+        def create(self, ioctx, name, size, order, old_format=True,
+                   features=0):
+            key = (ioctx.pool, name)
+            if key in FakeRBD.images:
+                raise FakeRBD.ImageExists(name)
+            FakeRBD.images[key] = {'data': '\0' * size, 'snaps': {}}
+
+        def clone(self, p_ioctx, p_name, p_snapname, c_ioctx, c_name,
+                  features=0):
+            parent = FakeRBD.images.get((p_ioctx.pool, p_name))
+            if parent is None or p_snapname not in parent['snaps']:
+                raise FakeRBD.ImageNotFound(p_name)
+            key = (c_ioctx.pool, c_name)
+            if key in FakeRBD.images:
+                raise FakeRBD.ImageExists(c_name)
+            FakeRBD.images[key] = {'data': parent['snaps'][p_snapname],
+                                   'snaps': {}}
+
+        def remove(self, ioctx, name):
+            if FakeRBD.images.pop((ioctx.pool, name), None) is None:
+                raise FakeRBD.ImageNotFound(name)
+
+    class Image(object):
+        def __init__(self, ioctx, name):
+            key = (ioctx.pool, name)
+            if key not in FakeRBD.images:
+                raise FakeRBD.ImageNotFound(name)
+            self.image = FakeRBD.images[key]
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.close()
+
+        def close(self):
+            pass
+
+        def size(self):
+            return len(self.image['data'])
+
+        def stat(self):
+            return {'size': self.size()}
+
+        def read(self, offset, length):
+            return self.image['data'][offset:offset + length]
+
+        def write(self, data, offset):
+            image_data = self.image['data']
+            self.image['data'] = (image_data[:offset] + data +
+                                  image_data[offset + len(data):])
+            return len(data)
+
+        def create_snap(self, name):
+            self.image['snaps'][name] = self.image['data']
+
+        def protect_snap(self, name):
+            pass
+
+        def unprotect_snap(self, name):
+            pass
+
+        def remove_snap(self, name):
+            del self.image['snaps'][name]
+
+
+class TestStore(test_utils.BaseTestCase):
+
+    def setUp(self):
+        """Establish a clean test environment"""
+        super(TestStore, self).setUp()
+        FakeRBD.images = {}
+        self.useFixture(fixtures.MonkeyPatch('glance.store.rbd.rados',
+                                             FakeRados))
+        self.useFixture(fixtures.MonkeyPatch('glance.store.rbd.rbd',
+                                             FakeRBD))
+        self.useFixture(fixtures.MonkeyPatch('glance.store.rbd._CLUSTERS',
+                                             {}))
+        self.config(rbd_store_pool='images')
+        self.store = glance.store.rbd.Store()
+        self.stubs = stubout.StubOutForTesting()
+        self.addCleanup(self.stubs.UnsetAll)
+
+    def _get_pipelined_store(self):
+        self.config(rbd_store_queue_depth=3)
+        store = glance.store.rbd.Store()
+        store.chunk_size = 4
+        return store
+
+    def _track_calls(self, method, fail_at=None):
+        """
+        Replaces a method of the fake images with one that is slower for
+        earlier offsets and records how many calls run at the same time,
+        optionally failing at an offset
+        """
+        calls = {'started': 0, 'active': 0, 'max_active': 0}
+        lock = threading.Lock()
+        real_method = getattr(FakeRBD.Image, method)
+
+        def tracked(image, *args):
+            offset = args[0] if method == 'read' else args[1]
+            with lock:
+                calls['started'] += 1
+                calls['active'] += 1
+                calls['max_active'] = max(calls['max_active'],
+                                          calls['active'])
+            try:
+                time.sleep(0.02 if offset < 8 else 0.001)
+                if offset == fail_at:
+                    raise FakeRBD.Error('I/O error')
+                with lock:
+                    return real_method(image, *args)
+            finally:
+                with lock:
+                    calls['active'] -= 1
+
+        self.stubs.Set(FakeRBD.Image, method, tracked)
+        return calls
+
+    def _add_source(self, pool, name, data, snapshot='snap'):
+        FakeRBD.images[(pool, name)] = {'data': data,
+                                        'snaps': {snapshot: data}}
+        return rbd_location('rbd://%s/%s/%s/%s' %
+                            (FSID, pool, name, snapshot))
+
+    def test_get_read_ahead(self):
+        """
+        Tests that chunks read concurrently are returned in order
+        """
+        data = 'abcdefghijklmnopqrstuvwxyz'
+        FakeRBD.images[('images', 'img')] = {'data': data, 'snaps': {}}
+        calls = self._track_calls('read')
+        store = self._get_pipelined_store()
+
+        image_iter, size = store.get(rbd_location('rbd://img'))
+
+        self.assertEqual([data[i:i + 4] for i in xrange(0, len(data), 4)],
+                         list(image_iter))
+        self.assertTrue(calls['max_active'] > 1)
+        self.assertEqual(0, calls['active'])
+
+    def test_get_read_ahead_range(self):
+        """Tests that a range of an image is read ahead"""
+        data = 'abcdefghijklmnopqrstuvwxyz'
+        FakeRBD.images[('images', 'img')] = {'data': data, 'snaps': {}}
+        store = self._get_pipelined_store()
+
+        image_iter, size = store.get(rbd_location('rbd://img'), offset=5,
+                                     length=10)
+
+        self.assertEqual(data[5:15], ''.join(image_iter))
+
+    def test_get_read_ahead_error(self):
+        """
+        Tests that an error reading a chunk is raised to the reader once
+        the reads in flight are done
+        """
+        FakeRBD.images[('images', 'img')] = {'data': 'x' * 26, 'snaps': {}}
+        calls = self._track_calls('read', fail_at=8)
+        store = self._get_pipelined_store()
+
+        image_iter, size = store.get(rbd_location('rbd://img'))
+
+        self.assertRaises(FakeRBD.Error, list, image_iter)
+        self.assertEqual(0, calls['active'])
+
+    def test_get_read_ahead_stopped_early(self):
+        """
+        Tests that reads in flight are waited for, and no more are
+        started, when the reader stops early
+        """
+        FakeRBD.images[('images', 'img')] = {'data': 'x' * 400, 'snaps': {}}
+        calls = self._track_calls('read')
+        store = self._get_pipelined_store()
+
+        image_iter, size = store.get(rbd_location('rbd://img'))
+        chunks = iter(image_iter)
+        self.assertEqual('xxxx', chunks.next())
+        chunks.close()
+
+        self.assertEqual(0, calls['active'])
+        self.assertTrue(calls['started'] <= 4)
+
+    def test_add_pipelined(self):
+        """
+        Tests that chunks written concurrently all end up in place
+        """
+        data = 'abcdefghijklmnopqrstuvwxyz'
+        calls = self._track_calls('write')
+        store = self._get_pipelined_store()
+
+        location, size, checksum = store.add('img', StringIO.StringIO(data),
+                                             len(data))
+
+        self.assertEqual(len(data), size)
+        self.assertEqual(hashlib.md5(data).hexdigest(), checksum)
+        self.assertEqual(data, FakeRBD.images[('images', 'img')]['data'])
+        self.assertTrue(calls['max_active'] > 1)
+        self.assertEqual(0, calls['active'])
+
+    def test_add_pipelined_error(self):
+        """
+        Tests that an error writing a chunk is raised once the writes in
+        flight are done
+        """
+        data = 'x' * 26
+        calls = self._track_calls('write', fail_at=8)
+        store = self._get_pipelined_store()
+
+        self.assertRaises(FakeRBD.Error, store.add, 'img',
+                          StringIO.StringIO(data), len(data))
+        self.assertEqual(0, calls['active'])
+
+    def test_add_from_location_clones_snapshot(self):
+        """
+        Tests that an image in the same cluster is copied by cloning its
+        snapshot, and the clone is snapshotted in turn
+        """
+        source = self._add_source('volumes', 'src', 'x' * 100)
+
+        location, size, checksum = self.store.add_from_location(
+                'new-image', source, 100)
+
+        self.assertEqual('rbd://%s/images/new-image/snap' % FSID, location)
+        self.assertEqual(100, size)
+        self.assertEqual(None, checksum)
+        clone = FakeRBD.images[('images', 'new-image')]
+        self.assertEqual('x' * 100, clone['data'])
+        self.assertTrue('snap' in clone['snaps'])
+
+    def test_add_from_location_other_cluster(self):
+        """
+        Tests that an image in another cluster is not cloned, so that it
+        is streamed instead
+        """
+        self._add_source('volumes', 'src', 'x' * 100)
+        source = rbd_location('rbd://other-fsid/volumes/src/snap')
+
+        self.assertEqual(None, self.store.add_from_location(
+                'new-image', source, 100))
+        self.assertFalse(('images', 'new-image') in FakeRBD.images)
+
+    def test_add_from_location_without_snapshot(self):
+        """Tests that a location without a snapshot is not cloned"""
+        FakeRBD.images[('images', 'src')] = {'data': 'x', 'snaps': {}}
+        source = rbd_location('rbd://src')
+
+        self.assertEqual(None, self.store.add_from_location(
+                'new-image', source, 1))
+
+    def test_add_from_location_clone_on_copy_disabled(self):
+        """Tests that rbd_store_clone_on_copy turns cloning off"""
+        self.config(rbd_store_clone_on_copy=False)
+        self.store = glance.store.rbd.Store()
+        source = self._add_source('volumes', 'src', 'x' * 100)
+
+        self.assertEqual(None, self.store.add_from_location(
+                'new-image', source, 100))
+
+    def test_add_from_location_missing_snapshot(self):
+        """
+        Tests that cloning a snapshot that does not exist raises NotFound
+        """
+        self._add_source('volumes', 'src', 'x' * 100)
+        source = rbd_location('rbd://%s/volumes/src/gone' % FSID)
+
+        self.assertRaises(exception.NotFound, self.store.add_from_location,
+                          'new-image', source, 100)
+
+    def test_add_from_location_already_existing(self):
+        """
+        Tests that cloning to the name of an existing image raises
+        Duplicate
+        """
+        source = self._add_source('volumes', 'src', 'x' * 100)
+        self._add_source('images', 'new-image', 'y')
+
+        self.assertRaises(exception.Duplicate, self.store.add_from_location,
+                          'new-image', source, 100)
+
+
+class TestClusterConnection(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestClusterConnection, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch('glance.store.rbd.rados',
+                                             FakeRados))
+        self.cluster = glance.store.rbd.ClusterConnection('ceph.conf',
+                                                          'glance')
+
+    def test_ioctx_reused(self):
+        """Tests that one I/O context per pool is shared by callers"""
+        with self.cluster.open_ioctx('images') as ioctx:
+            pass
+        with self.cluster.open_ioctx('images') as other:
+            self.assertTrue(other is ioctx)
+        self.assertEqual(FSID, self.cluster.get_fsid())
+        self.assertFalse(ioctx.closed)
+
+    def test_error_reconnects(self):
+        """
+        Tests that a RADOS error makes the next caller use a new
+        connection, and that the old one is closed
+        """
+        def fail():
+            with self.cluster.open_ioctx('images'):
+                raise FakeRados.Error()
+
+        with self.cluster.open_ioctx('images') as ioctx:
+            pass
+        conn = self.cluster.handles.conn
+        self.assertRaises(FakeRados.Error, fail)
+
+        self.assertTrue(ioctx.closed)
+        self.assertEqual('shutdown', conn.state)
+        with self.cluster.open_ioctx('images') as other:
+            self.assertFalse(other is ioctx)
+            self.assertFalse(other.closed)
+
+    def test_error_keeps_handles_in_use(self):
+        """
+        Tests that a RADOS error hit by one caller does not close the
+        I/O contexts other callers are still using
+        """
+        def fail():
+            with self.cluster.open_ioctx('images'):
+                raise FakeRados.Error()
+
+        with self.cluster.open_ioctx('images') as ioctx:
+            conn = self.cluster.handles.conn
+            self.assertRaises(FakeRados.Error, fail)
+            self.assertFalse(ioctx.closed)
+            self.assertEqual('connected', conn.state)
+
+            with self.cluster.open_ioctx('images') as other:
+                self.assertFalse(other is ioctx)
+
+        self.assertTrue(ioctx.closed)
+        self.assertEqual('shutdown', conn.state)
+        self.assertFalse(other.closed)
+
+    def test_reconnect_when_disconnected(self):
+        """Tests that a connection that was lost is replaced"""
+        with self.cluster.open_ioctx('images') as ioctx:
+            pass
+        self.cluster.handles.conn.state = 'shutdown'
+        with self.cluster.open_ioctx('images') as other:
+            self.assertFalse(other is ioctx)
+        self.assertTrue(ioctx.closed)
+
+    def test_reconnect_after_fork(self):
+        """
+        Tests that handles inherited from a parent process are replaced
+        without being closed
+        """
+        with self.cluster.open_ioctx('images') as ioctx:
+            pass
+        self.cluster.pid = -1
+        with self.cluster.open_ioctx('images') as other:
+            self.assertFalse(other is ioctx)
+        self.assertFalse(ioctx.closed)
+
+    def test_shutdown(self):
+        """Tests that shutting down closes the connection"""
+        with self.cluster.open_ioctx('images') as ioctx:
+            pass
+        conn = self.cluster.handles.conn
+        self.cluster.shutdown()
+        self.assertTrue(ioctx.closed)
+        self.assertEqual('shutdown', conn.state)
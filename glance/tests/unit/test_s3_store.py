@@ -20,6 +20,7 @@
 import hashlib
 import StringIO
 
+import boto.exception
 import boto.s3.connection
 import stubout
 
@@ -35,6 +36,8 @@ from glance.tests.unit import base
 FAKE_UUID = uuidutils.generate_uuid()
 
 FIVE_KB = (5 * 1024)
+NO_SUCH_BUCKET = ('<?xml version="1.0" encoding="UTF-8"?>\n<Error>'
+                  '<Code>NoSuchBucket</Code></Error>')
 S3_CONF = {'verbose': True,
            'debug': True,
            'default_store': 's3',
@@ -90,6 +93,37 @@ def stub_out_s3(stubs):
         def get_file(self):
             return self.data
 
+        def open_read(self, headers=None):
+            start, end = headers['Range'][6:].split('-')
+            self.data.seek(int(start))
+            data = self.data.read(int(end) - int(start) + 1)
+            self.read = StringIO.StringIO(data).read
+
+    class FakeMultiPartUpload:
+        """
+        Acts like a ``boto.s3.multipart.MultiPartUpload``
+        """
+        def __init__(self, bucket, key_name):
+            self.bucket = bucket
+            self.key_name = key_name
+            self.parts = {}
+            self.completed = False
+            self.cancelled = False
+
+        def upload_part_from_file(self, fp, part_num, **kwargs):
+            self.parts[part_num] = fp.read()
+
+        def complete_upload(self):
+            data = ''.join(self.parts[part_num]
+                           for part_num in sorted(self.parts))
+            key = self.bucket.new_key(self.key_name)
+            key.set_contents_from_file(StringIO.StringIO(data))
+            self.completed = True
+
+        def cancel_upload(self):
+            self.parts = {}
+            self.cancelled = True
+
     class FakeBucket:
         """
         Acts like a ``boto.s3.bucket.Bucket``
@@ -97,6 +131,7 @@ def stub_out_s3(stubs):
         def __init__(self, name, keys=None):
             self.name = name
             self.keys = keys or {}
+            self.multipart_uploads = []
 
         def __str__(self):
             return self.name
@@ -108,16 +143,18 @@ def stub_out_s3(stubs):
             del self.keys[key]
 
         def get_key(self, key_name, **kwargs):
-            key = self.keys.get(key_name)
-            if not key:
-                return FakeKey(self, key_name)
-            return key
+            return self.keys.get(key_name)
 
         def new_key(self, key_name):
             new_key = FakeKey(self, key_name)
             self.keys[key_name] = new_key
             return new_key
 
+        def initiate_multipart_upload(self, key_name, **kwargs):
+            mpu = FakeMultiPartUpload(self, key_name)
+            self.multipart_uploads.append(mpu)
+            return mpu
+
     fixture_buckets = {'glance': FakeBucket('glance')}
     b = fixture_buckets['glance']
     k = b.new_key(FAKE_UUID)
@@ -182,6 +219,19 @@ class TestStore(base.StoreClearingUnitTest):
             data += chunk
         self.assertEqual(expected_data, data)
 
+    def test_get_range(self):
+        """Test retrieving part of an image"""
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        (image_s3, image_size) = self.store.get(loc, offset=1024,
+                                                length=2048)
+        self.assertEqual(2048, image_size)
+        self.assertEqual("*" * 2048, "".join(image_s3))
+
+        (image_s3, image_size) = self.store.get(loc, offset=FIVE_KB - 10)
+        self.assertEqual(10, image_size)
+        self.assertEqual("*" * 10, "".join(image_s3))
+
     def test_get_calling_format_path(self):
         """Test a "normal" retrieval of an image in chunks"""
         self.config(s3_store_bucket_url_format='path')
@@ -258,6 +308,211 @@ class TestStore(base.StoreClearingUnitTest):
         self.assertEquals(expected_s3_contents, new_image_contents.getvalue())
         self.assertEquals(expected_s3_size, new_image_s3_size)
 
+    def test_add_multipart(self):
+        """
+        Test that a large image is streamed to S3 as a multipart upload
+        """
+        self.config(s3_store_large_object_size=0,
+                    s3_store_large_object_upload_concurrency=2)
+        self.store = Store()
+        self.store.large_object_chunk_size = 1024
+        expected_image_id = uuidutils.generate_uuid()
+        expected_s3_size = FIVE_KB + 512
+        expected_s3_contents = "*" * expected_s3_size
+        expected_checksum = hashlib.md5(expected_s3_contents).hexdigest()
+        image_s3 = StringIO.StringIO(expected_s3_contents)
+
+        location, size, checksum = self.store.add(expected_image_id,
+                                                  image_s3,
+                                                  expected_s3_size)
+
+        self.assertEquals(expected_s3_size, size)
+        self.assertEquals(expected_checksum, checksum)
+
+        bucket = boto.s3.connection.S3Connection(
+            host='localhost:8080').get_bucket('glance')
+        mpu = bucket.multipart_uploads[-1]
+        self.assertTrue(mpu.completed)
+        self.assertEquals(sorted(mpu.parts), range(1, 7))
+
+        loc = get_location_from_uri(location)
+        (new_image_s3, new_image_size) = self.store.get(loc)
+        self.assertEquals(expected_s3_contents,
+                          ''.join(chunk for chunk in new_image_s3))
+
+    def test_add_multipart_unknown_size(self):
+        """
+        Test that an image of unknown size is uploaded in parts
+        """
+        self.store.large_object_chunk_size = 1024
+        expected_image_id = uuidutils.generate_uuid()
+        expected_s3_contents = "*" * FIVE_KB
+        expected_checksum = hashlib.md5(expected_s3_contents).hexdigest()
+        image_s3 = StringIO.StringIO(expected_s3_contents)
+
+        location, size, checksum = self.store.add(expected_image_id,
+                                                  image_s3, 0)
+
+        self.assertEquals(FIVE_KB, size)
+        self.assertEquals(expected_checksum, checksum)
+
+    def test_add_multipart_part_size_fits_max_parts(self):
+        """
+        Test that the parts of a large image are made big enough for the
+        image to fit in the number of parts S3 allows
+        """
+        self.stubs.Set(glance.store.s3, 'MAX_MULTIPART_PARTS', 4)
+        self.config(s3_store_large_object_size=0)
+        self.store = Store()
+        self.store.large_object_chunk_size = 1024
+        expected_s3_size = FIVE_KB + 512
+        expected_s3_contents = "*" * expected_s3_size
+        image_s3 = StringIO.StringIO(expected_s3_contents)
+
+        location, size, checksum = self.store.add(uuidutils.generate_uuid(),
+                                                  image_s3,
+                                                  expected_s3_size)
+
+        self.assertEquals(expected_s3_size, size)
+        bucket = boto.s3.connection.S3Connection(
+            host='localhost:8080').get_bucket('glance')
+        mpu = bucket.multipart_uploads[-1]
+        self.assertTrue(mpu.completed)
+        self.assertEquals(sorted(mpu.parts), range(1, 5))
+
+    def test_add_multipart_too_many_parts(self):
+        """
+        Test that an image of unknown size is rejected as soon as it
+        needs more parts than S3 allows
+        """
+        self.stubs.Set(glance.store.s3, 'MAX_MULTIPART_PARTS', 4)
+        self.store.large_object_chunk_size = 1024
+        expected_image_id = uuidutils.generate_uuid()
+        image_s3 = StringIO.StringIO("*" * FIVE_KB)
+
+        self.assertRaises(exception.StorageFull, self.store.add,
+                          expected_image_id, image_s3, 0)
+        bucket = boto.s3.connection.S3Connection(
+            host='localhost:8080').get_bucket('glance')
+        mpu = bucket.multipart_uploads[-1]
+        self.assertTrue(mpu.cancelled)
+        self.assertFalse(bucket.exists(expected_image_id))
+
+    def test_add_multipart_part_failure(self):
+        """
+        Test that the multipart upload is aborted when a part fails
+        """
+        self.store.large_object_chunk_size = 1024
+        expected_image_id = uuidutils.generate_uuid()
+        image_s3 = StringIO.StringIO("*" * FIVE_KB)
+        bucket = boto.s3.connection.S3Connection(
+            host='localhost:8080').get_bucket('glance')
+        fake_initiate = bucket.initiate_multipart_upload
+
+        def fake_initiate_multipart_upload(key_name, **kwargs):
+            mpu = fake_initiate(key_name, **kwargs)
+
+            def fake_upload_part_from_file(fp, part_num, **kwargs):
+                if part_num == 3:
+                    raise IOError('part failed')
+                mpu.parts[part_num] = fp.read()
+
+            mpu.upload_part_from_file = fake_upload_part_from_file
+            return mpu
+
+        self.stubs.Set(bucket, 'initiate_multipart_upload',
+                       fake_initiate_multipart_upload)
+
+        self.assertRaises(IOError, self.store.add, expected_image_id,
+                          image_s3, 0)
+        mpu = bucket.multipart_uploads[-1]
+        self.assertTrue(mpu.cancelled)
+        self.assertFalse(mpu.completed)
+        self.assertFalse(bucket.exists(expected_image_id))
+
+    def test_add_multipart_chunk_size_too_small(self):
+        """
+        Test that a part size below the S3 minimum is rejected
+        """
+        self.config(s3_store_large_object_chunk_size=1)
+        self.store = Store()
+        image_s3 = StringIO.StringIO("*" * FIVE_KB)
+        self.assertRaises(exception.StoreAddDisabled, self.store.add,
+                          uuidutils.generate_uuid(), image_s3, FIVE_KB)
+
+    def test_get_size_reuses_bucket(self):
+        """
+        Test that the connection and bucket handle are only set up once
+        for repeated requests to the same bucket
+        """
+        connections = []
+        lookups = []
+        fake_init = boto.s3.connection.S3Connection.__init__
+        fake_get_bucket = boto.s3.connection.S3Connection.get_bucket
+
+        def fake_S3Connection_init(conn, *args, **kwargs):
+            connections.append(conn)
+            fake_init(conn, *args, **kwargs)
+
+        def counting_get_bucket(conn, bucket_id):
+            lookups.append(bucket_id)
+            return fake_get_bucket(conn, bucket_id)
+
+        self.stubs.Set(boto.s3.connection.S3Connection, '__init__',
+                       fake_S3Connection_init)
+        self.stubs.Set(boto.s3.connection.S3Connection, 'get_bucket',
+                       counting_get_bucket)
+
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        self.assertEqual(self.store.get_size(loc), FIVE_KB)
+        self.assertEqual(self.store.get_size(loc), FIVE_KB)
+        (image_s3, image_size) = self.store.get(loc)
+
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(lookups, ['glance'])
+
+        other = get_location_from_uri(
+            "s3://user2:key@auth_address/glance/%s" % FAKE_UUID)
+        self.assertEqual(self.store.get_size(other), FIVE_KB)
+        self.assertEqual(len(connections), 2)
+
+        # The same access key with another secret must not share the
+        # connection authenticated with the first one
+        wrong_secret = get_location_from_uri(
+            "s3://user:wrong@auth_address/glance/%s" % FAKE_UUID)
+        self.store.get_size(wrong_secret)
+        self.assertEqual(len(connections), 3)
+        self.assertEqual(lookups, ['glance', 'glance', 'glance'])
+
+    def test_get_stale_bucket_reconnects(self):
+        """
+        Test that a cached bucket handle is replaced when S3 reports the
+        bucket is gone
+        """
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        self.assertEqual(self.store.get_size(loc), FIVE_KB)
+
+        (stale_bucket, cached) = self.store._get_bucket(
+            loc.store_location)
+        self.assertTrue(cached)
+
+        def fake_get_key(key_name, **kwargs):
+            raise boto.exception.S3ResponseError(404, 'Not Found',
+                                                 NO_SUCH_BUCKET)
+
+        stale = glance.store.s3.get_bucket(
+            boto.s3.connection.S3Connection(host='localhost:8080'),
+            'stale')
+        self.stubs.Set(stale, 'get_key', fake_get_key)
+        for cache_key in self.store.bucket_cache:
+            self.store.bucket_cache[cache_key] = stale
+
+        (image_s3, image_size) = self.store.get(loc)
+        self.assertEqual(image_size, FIVE_KB)
+        self.assertTrue(stale not in self.store.bucket_cache.values())
+
     def test_add_host_variations(self):
         """
         Test that having http(s):// in the s3serviceurl in config
@@ -16,6 +16,7 @@
 #    under the License.
 
 from glance.common import exception
+from glance.common import utils
 from glance import context
 import glance.store
 import glance.store.filesystem
@@ -391,3 +392,50 @@ class TestStoreLocation(base.StoreClearingUnitTest):
                               glance.store.get_store_from_scheme,
                               ctx,
                               store)
+
+    def test_get_store_from_scheme_is_shared(self):
+        """
+        Test that the same store instance is returned for every request
+        rather than a newly configured store each time.
+        """
+        ctx1 = context.RequestContext(user='user1')
+        ctx2 = context.RequestContext(user='user2')
+        store1 = glance.store.get_store_from_scheme(ctx1, 'file')
+        store2 = glance.store.get_store_from_scheme(ctx2, 'filesystem')
+        self.assertTrue(store1 is store2)
+
+        store3 = glance.store.get_store_from_uri(ctx1, 'swift://a:b@c/d/e')
+        store4 = glance.store.get_store_from_uri(ctx2, 'swift://a:b@c/d/f')
+        self.assertTrue(store3 is store4)
+
+    def test_get_location_from_uri_is_cached(self):
+        """
+        Test that a URI is only parsed once, while its scheme is still
+        registered.
+        """
+        uri = 's3://accesskey:secretkey@s3.amazonaws.com/bucket/key-id'
+        loc1 = location.get_location_from_uri(uri)
+        loc2 = location.get_location_from_uri(uri)
+        self.assertTrue(loc1 is loc2)
+
+        location.SCHEME_TO_CLS_MAP = {}
+        self.assertRaises(exception.UnknownScheme,
+                          location.get_location_from_uri, uri)
+
+    def test_get_location_from_uri_cache_is_bounded(self):
+        self.addCleanup(setattr, location, '_LOCATION_CACHE',
+                        location._LOCATION_CACHE)
+        location._LOCATION_CACHE = utils.LRUCache(2)
+        first = location.get_location_from_uri('file:///images/1')
+        location.get_location_from_uri('file:///images/2')
+        location.get_location_from_uri('file:///images/3')
+        self.assertFalse(first is
+                         location.get_location_from_uri('file:///images/1'))
+
+    def test_get_store_and_location(self):
+        ctx = context.RequestContext()
+        store, loc = glance.store.get_store_and_location(
+            ctx, 'swift://a:b@c/d/e')
+        self.assertEqual(glance.store.swift.SingleTenantStore,
+                         store.__class__)
+        self.assertEqual('e', loc.store_location.obj)
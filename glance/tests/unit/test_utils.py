@@ -15,9 +15,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
+import hashlib
 import StringIO
 import tempfile
 
+import stubout
+
 from glance.common import exception
 from glance.common import utils
 from glance.tests import utils as test_utils
@@ -61,6 +65,115 @@ class TestUtils(test_utils.BaseTestCase):
         meat = ''.join(chunks)
         self.assertEqual(meat, 'aaabbbcccdddeeefffggghhh')
 
+    def test_slice_iter(self):
+        chunks = ['abc', 'def', 'ghi']
+        self.assertEqual(['bc', 'de'], list(utils.slice_iter(chunks, 1, 4)))
+        self.assertEqual(['def'], list(utils.slice_iter(chunks, 3, 3)))
+        self.assertEqual(['hi'], list(utils.slice_iter(chunks, 7)))
+        self.assertEqual(['ghi'], list(utils.slice_iter(chunks, 6, 10)))
+        self.assertEqual([], list(utils.slice_iter(chunks, 9)))
+
+    def test_threaded_hasher(self):
+        """Ensure updates of any size are hashed in order"""
+        chunks = ['a' * 10, 'b' * utils.ThreadedHasher.MIN_THREADED_SIZE,
+                  'c' * 3, 'd' * (utils.ThreadedHasher.MIN_THREADED_SIZE * 2)]
+        hasher = utils.ThreadedHasher(hashlib.md5())
+        for chunk in chunks:
+            hasher.update(chunk)
+        expected = hashlib.md5(''.join(chunks))
+        self.assertEqual(expected.hexdigest(), hasher.hexdigest())
+        self.assertEqual(expected.digest(), hasher.digest())
+
+    def test_threaded_hasher_batches_updates(self):
+        """Ensure small updates are handed to threads in batches"""
+        stubs = stubout.StubOutForTesting()
+        self.addCleanup(stubs.UnsetAll)
+        calls = []
+        real_execute = utils.tpool.execute
+
+        def fake_execute(func, *args):
+            calls.append(func)
+            return real_execute(func, *args)
+
+        stubs.Set(utils.tpool, 'execute', fake_execute)
+        chunk = 'x' * 65536
+        count = utils.ThreadedHasher.MIN_THREADED_SIZE / len(chunk) * 3 + 1
+        hasher = utils.ThreadedHasher(hashlib.md5())
+        for i in xrange(count):
+            hasher.update(chunk)
+        self.assertEqual(hashlib.md5(chunk * count).hexdigest(),
+                         hasher.hexdigest())
+        self.assertEqual(3, len(calls))
+
+    def test_chunk_size(self):
+        data = StringIO.StringIO('*' * 10)
+        self.assertEqual(65536, utils.get_chunk_size())
+        self.assertEqual(4, utils.get_chunk_size(4))
+        self.assertEqual(['****'] * 2 + ['**'],
+                         list(utils.chunkiter(data, 4)))
+        self.config(image_chunk_size=3)
+        self.assertEqual(3, utils.get_chunk_size(4))
+        data = StringIO.StringIO('*' * 10)
+        self.assertEqual(['***'] * 3 + ['*'], list(utils.chunkiter(data)))
+
+    def test_pipeline(self):
+        """Ensure each chunk passes through every stage in order"""
+        self.config(image_chunk_size=4)
+        written = []
+        hasher = hashlib.md5()
+        data = utils.pipeline(StringIO.StringIO('abcdefghij'),
+                              utils.cooperative_iter,
+                              functools.partial(utils.limiting_iter,
+                                                limit=10),
+                              functools.partial(utils.hashing_iter,
+                                                hashers=[hasher]),
+                              functools.partial(utils.tee_iter,
+                                                write=written.append))
+        self.assertEqual(['abcd', 'efgh', 'ij'], list(data))
+        self.assertEqual(['abcd', 'efgh', 'ij'], written)
+        self.assertEqual(hashlib.md5('abcdefghij').hexdigest(),
+                         hasher.hexdigest())
+
+    def test_pipeline_limit_exceeded(self):
+        written = []
+        data = utils.pipeline(['abcd', 'efgh', 'ij'],
+                              functools.partial(utils.limiting_iter,
+                                                limit=6),
+                              functools.partial(utils.tee_iter,
+                                                write=written.append))
+        self.assertEqual('abcd', data.next())
+        self.assertRaises(exception.ImageSizeLimitExceeded, data.next)
+        self.assertEqual(['abcd'], written)
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache['a'])
+        cache['c'] = 3
+        self.assertEqual(['a', 'c'], sorted(cache))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.pop('c'))
+        self.assertEqual('x', cache.pop('c', 'x'))
+        self.assertRaises(KeyError, cache.pop, 'c')
+        cache['d'] = 4
+        cache['e'] = 5
+        self.assertEqual([('d', 4), ('e', 5)], sorted(cache.items()))
+        del cache['d']
+        self.assertEqual([5], cache.values())
+        self.assertFalse('d' in cache)
+        self.assertEqual(1, len(cache))
+
+    def test_lru_cache_compacts(self):
+        cache = utils.LRUCache(3)
+        for x in xrange(3):
+            cache[x] = x
+        for x in xrange(1000):
+            cache.get(x % 3)
+        self.assertTrue(len(cache.order) <= 2 * 3 + 16)
+        cache['new'] = 'new'
+        self.assertEqual([0, 2, 'new'], sorted(cache))
+
     def test_limiting_reader(self):
         """Ensure limiting reader class accesses all bytes of file"""
         BYTES = 1024
@@ -98,11 +98,16 @@ class FakeStoreAPI(object):
     def set_acls(*_args, **_kwargs):
         pass
 
-    def get_from_backend(self, context, location):
+    def get_from_backend(self, context, location, offset=0, length=None):
         try:
-            return self.data[location]
+            data, size = self.data[location]
         except KeyError:
             raise exception.NotFound()
+        if offset or length is not None:
+            end = size if length is None else offset + length
+            data = data[offset:end]
+            size = len(data)
+        return data, size
 
     def safe_delete_from_backend(self, uri, context, id, **kwargs):
         try:
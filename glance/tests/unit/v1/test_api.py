@@ -20,8 +20,10 @@ import datetime
 import hashlib
 import httplib
 import json
+import os
 import StringIO
 
+import eventlet
 import routes
 from sqlalchemy import exc
 import stubout
@@ -30,6 +32,7 @@ import webob
 import glance.api.common
 from glance.api.v1 import images
 from glance.api.v1 import router
+from glance.common import exception
 import glance.common.config
 import glance.context
 from glance.db.sqlalchemy import api as db_api
@@ -2267,6 +2270,126 @@ class TestGlanceAPI(base.IsolatedUnitTest):
         res = req.get_response(self.api)
         self.assertEquals(res.status_int, webob.exc.HTTPBadRequest.code)
 
+    def test_add_copy_from_rbd_requires_admin(self):
+        """Tests that only admins may copy from an RBD location"""
+        fixture_headers = {'x-image-meta-store': 'file',
+                           'x-image-meta-disk-format': 'raw',
+                           'x-image-meta-container-format': 'bare',
+                           'x-image-meta-name': 'fake image #3',
+                           'x-glance-api-copy-from':
+                           'rbd://fsid/images/%s/snap' % UUID1}
+
+        req = webob.Request.blank("/images")
+        req.method = 'POST'
+        for k, v in fixture_headers.iteritems():
+            req.headers[k] = v
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.BAD_REQUEST)
+
+    def test_add_copy_from_within_store(self):
+        """
+        Tests that a store that can copy the source itself is used instead
+        of streaming the image data through the API
+        """
+        self.api = test_utils.FakeAuthMiddleware(router.API(self.mapper),
+                                                 is_admin=True)
+        fixture_headers = {'x-image-meta-store': 'file',
+                           'x-image-meta-disk-format': 'raw',
+                           'x-image-meta-container-format': 'bare',
+                           'x-image-meta-name': 'fake image #3',
+                           'x-glance-api-copy-from':
+                           'http://example.com/images/123'}
+        copied = []
+
+        def fake_get_from_backend(context, uri, **kwargs):
+            return iter(['image data']), None
+
+        def fake_add_from_location(store, image_id, source, image_size,
+                                   context=None):
+            copied.append(source.get_store_uri())
+            return ('file:///copied/%s' % image_id, 10, None)
+
+        def fake_add(*args, **kwargs):
+            self.fail('Image data should not be streamed')
+
+        self.stubs.Set(images, 'get_from_backend', fake_get_from_backend)
+        self.stubs.Set(glance.store.filesystem.Store, 'add_from_location',
+                       fake_add_from_location)
+        self.stubs.Set(glance.store.filesystem.Store, 'add', fake_add)
+
+        req = webob.Request.blank("/images")
+        req.method = 'POST'
+        for k, v in fixture_headers.iteritems():
+            req.headers[k] = v
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CREATED)
+        image_id = json.loads(res.body)['image']['id']
+
+        # The copy happens asynchronously
+        eventlet.sleep(0)
+
+        self.assertEquals(copied, ['http://example.com/images/123'])
+        req = webob.Request.blank("/images/%s" % image_id)
+        req.method = 'HEAD'
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.OK)
+        self.assertEquals(res.headers['x-image-meta-status'], 'active')
+        self.assertEquals(res.headers['x-image-meta-size'], '10')
+        self.assertFalse('x-image-meta-checksum' in res.headers)
+
+    def test_add_copy_from_within_store_verifies_checksum(self):
+        """
+        Tests that the image data is streamed, so that its checksum is
+        verified, when a checksum is supplied for a copy
+        """
+        self.api = test_utils.FakeAuthMiddleware(router.API(self.mapper),
+                                                 is_admin=True)
+        checksum = hashlib.md5('image data').hexdigest()
+        fixture_headers = {'x-image-meta-store': 'file',
+                           'x-image-meta-disk-format': 'raw',
+                           'x-image-meta-container-format': 'bare',
+                           'x-image-meta-name': 'fake image #3',
+                           'x-image-meta-checksum': checksum,
+                           'x-glance-api-copy-from':
+                           'http://example.com/images/123'}
+
+        def fake_get_from_backend(context, uri, **kwargs):
+            return iter(['image data']), None
+
+        added = []
+
+        def fake_add_from_location(*args, **kwargs):
+            self.fail('Image data should be streamed')
+
+        def fake_add(store, image_id, image_file, image_size,
+                     context=None):
+            added.append(image_id)
+            return ('file:///added/%s' % image_id, 10, checksum)
+
+        self.stubs.Set(images, 'get_from_backend', fake_get_from_backend)
+        self.stubs.Set(glance.store.filesystem.Store, 'add_from_location',
+                       fake_add_from_location)
+        self.stubs.Set(glance.store.filesystem.Store, 'add', fake_add)
+
+        req = webob.Request.blank("/images")
+        req.method = 'POST'
+        for k, v in fixture_headers.iteritems():
+            req.headers[k] = v
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.CREATED)
+        image_id = json.loads(res.body)['image']['id']
+
+        # The copy happens asynchronously
+        eventlet.sleep(0)
+
+        req = webob.Request.blank("/images/%s" % image_id)
+        req.method = 'HEAD'
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, httplib.OK)
+        self.assertEquals(added, [image_id])
+        self.assertEquals(res.headers['x-image-meta-status'], 'active')
+        self.assertEquals(res.headers['x-image-meta-checksum'], checksum)
+
     def test_add_image_basic_file_store(self):
         """Tests to add a basic image in the file store"""
         fixture_headers = {'x-image-meta-store': 'file',
@@ -2994,6 +3117,39 @@ class TestGlanceAPI(base.IsolatedUnitTest):
         self.assertEqual(res.content_type, 'application/octet-stream')
         self.assertEqual('chunk00000remainder', res.body)
 
+    def test_show_image_range(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=5-9'
+        res = req.get_response(self.api)
+        self.assertEqual(206, res.status_int)
+        self.assertEqual('00000', res.body)
+        self.assertEqual('bytes 5-9/19', res.headers['Content-Range'])
+        self.assertEqual('5', res.headers['Content-Length'])
+
+    def test_show_image_range_suffix(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=-9'
+        res = req.get_response(self.api)
+        self.assertEqual(206, res.status_int)
+        self.assertEqual('remainder', res.body)
+        self.assertEqual('bytes 10-18/19', res.headers['Content-Range'])
+
+    def test_show_image_range_not_satisfiable(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=19-'
+        res = req.get_response(self.api)
+        self.assertEqual(416, res.status_int)
+        self.assertEqual('bytes */19', res.headers['Content-Range'])
+
+    def test_show_image_if_range_mismatch(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=5-9'
+        req.headers['If-Range'] = '"0745064918b49693cca64d6b6a13d28a"'
+        res = req.get_response(self.api)
+        self.assertEqual(200, res.status_int)
+        self.assertEqual('chunk00000remainder', res.body)
+        self.assertEqual('bytes', res.headers['Accept-Ranges'])
+
     def test_show_non_exists_image(self):
         req = webob.Request.blank("/images/%s" % _gen_uuid())
         res = req.get_response(self.api)
@@ -3369,6 +3525,62 @@ class TestImageSerializer(base.IsolatedUnitTest):
 
         self.assertEqual(response.body, 'chunk67891123456789')
 
+    def test_show_file_wrapper(self):
+        """
+        Tests that an image in a local file is handed to the server's
+        file wrapper
+        """
+        class FakeFileWrapper(object):
+            def __init__(self, filelike, blksize):
+                self.filelike = filelike
+
+        path = os.path.join(self.test_dir, 'image')
+        with open(path, 'wb') as image_file:
+            image_file.write('*' * 19)
+        self.FIXTURE['image_iterator'] = glance.store.filesystem.ChunkedFile(
+            path)
+
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.method = 'GET'
+        req.context = self.context
+        req.environ['wsgi.file_wrapper'] = FakeFileWrapper
+        response = webob.Response(request=req)
+        notified = []
+        self.stubs.Set(self.serializer.notifier, 'info',
+                       lambda event_type, payload: notified.append(payload))
+        self.serializer.show(response, self.FIXTURE)
+
+        self.assertTrue(isinstance(response.app_iter, FakeFileWrapper))
+        self.assertEquals(response.app_iter.filelike.read(), '*' * 19)
+        self.assertEquals('19', response.headers['Content-Length'])
+
+        # The notification is sent when the server closes the file
+        self.assertEqual([], notified)
+        response.app_iter.filelike.close()
+        response.app_iter.filelike.close()
+        self.assertEqual([19], [payload['bytes_sent']
+                                for payload in notified])
+
+    def test_show_file_wrapper_size_mismatch(self):
+        """
+        Tests that the image is streamed when the local file is not the
+        expected size
+        """
+        path = os.path.join(self.test_dir, 'image')
+        with open(path, 'wb') as image_file:
+            image_file.write('*' * 10)
+        self.FIXTURE['image_iterator'] = glance.store.filesystem.ChunkedFile(
+            path)
+
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.method = 'GET'
+        req.context = self.context
+        req.environ['wsgi.file_wrapper'] = self.fail
+        response = webob.Response(request=req)
+        self.serializer.show(response, self.FIXTURE)
+
+        self.assertRaises(exception.GlanceException, list, response.app_iter)
+
     def test_show_notify(self):
         """Make sure an eventlet posthook for notify_image_sent is added."""
         req = webob.Request.blank("/images/%s" % UUID2)
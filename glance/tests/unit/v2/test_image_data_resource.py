@@ -69,6 +69,22 @@ class TestImagesController(base.StoreClearingUnitTest):
         }
         self.assertEqual(output_log, expected_log)
 
+    def test_download_range(self):
+        request = unit_test_utils.get_fake_request()
+        self.controller.upload(request, unit_test_utils.UUID2, 'YYYY', 4)
+        request.headers['Range'] = 'bytes=1-2'
+        output = self.controller.download(request, unit_test_utils.UUID2)
+        self.assertEqual((1, 2), output['range'])
+        self.assertEqual('YY', output['data'])
+
+    def test_download_range_not_satisfiable(self):
+        request = unit_test_utils.get_fake_request()
+        self.controller.upload(request, unit_test_utils.UUID2, 'YYYY', 4)
+        request.headers['Range'] = 'bytes=4-'
+        self.assertRaises(webob.exc.HTTPRequestRangeNotSatisfiable,
+                          self.controller.download, request,
+                          unit_test_utils.UUID2)
+
     def test_upload_non_existent_image(self):
         request = unit_test_utils.get_fake_request()
         self.assertRaises(webob.exc.HTTPNotFound, self.controller.upload,
@@ -227,6 +243,24 @@ class TestImageDataSerializer(test_utils.BaseTestCase):
         self.assertEqual('application/octet-stream',
                          response.headers['Content-Type'])
 
+    def test_download_range(self):
+        request = webob.Request.blank('/')
+        request.environ = {}
+        response = webob.Response()
+        response.request = request
+        checksum = '0745064918b49693cca64d6b6a13d28a'
+        fixture = {
+            'data': 'ZZ',
+            'meta': {'size': 3, 'id': 'asdf', 'checksum': checksum},
+            'range': (1, 2),
+        }
+        self.serializer.download(response, fixture)
+        self.assertEqual(206, response.status_int)
+        self.assertEqual('ZZ', response.body)
+        self.assertEqual('2', response.headers['Content-Length'])
+        self.assertEqual('bytes 1-2/3', response.headers['Content-Range'])
+        self.assertFalse('Content-MD5' in response.headers)
+
     def test_upload(self):
         request = webob.Request.blank('/')
         request.environ = {}